@@ -0,0 +1,496 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from Protocol import FrameDecoder, encode_message, encode_frame, decode_message, MESSAGE_FRAMES, FRAME_FILE_CHUNK, FRAME_STREAM_CHUNK, STREAM_CHUNK_HEADER, CHUNK_SIZE
+
+# Text messages sent by the benchmark carry this prefix followed by their send time
+TEXT_PREFIX = "bench "
+# Room the file transfer phase uploads into, so only the chosen receivers download the file
+FILE_ROOM = "bench-files"
+# Seconds without any received frame after which the server is considered idle
+SETTLE_TIME = 0.5
+# Metrics compared against a baseline, and whether a higher value is better
+REGRESSION_METRICS = [
+    ("connect.joins_per_sec", True),
+    ("messages.delivered_per_sec", True),
+    ("messages.latency_ms.p50", False),
+    ("messages.latency_ms.p99", False),
+    ("file.delivery_mb_per_sec", True),
+    ("rss.peak_mb", False),
+]
+
+
+def log(text):
+    # Progress goes to stderr so stdout carries only the JSON results
+    print(text, file=sys.stderr, flush=True)
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def raise_file_limit():
+    # Thousands of simulated clients need thousands of sockets
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError) as e:
+        log(f"Could not raise open file limit: {e}")
+
+
+def process_tree(pid):
+    # A process and all of its descendants (server workers), from /proc on Linux
+    pids = [pid]
+    for current in pids:
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as children:
+                    pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def rss_bytes(pid):
+    # Resident set size of a process tree, or None where /proc is not available
+    total = None
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total = (total or 0) + int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def rounded(value, digits=3):
+    return None if value is None else round(value, digits)
+
+
+def megabytes(size):
+    return None if size is None else round(size / (1024 * 1024), 2)
+
+
+class Recorder:
+    # Measurements shared by every simulated client
+    def __init__(self):
+        self.frames = 0
+        self.last_frame = time.perf_counter()
+        self.latencies = []
+        self.delivered = 0
+        self.disconnected = 0
+        self.changed = asyncio.Event()
+
+    def frame_received(self):
+        self.frames += 1
+        self.last_frame = time.perf_counter()
+
+    def notify(self):
+        self.changed.set()
+
+    async def wait_for(self, predicate, timeout):
+        # Wait until a condition over the counters holds; False on timeout
+        deadline = time.perf_counter() + timeout
+        while not predicate():
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return False
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), min(remaining, 0.25))
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    async def settle(self, timeout):
+        # Wait until no frames have arrived for SETTLE_TIME, e.g. once join announcements have been delivered
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() - self.last_frame < SETTLE_TIME and time.perf_counter() < deadline:
+            await asyncio.sleep(SETTLE_TIME / 5)
+
+
+class SimClient:
+    # A headless client speaking the same protocol as ChatClient
+
+    def __init__(self, name, recorder):
+        self.name = name
+        self.recorder = recorder
+        # Start small; the buffer grows only for clients that receive file chunks
+        self.decoder = FrameDecoder(buffer_size=4096)
+        self.reader = None
+        self.writer = None
+        self.joined = False
+        self.synced = False
+        self.closing = False
+        self.file_length = None
+        self.file_received = 0
+        self.file_done = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(encode_message({"type": "join", "name": self.name}))
+        await self.writer.drain()
+        asyncio.create_task(self.receive_loop())
+
+    async def receive_loop(self):
+        try:
+            while data := await self.reader.read(256 * 1024):
+                self.decoder.feed(data)
+                for frame_type, payload in self.decoder.frames():
+                    self.handle_frame(frame_type, payload)
+        except (OSError, ValueError) as e:
+            if not self.closing:
+                log(f"{self.name}: {e}")
+        if not self.closing:
+            self.recorder.disconnected += 1
+            self.recorder.notify()
+
+    def handle_frame(self, frame_type, payload):
+        recorder = self.recorder
+        recorder.frame_received()
+        if frame_type == FRAME_STREAM_CHUNK:
+            self.file_received += len(payload) - STREAM_CHUNK_HEADER.size
+            if self.file_received == self.file_length:
+                self.file_done = time.perf_counter()
+                recorder.notify()
+            return
+        if frame_type not in MESSAGE_FRAMES:
+            return
+        message = decode_message(payload, frame_type)
+        message_type = message["type"]
+        if message_type == "text":
+            text = message["text"]
+            if text.startswith(TEXT_PREFIX):
+                recorder.latencies.append(time.perf_counter() - float(text[len(TEXT_PREFIX):]))
+                recorder.delivered += 1
+                recorder.notify()
+            elif message["room"] == FILE_ROOM:
+                self.synced = True
+                recorder.notify()
+        elif message_type == "user_list" and not self.joined:
+            self.joined = True
+            recorder.notify()
+        elif message_type == "file":
+            self.file_length = message["length"]
+            self.file_received = 0
+            self.file_done = None
+        elif message_type == "file_abort":
+            log(f"{self.name}: file transfer aborted")
+
+    async def send(self, message):
+        self.writer.write(encode_message(message))
+        await self.writer.drain()
+
+    async def send_text(self, room="lobby"):
+        await self.send({"type": "text", "text": f"{TEXT_PREFIX}{time.perf_counter():.9f}", "room": room})
+
+    async def send_file(self, size, room):
+        # Upload `size` bytes of incompressible data in the same chunk frames ChatClient sends
+        block = os.urandom(CHUNK_SIZE)
+        await self.send({"type": "file", "filename": "bench.bin", "length": size,
+                         "timestamp": time.strftime("%H:%M:%S"), "room": room})
+        for offset in range(0, size, CHUNK_SIZE):
+            self.writer.write(encode_frame(FRAME_FILE_CHUNK, block[:min(CHUNK_SIZE, size - offset)]))
+            await self.writer.drain()
+
+    def close(self):
+        self.closing = True
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Benchmark:
+    # Drives one server through the connect, message and file phases and collects the results
+
+    def __init__(self, args, host, port, server_pid=None):
+        self.args = args
+        self.host = host
+        self.port = port
+        self.server_pid = server_pid
+        self.recorder = None
+        self.clients = []
+        self.rss_samples = []
+
+    def sample_rss(self):
+        if self.server_pid is None:
+            return None
+        rss = rss_bytes(self.server_pid)
+        if rss is not None:
+            self.rss_samples.append(rss)
+        return rss
+
+    async def sample_rss_forever(self):
+        while True:
+            self.sample_rss()
+            await asyncio.sleep(0.25)
+
+    async def run(self):
+        self.recorder = Recorder()
+        results = {"rss": {"idle_mb": megabytes(self.sample_rss())}}
+        sampler = asyncio.create_task(self.sample_rss_forever())
+        try:
+            results["connect"] = await self.connect_phase()
+            results["rss"]["connected_mb"] = megabytes(self.sample_rss())
+            results["messages"] = await self.message_phase()
+            if self.args.file_size > 0 and self.args.file_receivers > 0:
+                results["file"] = await self.file_phase()
+        finally:
+            sampler.cancel()
+            for client in self.clients:
+                client.close()
+        results["rss"]["peak_mb"] = megabytes(max(self.rss_samples, default=None))
+        results["disconnected"] = self.recorder.disconnected
+        return results
+
+    async def connect_phase(self):
+        # Connect every client, a bounded number at a time, and wait until each has its roster snapshot
+        args = self.args
+        recorder = self.recorder
+        log(f"Connecting {args.clients} clients")
+        limit = asyncio.Semaphore(args.connect_concurrency)
+
+        async def connect(client):
+            async with limit:
+                await client.connect(self.host, self.port)
+
+        self.clients = [SimClient(f"bench{index}", recorder) for index in range(args.clients)]
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(connect(client) for client in self.clients), return_exceptions=True)
+        failed = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        if failed:
+            log(f"{len(failed)} clients failed to connect: {failed[0]}")
+        self.clients = [client for client, outcome in zip(self.clients, outcomes) if not isinstance(outcome, Exception)]
+        await recorder.wait_for(lambda: all(client.joined for client in self.clients), args.timeout)
+        elapsed = time.perf_counter() - start
+        # Clients the server never admitted take no part in the later phases
+        for client in self.clients:
+            if not client.joined:
+                client.close()
+        self.clients = [client for client in self.clients if client.joined]
+        joined = len(self.clients)
+        if joined < args.clients:
+            log(f"{args.clients - joined} clients did not join within {args.timeout}s")
+        # Let the join announcements drain so they do not count against message latency
+        await recorder.settle(args.timeout)
+        return {
+            "clients": args.clients,
+            "joined": joined,
+            "failed": len(failed),
+            "seconds": round(elapsed, 3),
+            "joins_per_sec": round(joined / elapsed, 1) if elapsed else None,
+        }
+
+    async def message_phase(self):
+        # Senders broadcast text to the lobby; every other client records each message's end-to-end latency
+        args = self.args
+        recorder = self.recorder
+        senders = self.clients[:args.senders]
+        expected = len(senders) * args.messages * (len(self.clients) - 1)
+        # Messages per second for each sender, when a total rate is requested
+        interval = len(senders) / args.rate if args.rate else 0
+        log(f"Broadcasting {len(senders) * args.messages} messages from {len(senders)} senders")
+
+        async def send(sender):
+            for _ in range(args.messages):
+                await sender.send_text()
+                await asyncio.sleep(interval)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send(sender) for sender in senders))
+        sent_elapsed = time.perf_counter() - start
+        complete = await recorder.wait_for(lambda: recorder.delivered >= expected or not self.clients, args.timeout)
+        elapsed = time.perf_counter() - start
+        if not complete:
+            log(f"Timed out with {recorder.delivered} of {expected} messages delivered")
+        latencies = sorted(latency * 1000 for latency in recorder.latencies)
+        sent = len(senders) * args.messages
+        return {
+            "senders": len(senders),
+            "sent": sent,
+            "expected_deliveries": expected,
+            "delivered": recorder.delivered,
+            "seconds": round(elapsed, 3),
+            "sent_per_sec": round(sent / sent_elapsed, 1) if sent_elapsed else None,
+            "delivered_per_sec": round(recorder.delivered / elapsed, 1) if elapsed else None,
+            "latency_ms": {
+                "p50": rounded(percentile(latencies, 0.50)),
+                "p90": rounded(percentile(latencies, 0.90)),
+                "p99": rounded(percentile(latencies, 0.99)),
+                "max": rounded(latencies[-1] if latencies else None),
+            },
+        }
+
+    async def file_phase(self):
+        # One client uploads a file to a room the receivers subscribed to; measures upload and delivery rates
+        args = self.args
+        recorder = self.recorder
+        await recorder.settle(args.timeout)
+        uploader = self.clients[0]
+        receivers = self.clients[1:1 + args.file_receivers]
+        for receiver in receivers:
+            await receiver.send({"type": "subscribe", "room": FILE_ROOM})
+        # A text to the room confirms every subscription has been processed before the upload starts
+        await uploader.send({"type": "text", "text": "sync", "room": FILE_ROOM})
+        await recorder.wait_for(lambda: all(receiver.synced for receiver in receivers), args.timeout)
+        log(f"Uploading {args.file_size} bytes to {len(receivers)} receivers")
+        start = time.perf_counter()
+        await uploader.send_file(args.file_size, FILE_ROOM)
+        uploaded = time.perf_counter() - start
+        await recorder.wait_for(lambda: all(receiver.file_done for receiver in receivers), args.timeout)
+        finished = [receiver.file_done - start for receiver in receivers if receiver.file_done]
+        elapsed = max(finished) if finished else time.perf_counter() - start
+        size_mb = args.file_size / (1024 * 1024)
+        return {
+            "size_bytes": args.file_size,
+            "receivers": len(receivers),
+            "completed": len(finished),
+            "upload_seconds": round(uploaded, 3),
+            "delivery_seconds": round(elapsed, 3),
+            "upload_mb_per_sec": round(size_mb / uploaded, 2) if uploaded else None,
+            "delivery_mb_per_sec": round(size_mb * len(finished) / elapsed, 2) if elapsed else None,
+        }
+
+
+def lookup(results, path):
+    # Fetch a dotted key such as "messages.latency_ms.p99" from nested results
+    value = results
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def find_regressions(results, baseline, tolerance):
+    # Metrics that got worse than the baseline by more than the tolerance fraction
+    regressions = []
+    for path, higher_is_better in REGRESSION_METRICS:
+        current = lookup(results, path)
+        previous = lookup(baseline, path)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append({"metric": path, "baseline": previous, "current": current,
+                                "change": round(change, 3)})
+    return regressions
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_server(args, port, directory):
+    # Run Server.py as a child process in a scratch directory so uploaded files do not pile up
+    server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Server.py")
+    command = [sys.executable, server_script, "--host", "127.0.0.1", "--port", str(port),
+               *shlex.split(args.server_args)]
+    server = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL,
+                              stderr=None if args.verbose else subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with status {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server did not start listening")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="QuickChat load generator and latency benchmark")
+    parser.add_argument("--connect", metavar="HOST:PORT",
+                        help="benchmark a running server instead of starting one")
+    parser.add_argument("--server-pid", type=int,
+                        help="process id of the server given with --connect, to report its memory use")
+    parser.add_argument("--server-args", default="",
+                        help='options for the server this tool starts, e.g. "--engine asyncio --workers 4"')
+    parser.add_argument("--clients", type=int, default=500, help="simulated clients to connect")
+    parser.add_argument("--connect-concurrency", type=int, default=100,
+                        help="connections opened at the same time")
+    parser.add_argument("--senders", type=int, default=10, help="clients that broadcast text messages")
+    parser.add_argument("--messages", type=int, default=50, help="messages each sender broadcasts")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="total messages per second across senders (0 sends as fast as possible)")
+    parser.add_argument("--file-size", type=int, default=8 * 1024 * 1024,
+                        help="bytes uploaded in the file transfer phase (0 skips it)")
+    parser.add_argument("--file-receivers", type=int, default=10, help="clients that download the uploaded file")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each phase to complete")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="fraction a metric may worsen by before it counts as a regression")
+    parser.add_argument("--verbose", action="store_true", help="show the started server's errors")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    raise_file_limit()
+    server = None
+    directory = None
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        port = int(port)
+        server_pid = args.server_pid
+    else:
+        host, port = "127.0.0.1", free_port()
+        directory = tempfile.mkdtemp(prefix="quickchat-bench-")
+        server = start_server(args, port, directory)
+        server_pid = server.pid
+    try:
+        results = asyncio.run(Benchmark(args, host, port, server_pid).run())
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "server": args.connect or f"Server.py {args.server_args}".strip(),
+        "results": results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = find_regressions(results, baseline.get("results", baseline), args.tolerance)
+        report["regressions"] = regressions
+        for regression in regressions:
+            log(f"Regression in {regression['metric']}: {regression['baseline']} -> {regression['current']}")
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import shutil
+import string
+import tempfile
+import threading
+import time
+
+# Uploads are stored once per distinct content under files/.store/blobs/<first two hex digits>/<sha256>.
+# The files users see (files/{name}_{timestamp}_{filename}) are hard links to their blob, and
+# files/.store/index.jsonl records which blob every name refers to.
+STORE_DIR = ".store"
+# Partial uploads of resumable transfers are kept this many seconds for their sender to come back
+PARTIAL_MAX_AGE = 24 * 60 * 60
+
+
+def valid_digest(digest):
+    # Digests come from clients and become paths, so only accept 64 lowercase hex digits
+    return isinstance(digest, str) and len(digest) == 64 and all(c in string.hexdigits[:16] for c in digest)
+
+
+def valid_transfer_id(transfer):
+    # Transfer ids also become paths: 8 to 64 hex digits
+    return isinstance(transfer, str) and 8 <= len(transfer) <= 64 and all(c in string.hexdigits for c in transfer)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    # SHA-256 of a file, read in chunks
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobUpload:
+    # A blob being received: bytes are hashed as they arrive and written to a temporary file,
+    # unless the sender announced a digest the store already has, in which case they are only hashed.
+    # A resumable upload writes to a file named after its transfer, which survives an interrupted
+    # connection (or server restart) and is picked up again, hash state included, when the sender resumes.
+    # Its owner file, which names the client allowed to resume it, goes when the upload is committed or aborted.
+
+    def __init__(self, store, expected=None, partial_path=None, owner_path=None):
+        if expected is not None and not valid_digest(expected):
+            raise ValueError("Invalid SHA-256 digest")
+        self.store = store
+        self.expected = expected
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.file = None
+        self.temp_path = None
+        self.owner_path = owner_path
+        self.resumable = partial_path is not None
+        self.duplicate = expected is not None and store.has(expected)
+        if self.duplicate:
+            return
+        if partial_path is None:
+            fd, self.temp_path = tempfile.mkstemp(dir=store.incoming)
+            self.file = os.fdopen(fd, 'wb')
+            return
+        self.temp_path = partial_path
+        self.file = open(partial_path, 'a+b')
+        # Rebuild the hash of what was received before the interruption
+        self.file.seek(0)
+        while chunk := self.file.read(1024 * 1024):
+            self.hash.update(chunk)
+            self.size += len(chunk)
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        if self.file is not None:
+            self.file.write(data)
+
+    def commit(self):
+        # Verify the content and move it into the store; returns its digest
+        digest = self.hash.hexdigest()
+        if self.expected is not None and digest != self.expected:
+            self.abort()
+            raise ValueError("File content does not match its SHA-256 digest")
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            path = self.store.blob_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                # Someone stored the same content meanwhile
+                os.remove(self.temp_path)
+            else:
+                os.replace(self.temp_path, path)
+            self.temp_path = None
+        self.disown()
+        return digest
+
+    def suspend(self):
+        # Keep what was received so the sender can resume later
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def abort(self):
+        # Discard a partial upload
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.temp_path is not None:
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+            self.temp_path = None
+        self.disown()
+
+    def disown(self):
+        if self.owner_path is not None:
+            try:
+                os.remove(self.owner_path)
+            except OSError:
+                pass
+            self.owner_path = None
+
+
+class BlobStore:
+    # Content-addressed storage shared by the server and clients running from the same directory
+
+    def __init__(self, directory="files"):
+        self.directory = directory
+        self.root = os.path.join(directory, STORE_DIR)
+        self.blobs = os.path.join(self.root, "blobs")
+        self.incoming = os.path.join(self.root, "incoming")
+        self.index_path = os.path.join(self.root, "index.jsonl")
+        self.lock = threading.Lock()
+        os.makedirs(self.blobs, exist_ok=True)
+        os.makedirs(self.incoming, exist_ok=True)
+
+    def prune_partials(self, max_age=PARTIAL_MAX_AGE):
+        # Delete partial uploads whose senders never came back
+        cutoff = time.time() - max_age
+        names = set(os.listdir(self.incoming))
+        for name in names:
+            path = os.path.join(self.incoming, name)
+            # An owner file is as old as its partial's first byte, so it goes with the partial
+            if name.endswith(".owner") and f"{name[:-6]}.part" in names:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    if name.endswith(".part"):
+                        os.remove(f"{path[:-5]}.owner")
+            except OSError:
+                pass
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def has(self, digest):
+        return valid_digest(digest) and os.path.exists(self.blob_path(digest))
+
+    def partial_owner(self, transfer):
+        # Name of the client that may resume a transfer, or None when nobody has started it
+        try:
+            with open(os.path.join(self.incoming, f"{transfer.lower()}.owner"), encoding='utf-8') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def begin(self, expected=None, transfer=None, owner=None):
+        # Start receiving a blob, optionally with the digest the sender announced. Giving a transfer id
+        # makes the upload resumable: its size tells the sender where to continue from. Only the owner
+        # that started a transfer may resume it, since resuming replays and completes what it sent.
+        if transfer is None:
+            return BlobUpload(self, expected)
+        if not valid_transfer_id(transfer):
+            raise ValueError("Invalid transfer id")
+        partial_path = os.path.join(self.incoming, f"{transfer.lower()}.part")
+        owner_path = os.path.join(self.incoming, f"{transfer.lower()}.owner")
+        with self.lock:
+            recorded = self.partial_owner(transfer)
+            if recorded is not None and recorded != owner:
+                raise PermissionError("Transfer belongs to another user")
+            if recorded is None:
+                # A partial nobody owns (left by an older server) is not handed to whoever asks first
+                try:
+                    os.remove(partial_path)
+                except FileNotFoundError:
+                    pass
+                with open(owner_path, 'w', encoding='utf-8') as file:
+                    file.write(owner)
+        return BlobUpload(self, expected, partial_path, owner_path)
+
+    def link(self, digest, path, **metadata):
+        # Give a stored blob a visible name and record it in the index; the name shares the blob's data
+        blob = self.blob_path(digest)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(blob, path)
+        except OSError:
+            # Filesystems without hard links get a copy
+            shutil.copyfile(blob, path)
+        entry = {"name": os.path.basename(path), "sha256": digest, "size": os.path.getsize(blob),
+                 "time": time.time(), **metadata}
+        with self.lock:
+            with open(self.index_path, 'a') as index:
+                index.write(json.dumps(entry) + "\n")
+        return path
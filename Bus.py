@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from Protocol import FrameDecoder, ProtocolError, encode_frame, FRAME_BUS
+from Outbound import OutboundQueue
+
+logger = logging.getLogger("quickchat.bus")
+
+# A bus envelope is a FRAME_BUS frame whose payload is a 2 byte route length, the JSON route,
+# then an already encoded client frame that receiving workers deliver without re-encoding.
+ROUTE_LENGTH = struct.Struct("!H")
+# High water mark of a bus connection's queue. Bus frames are queued as bulk frames, which are never
+# refused and which nothing waits on, so the queue is not actually bounded: everything sent to a peer
+# that stops reading stays in memory until its connection closes.
+BUS_HIGH_WATER = 64 * 1024 * 1024
+
+
+def encode_envelope(route, frame=b""):
+    # Wrap a client frame with the route that says which connections should receive it
+    route_data = json.dumps(route).encode("utf-8")
+    return encode_frame(FRAME_BUS, ROUTE_LENGTH.pack(len(route_data)) + route_data + frame)
+
+
+def decode_envelope(payload):
+    # Split an envelope payload into its route and client frame
+    (length,) = ROUTE_LENGTH.unpack_from(payload)
+    route = json.loads(payload[ROUTE_LENGTH.size:ROUTE_LENGTH.size + length])
+    return route, payload[ROUTE_LENGTH.size + length:]
+
+
+class BusConnection:
+    # One Unix domain socket between a worker and the hub, with a reader thread and a queued writer thread
+
+    def __init__(self, sock, on_envelope, on_close):
+        self.sock = sock
+        self.on_envelope = on_envelope
+        self.on_close = on_close
+        self.queue = OutboundQueue(BUS_HIGH_WATER)
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def send(self, data):
+        # Queue an encoded envelope; bus traffic is never dropped
+        self.queue.put(data, bulk=True)
+
+    def read_loop(self):
+        # Decode envelopes and hand them to the owner
+        decoder = FrameDecoder()
+        try:
+            while decoder.recv_into(self.sock):
+                for frame_type, payload in decoder.frames():
+                    if frame_type != FRAME_BUS:
+                        raise ProtocolError(f"Unexpected frame type {frame_type} on the bus")
+                    route, frame = decode_envelope(payload)
+                    self.on_envelope(self, route, frame, payload)
+        except (OSError, ValueError, ProtocolError) as e:
+            if not self.queue.closed:
+                logger.error(f"Bus connection failed: {e}")
+        finally:
+            self.close()
+            self.on_close(self)
+
+    def write_loop(self):
+        # Drain queued envelopes onto the socket
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                self.sock.sendall(item)
+        except OSError as e:
+            if not self.queue.closed:
+                logger.error(f"Bus write failed: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        self.queue.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class BusHub:
+    # Relays envelopes between worker processes and owns the cluster-wide roster.
+    # Presence events are versioned here so every worker sees the same sequence.
+
+    def __init__(self, path):
+        self.path = path
+        self.workers = {}  # Maps bus connections to worker ids
+        self.worker_names = {}  # Maps bus connections to the user names that joined through them
+        self.roster = []
+        self.version = 0
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            os.remove(path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(path)
+        self.server_socket.listen(64)
+
+    def start(self):
+        # Accept worker connections in the background
+        threading.Thread(target=self.accept_workers, daemon=True).start()
+
+    def accept_workers(self):
+        try:
+            while True:
+                sock, _ = self.server_socket.accept()
+                BusConnection(sock, self.on_envelope, self.on_close)
+        except OSError as e:
+            logger.info(f"Bus hub stopped accepting workers: {e}")
+
+    def on_envelope(self, connection, route, frame, payload):
+        # Register workers, sequence presence events and relay everything else to the other workers
+        destination = route["to"]
+        if destination == "hello":
+            with self.lock:
+                self.workers[connection] = route["worker"]
+                self.worker_names[connection] = []
+                connection.send(encode_envelope({"to": "roster", "users": self.roster, "version": self.version}))
+        elif destination == "presence":
+            with self.lock:
+                self.apply_presence(connection, route)
+        else:
+            data = encode_frame(FRAME_BUS, payload)
+            for worker in list(self.workers):
+                if worker is not connection:
+                    worker.send(data)
+
+    def apply_presence(self, connection, route):
+        # Update the roster, assign the next version and send the delta to every worker, origin included
+        name = route["name"]
+        if route["op"] == "join":
+            self.roster.append(name)
+            self.worker_names[connection].append(name)
+        else:
+            if name in self.roster:
+                self.roster.remove(name)
+            if name in self.worker_names.get(connection, []):
+                self.worker_names[connection].remove(name)
+        self.version += 1
+        data = encode_envelope(dict(route, version=self.version, worker=self.workers.get(connection)))
+        for worker in list(self.workers):
+            worker.send(data)
+
+    def on_close(self, connection):
+        # A worker went away; everyone it served has left
+        with self.lock:
+            self.workers.pop(connection, None)
+            for name in list(self.worker_names.get(connection, [])):
+                self.apply_presence(connection, {"to": "presence", "op": "leave", "name": name})
+            self.worker_names.pop(connection, None)
+
+    def close(self):
+        self.server_socket.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class BusClient:
+    # A worker's connection to the hub
+
+    def __init__(self, path, worker_id, on_envelope, attempts=50):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The hub may still be starting
+        for attempt in range(attempts):
+            try:
+                sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.1)
+        self.on_envelope = on_envelope
+        self.connection = BusConnection(sock, self.receive, self.closed)
+        self.connection.send(encode_envelope({"to": "hello", "worker": worker_id}))
+
+    def receive(self, connection, route, frame, payload):
+        self.on_envelope(route, frame)
+
+    def closed(self, connection):
+        logger.error("Lost connection to the bus hub; only local clients will be reached")
+
+    def publish(self, route, frame=b""):
+        # Send a route and encoded client frame to the other workers
+        self.connection.send(encode_envelope(route, frame))
@@ -1,152 +1,752 @@
 import socket
-import json
+import bisect
+import collections
+import itertools
 import os
+import queue
 import threading
 import tkinter as tk
 import time
+import uuid
 from tkinter import scrolledtext, filedialog
 from datetime import datetime
-from glob import glob
-from pathlib import Path
 import tkinter.font as tkFont
+from Protocol import FrameDecoder, ProtocolError, encode_message, decode_message, encode_transfer_chunk, decode_stream_chunk, MESSAGE_FRAMES, FRAME_STREAM_CHUNK, CHUNK_SIZE, COMPRESSIONS, FrameCompressor, worth_compressing
+from Blobs import BlobStore, file_digest
+
+# Connection attempts made for one upload before giving up, seconds before the first retry (doubling
+# after each failure) and seconds to wait for the server's resume offset
+UPLOAD_ATTEMPTS = 5
+RETRY_DELAY = 0.5
+RESUME_TIMEOUT = 10
+# Milliseconds between GUI updates, and most queued updates applied in one go before Tk gets to handle input
+GUI_TICK_MS = 50
+GUI_BATCH = 2000
+# Lines kept in memory for scrolling back, lines the message display holds while following new messages,
+# and lines added at a time when scrolling up past the top
+SCROLLBACK_LINES = 10000
+VISIBLE_LINES = 500
+PAGE_LINES = 100
+# Seconds between checks of files/ for files saved there by others, such as a server run from the same directory
+FILE_POLL_INTERVAL = 2.0
+
+
+def display_segments(lines):
+    # Text and tags of scrollback lines, as the arguments of one Text.insert
+    return [part for text, tags, _, _ in lines for part in (text, tags)]
+
+
+def display_line(index):
+    # Line number of a Tk text index
+    return int(index.split(".")[0])
+
+
+def single_line(text):
+    # Text shown as one display line: scrollback entries and trimming count one Tk line per entry, so
+    # line breaks inside a message are shown as a symbol instead
+    return " \u23ce ".join(text.splitlines()) if "\n" in text or "\r" in text else text
+
 
 class ChatClient:
-    def __init__(self, host='127.0.0.1', port=8888):
+    def __init__(self, host='127.0.0.1', port=8888, scrollback=SCROLLBACK_LINES, visible_lines=VISIBLE_LINES,
+                 file_poll_interval=FILE_POLL_INTERVAL):
         # Initialize client with target server host and port
         self.host = host
         self.port = port
         # Socket for the client
         self.client_socket = None
+        # Frame decoder for everything received from the server
+        self.decoder = FrameDecoder()
         # User name of the client
         self.name = ""
+        # Connected users as shown in the user list, and the roster version they reflect
+        self.users = []
+        self.roster_version = None
+        self.roster_requested = False
+        # Rooms this client is subscribed to; text is sent to the current one
+        self.rooms = ["lobby"]
+        self.current_room = "lobby"
+        # Offset after the last message seen in each room, sent back to resume its history on resubscribe
+        self.history_cursors = {}
+        # Received files are stored once per distinct content; downloads of content already here are skipped
+        self.blobs = BlobStore("files")
+        # Uploads waiting for the server to say where to resume: transfer id -> [event, offset, refusal reason,
+        # seconds the server may keep the upload queued]
+        self.pending_uploads = {}
+        self.receive_thread = None
+        # Frames are sent from the GUI and from upload threads; the lock keeps each frame whole on the wire
+        # and one upload runs at a time, so chat goes out between the chunks of an upload
+        self.send_lock = threading.Lock()
+        self.upload_lock = threading.Lock()
+        # Compressor for frames sent to the server, once it has agreed to a method
+        self.compressor = None
+        # Files being received, which may be several at once: stream id -> [header, blob upload (None when
+        # skipped), bytes received, skipped, percentage last shown]. Chunks are written to a temporary file
+        # in the store as they arrive, so a download takes the same memory whatever its size.
+        self.downloads = {}
+        # Tk may only be used from the thread running the main loop. Other threads queue lines for the
+        # message display and widget updates here, and a timer applies them in batches.
+        self.gui_queue = queue.SimpleQueue()
+        # Scrollback: a ring of the newest lines as (text, tags, room, history offset). The message display shows
+        # a window of at most `visible_lines` of them, twice that while the user reads further up, so its size
+        # stays bounded however long the client runs. Scrolling to the top brings older lines back, from the
+        # ring while it has them and then a page at a time from the server's history. Only the GUI thread
+        # touches these.
+        self.visible_lines = visible_lines
+        self.scrollback = collections.deque(maxlen=max(scrollback, 2 * visible_lines))
+        self.scrollback_end = 0  # Lines ever added; the ring holds the last len(scrollback) of them
+        self.shown_from = 0  # Number of the first ring line in the display
+        self.paged = 0  # Lines from server history above it
+        self.page_room = None
+        self.page_before = None  # History offset of the oldest line paged in from the server
+        self.page_scheduled = False
+        # Oldest history offset of each room, once paging back has reached it
+        self.history_start = {}
+        # (room, offset) of the history page asked for, and the lines of it received so far
+        self.page_request = None
+        self.page_lines = []
+        # Files shown in the file list: the names listed and their sorted order, so new files are inserted
+        # in place rather than the list being rebuilt. None as the poll interval disables watching files/.
+        self.file_names = set()
+        self.file_rows = []
+        self.file_poll_interval = file_poll_interval
         self.setup_socket()
         self.create_gui()
+        self.window.after(GUI_TICK_MS, self.drain_gui_queue)
         self.start_receive_thread()
 
     def log_error(self, error_message):
         print(f"ERROR: {error_message}")
 
+    def show(self, text, tag=None, room=None, offset=None):
+        # Append a line to the message display; safe to call from any thread
+        self.gui_queue.put((None, (single_line(text) + "\n", tag or (), room, offset)))
+
+    def post(self, callback, *args):
+        # Run a widget update on the GUI thread; safe to call from any thread
+        self.gui_queue.put((callback, args))
+
+    def drain_gui_queue(self):
+        # Apply the updates queued since the last tick. Consecutive lines go into the message display
+        # with a single insert and one scroll, so a flood of messages costs one redraw per tick.
+        lines = []
+        for _ in range(GUI_BATCH):
+            try:
+                callback, args = self.gui_queue.get_nowait()
+            except queue.Empty:
+                break
+            if callback is None:
+                lines.append(args)
+                continue
+            self.add_lines(lines)
+            lines = []
+            try:
+                callback(*args)
+            except Exception as e:
+                self.log_error(f"Failed to update the window: {e}")
+        self.add_lines(lines)
+        # Come back at once while a backlog remains, letting Tk handle input in between
+        self.window.after(0 if not self.gui_queue.empty() else GUI_TICK_MS, self.drain_gui_queue)
+
+    def add_lines(self, lines):
+        # Add lines to the scrollback and the end of the message display. The display follows new lines
+        # while it is scrolled to the bottom; otherwise the user's view is kept where it is.
+        if not lines:
+            return
+        follow = self.message_display.yview()[1] >= 1.0
+        self.scrollback.extend(lines)
+        self.scrollback_end += len(lines)
+        self.message_display.insert("end", *display_segments(lines))
+        self.trim_display(follow)
+        if follow:
+            self.message_display.see("end")
+
+    def trim_display(self, follow):
+        # Delete the oldest lines of the display, server history pages first. While following new lines it keeps
+        # `visible_lines`. While the user reads further up, only lines a page or more above the view go, down to
+        # twice that, unless the ring no longer holds lines the display shows.
+        shown = self.scrollback_end - self.shown_from + self.paged
+        top = display_line(self.message_display.index("@0,0"))
+        if follow:
+            excess = shown - self.visible_lines
+        else:
+            excess = max(min(shown - 2 * self.visible_lines, top - 1 - PAGE_LINES), shown - self.scrollback.maxlen)
+        if excess <= 0:
+            return
+        self.message_display.delete("1.0", f"{excess + 1}.0")
+        paged = min(excess, self.paged)
+        self.paged -= paged
+        self.shown_from += excess - paged
+        if not self.paged:
+            self.page_room = self.page_before = None
+        if not follow:
+            self.message_display.yview(f"{max(1, top - excess)}.0")
+
+    def prepend_lines(self, lines):
+        # Insert older lines above the display, keeping the view on the line it showed
+        top = display_line(self.message_display.index("@0,0"))
+        self.message_display.insert("1.0", *display_segments(lines))
+        self.message_display.yview(f"{top + len(lines)}.0")
+
+    def on_scroll(self, first, last):
+        # The display's scroll command: move the scrollbar, and page older lines in once the top is reached
+        self.message_display.vbar.set(first, last)
+        if float(first) <= 0.0 and float(last) < 1.0 and not self.page_scheduled:
+            self.page_scheduled = True
+            self.window.after_idle(self.page_in)
+
+    def page_in(self):
+        # Show older lines above the display: from the ring while it has lines older than those shown,
+        # then from the server's history of the current room
+        self.page_scheduled = False
+        if self.message_display.yview()[0] > 0.0:
+            return
+        first = self.scrollback_end - len(self.scrollback)
+        if not self.paged and self.shown_from > first:
+            start = max(first, self.shown_from - PAGE_LINES)
+            lines = list(itertools.islice(self.scrollback, start - first, self.shown_from - first))
+            self.shown_from = start
+            self.prepend_lines(lines)
+        elif self.page_request is None:
+            self.request_history_page()
+
+    def request_history_page(self):
+        # Ask for the messages of the current room preceding the oldest one displayed
+        room = self.current_room
+        if self.paged and self.page_room == room:
+            before = self.page_before
+        else:
+            before = next((offset for _, _, line_room, offset in self.scrollback
+                           if line_room == room and offset is not None), self.history_cursors.get(room))
+        if before is None or before <= self.history_start.get(room, 0):
+            return  # No history on the server, or none older
+        self.page_request = (room, before)
+        self.send(encode_message({"type": "history_request", "room": room, "before": before, "history": PAGE_LINES}))
+
+    def show_history_page(self, room, lines, cursor, count):
+        # Put a page of server history above the display
+        self.page_request = None
+        if count < PAGE_LINES:
+            self.history_start[room] = cursor
+        if lines:
+            self.page_room = room
+            self.page_before = cursor
+            self.paged += len(lines)
+            self.prepend_lines(lines)
+
     def setup_socket(self):
         # Establish connection to the server
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((self.host, self.port))
+            # Messages are small and sent one at a time; do not hold them back waiting for ACKs
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         except Exception as e:
             self.log_error(f"Failed to connect to server: {e}")
             exit(1)
 
+    def send(self, frame, compress=True):
+        # Write one frame to the server, compressed if negotiated and worthwhile
+        compressor = self.compressor if compress else None
+        if compressor is not None:
+            frame = compressor.compress(frame)
+        with self.send_lock:
+            self.client_socket.sendall(frame)
+
+    def join_message(self):
+        # The join message is the handshake: it names the user and offers the compression methods
+        # available here, most preferred first; the server answers with "capabilities"
+        return {"type": "join", "name": self.name, "compression": list(COMPRESSIONS)}
+
+    def text_line(self, message):
+        # Display line of a text message; messages from rooms other than the current one are labelled with their room
+        room = message.get("room", "lobby")
+        prefix = "" if room == self.current_room else f"#{room} "
+        return (f"[{message['timestamp']}] {prefix}{message['name']}: {single_line(message['text'])}\n", (), room,
+                message.get("offset"))
+
+    def reconnect(self):
+        # Replace a failed connection: rejoin under the same name and resubscribe to every room,
+        # resuming each room's history from the last message seen
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+            self.client_socket.close()
+        except OSError:
+            pass
+        if self.receive_thread is not None:
+            self.receive_thread.join(5)
+        for attempt in range(UPLOAD_ATTEMPTS):
+            try:
+                client_socket = socket.create_connection((self.host, self.port), timeout=RESUME_TIMEOUT)
+                break
+            except OSError as e:
+                if attempt == UPLOAD_ATTEMPTS - 1:
+                    raise
+                self.log_error(f"Reconnect failed: {e}")
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+        client_socket.settimeout(None)
+        self.client_socket = client_socket
+        self.decoder = FrameDecoder()
+        # Files that were arriving on the old connection will not continue
+        for download in self.downloads.values():
+            if download[1] is not None:
+                download[1].abort()
+        self.downloads.clear()
+        self.post(self.show_progress, "")
+        self.compressor = None
+        self.page_request = None
+        self.page_lines = []
+        # The new connection's roster versions start over (a restarted server counts from scratch),
+        # so wait for its snapshot instead of comparing them with the old connection's
+        self.users = []
+        self.roster_version = None
+        self.roster_requested = False
+        join = self.join_message()
+        if "lobby" in self.history_cursors:
+            join["since"] = self.history_cursors["lobby"]
+        self.send(encode_message(join))
+        for room in self.rooms:
+            if room != "lobby":
+                self.send(encode_message(self.subscribe_message(room)))
+        self.start_receive_thread()
+
     def send_file(self, file_path):
         try:
-            # Send a file to the server
+            # Send a file to the server as a resumable transfer
             with open(file_path, "rb") as file:
-                file_data = file.read()
+                head = file.read(16)
             header = {
                 "type": "file",
                 "filename": os.path.basename(file_path),
-                "length": len(file_data),
-                "timestamp": datetime.now().strftime("%H:%M:%S")
+                "length": os.path.getsize(file_path),
+                "timestamp": datetime.now().strftime("%H:%M:%S"),
+                "room": self.current_room,
+                # Lets the server and recipients recognise content they already have
+                "sha256": file_digest(file_path),
+                # Names the upload so it can be continued on a new connection
+                "transfer": uuid.uuid4().hex,
+                # Content that is already compressed is sent, and relayed, as it is
+                "compress": worth_compressing(os.path.basename(file_path), head)
             }
-            self.client_socket.send(json.dumps(header).encode())
-            self.client_socket.sendall(file_data)
-            self.message_display.insert("end", f"[{header['timestamp']}] You: sending file: {header['filename']}\n", "sender")
-            time.sleep(1)  # Wait to ensure file is sent before refreshing the file list
-            self.refresh_file_list()
+            for attempt in range(UPLOAD_ATTEMPTS):
+                try:
+                    with self.upload_lock:
+                        self.upload_file(file_path, header)
+                    break
+                except OSError as e:
+                    if attempt == UPLOAD_ATTEMPTS - 1:
+                        raise
+                    self.log_error(f"Upload of {header['filename']} interrupted ({e}), resuming")
+                    # Give the server time to notice the old connection is gone and keep what it received
+                    time.sleep(RETRY_DELAY * 2 ** attempt)
+                    self.reconnect()
+            self.show(f"[{header['timestamp']}] You: sending file: {header['filename']}", "sender")
         except Exception as e:
             self.log_error(f"Failed to send file {file_path}: {e}")
 
-    def receive_file(self, message, data_length):
+    def upload_file(self, file_path, header):
+        # Announce an upload, wait for the offset the server already has and send the rest in
+        # chunks carrying their offset and CRC-32
+        waiter = self.pending_uploads[header["transfer"]] = [threading.Event(), None, None, None]
         try:
-            # Receive a file from the server
-            self.message_display.insert("end", f"[{message['timestamp']}] {message['name']}: sending file: {message['filename']}\n")
-            self.message_display.see("end")
-            self.window.update()
-            data = b''
-            while len(data) < data_length:
-                packet = self.client_socket.recv(1024)
-                if not packet:
-                    break
-                data += packet
-            return data
+            self.send(encode_message(header))
+            timeout = RESUME_TIMEOUT
+            while not waiter[0].wait(timeout):
+                if waiter[3] is None:
+                    raise ConnectionError("The server did not accept the upload")
+                # Queued behind other uploads; the server answers within the time it gave
+                timeout, waiter[3] = waiter[3] + RESUME_TIMEOUT, None
+            if waiter[2] is not None:
+                # Refused, not interrupted: retrying on a new connection would not help
+                raise ValueError(f"Upload refused: {waiter[2]}")
+            if waiter[1] is None:
+                raise ConnectionError("The server did not accept the upload")
+            offset = waiter[1]
+            with open(file_path, "rb") as file:
+                file.seek(offset)
+                while chunk := file.read(CHUNK_SIZE):
+                    self.send(encode_transfer_chunk(offset, chunk), header["compress"])
+                    offset += len(chunk)
+        finally:
+            del self.pending_uploads[header["transfer"]]
+
+    def start_download(self, message):
+        # A file is announced; its chunks arrive as a stream interleaved with chat and other files.
+        # Content that is already stored is skipped: the server is asked to stop sending it and
+        # chunks already on their way are discarded until it confirms.
+        self.show(f"[{message['timestamp']}] {message['name']}: sending file: {message['filename']}")
+        skip = self.blobs.has(message.get("sha256"))
+        if skip:
+            self.send(encode_message({"type": "file_skip", "sha256": message["sha256"]}))
+            upload = None
+        else:
+            try:
+                upload = self.blobs.begin(message.get("sha256"))
+            except (OSError, ValueError) as e:
+                # Its chunks are ignored as those of an unknown stream
+                self.log_error(f"Failed to start receiving {message['filename']}: {e}")
+                return
+        self.downloads[message["stream"]] = [message, upload, 0, skip, None]
+        if message["length"] == 0:
+            self.finish_download(message["stream"])
+
+    def receive_chunk(self, payload):
+        # Add a chunk to the download it belongs to
+        stream = None
+        try:
+            stream, offset, data = decode_stream_chunk(payload)
+            download = self.downloads.get(stream)
+            if download is None:
+                return  # Aborted or unknown transfer
+            if offset != download[2]:
+                raise ProtocolError(f"File chunk at offset {offset}, expected {download[2]}")
+            if download[1] is not None:
+                download[1].write(data)
+            download[2] += len(data)
+            if download[2] >= download[0]["length"]:
+                self.finish_download(stream)
+            elif not download[3]:
+                percent = download[2] * 100 // download[0]["length"]
+                if percent != download[4]:
+                    download[4] = percent
+                    self.post(self.show_progress, self.download_progress())
         except Exception as e:
             self.log_error(f"Failed to recieve file: {e}")
-
-    def save_file(self, client_name, file_data, filename):
+            self.drop_download(stream)
+
+    def download_progress(self):
+        # Progress of the downloads being received, as shown under the file list
+        return ", ".join(f"Receiving {message['filename']}: {percent}%"
+                         for message, _, _, skip, percent in self.downloads.values() if not skip and percent is not None)
+
+    def show_progress(self, text):
+        self.transfer_status.config(text=text)
+
+    def drop_download(self, stream):
+        # Forget a download, deleting what was written of it
+        download = self.downloads.pop(stream, None)
+        if download is not None and download[1] is not None:
+            download[1].abort()
+        self.post(self.show_progress, self.download_progress())
+
+    def finish_download(self, stream):
+        # Store a completed (or skipped) download under its name. Committing moves the temporary file into
+        # the store with a rename once its content matches the digest announced.
+        message, upload, _, skip, _ = self.downloads.pop(stream)
+        self.post(self.show_progress, self.download_progress())
         try:
-            # Save the received file locally
-            file_path = f'files/{client_name}_{datetime.now().strftime("%Y%m%d%H%M%S")}_{filename}'
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, 'wb') as file:
-                file.write(file_data)
+            digest = message.get("sha256") if upload is None else upload.commit()
+        except (OSError, ValueError) as e:
+            self.log_error(f"Failed to save file {message['filename']}: {e}")
+            return
+        if digest is not None:
+            self.save_file(self.name, message['filename'], digest)
+
+    def end_download(self, message):
+        # The server stopped sending a file: aborted by its sender, or skipped because we have it
+        if message.get("stream") not in self.downloads:
+            return
+        if message["type"] == "file_skipped":
+            self.finish_download(message["stream"])
+        else:
+            self.drop_download(message["stream"])
+            self.show(f"File transfer of {message['filename']} was aborted", "system")
+
+    def save_file(self, client_name, filename, digest):
+        try:
+            # Save a received file, already in the content store, locally as a name for its content
+            file_path = f'files/{client_name}_{datetime.now().strftime("%Y%m%d%H%M%S")}_{os.path.basename(filename)}'
+            self.blobs.link(digest, file_path, sender=client_name)
             print(f"File received and saved to {file_path}")
-            self.refresh_file_list()  # Refresh the file list to include the new file 
+            self.post(self.add_files, [os.path.basename(file_path)])  # List the new file
         except Exception as e:
             self.log_error(f"Failed to save file {filename}: {e}")
 
 
-    def refresh_file_list(self):
+    def add_files(self, names):
         try:
-            # Refresh the list of files shown in the GUI
-            self.file_list.delete(0, tk.END)  # Clear current list
-            for f in sorted(Path('files/').glob("*"+self.name+"*")):
-                self.file_list.insert(tk.END, f)  # Add files to the list
-            self.file_list.bind("<<ListboxSelect>>", self.open_file)
-            self.window.geometry("600x800")  # Adjust window size if needed
+            # Insert rows for files not listed yet at their sorted position
+            names = sorted(set(names) - self.file_names)
+            if not names:
+                return
+            self.file_names.update(names)
+            if not self.file_rows or names[0] > self.file_rows[-1]:
+                # All after the last row, as with the first listing: one insert
+                self.file_rows.extend(names)
+                self.file_list.insert(tk.END, *(os.path.join("files", name) for name in names))
+                return
+            for name in names:
+                index = bisect.bisect(self.file_rows, name)
+                self.file_rows.insert(index, name)
+                self.file_list.insert(index, os.path.join("files", name))
         except Exception as e:
-            self.log_error(f"Failed to refresh file list: {e}")
-
-    def refresh_user_list(self, users):
+            self.log_error(f"Failed to update file list: {e}")
+
+    def scan_files(self):
+        # Names of this user's files in files/ that are not listed yet; the content store is skipped
+        with os.scandir("files") as entries:
+            return [entry.name for entry in entries
+                    if self.name in entry.name and not entry.name.startswith(".") and entry.name not in self.file_names
+                    and entry.is_file()]
+
+    def watch_files(self):
+        # List the files present when the file list is created, then poll files/ for new ones. The directory
+        # is only read again when its modification time changes. Runs in its own thread.
+        seen = None
+        while True:
+            try:
+                modified = os.stat("files").st_mtime_ns
+                if modified != seen:
+                    seen = modified
+                    names = self.scan_files()
+                    if names:
+                        self.post(self.add_files, names)
+            except OSError as e:
+                self.log_error(f"Failed to read the files directory: {e}")
+            if self.file_poll_interval is None:
+                return
+            time.sleep(self.file_poll_interval)
+
+    def refresh_user_list(self, users, version):
         try:
-            # Updates the GUI component with the current list of users
-            self.user_list_box.delete(0, tk.END)  # Clear the current list
-            for user in users:
-                self.user_list_box.insert(tk.END, user)
+            # Replace the user list with a full snapshot from the server
+            if self.roster_version is not None and version < self.roster_version:
+                return  # Older than the deltas already applied
+            self.users = list(users)
+            self.roster_version = version
+            self.roster_requested = False
+            self.post(self.show_users, list(users))
         except Exception as e:
             self.log_error(f"Failed to refresh user list: {e}")
 
+    def show_users(self, users):
+        # Replace the contents of the user list widget
+        self.user_list_box.delete(0, tk.END)
+        self.user_list_box.insert(tk.END, *users)
+
+    def apply_presence(self, message):
+        try:
+            # Apply a single join/leave delta to the user list without rebuilding it
+            version = message["version"]
+            if self.roster_version is None or version <= self.roster_version:
+                return  # No snapshot yet, or already reflected in it
+            if version != self.roster_version + 1:
+                # A delta was missed; ask for a fresh snapshot once
+                if not self.roster_requested:
+                    self.roster_requested = True
+                    self.send(encode_message({"type": "roster_request"}))
+                return
+            self.roster_version = version
+            if message["op"] == "join":
+                self.users.append(message["name"])
+                self.post(self.user_list_box.insert, tk.END, message["name"])
+            elif message["op"] == "leave" and message["name"] in self.users:
+                index = self.users.index(message["name"])
+                del self.users[index]
+                self.post(self.user_list_box.delete, index)
+        except Exception as e:
+            self.log_error(f"Failed to update user list: {e}")
+
     def send_message(self):
         try:
             # Send a text message to the server
             message_text = self.message_entry.get()
             if message_text:
-                message = {"text": message_text, "type": "text"}
-                self.client_socket.send(json.dumps(message).encode())
                 timestamp = datetime.now().strftime("%H:%M:%S")
-                self.message_display.insert("end", f"[{timestamp}] You: {message_text}\n", "sender")
-                self.message_display.see("end")
+                if message_text.startswith("/"):
+                    self.run_command(message_text)
+                else:
+                    message = {"text": message_text, "type": "text", "room": self.current_room}
+                    self.send(encode_message(message))
+                    self.show(f"[{timestamp}] You: {message_text}", "sender")
                 self.message_entry.delete(0, "end")
-                self.window.update()
         except Exception as e:
             self.log_error(f"Failed to send message: {e}")
 
+    def run_command(self, command_text):
+        # Handle /join <room>, /leave [room], /msg <user> <text>, /search <words> and /profile typed into the message entry
+        command, _, argument = command_text[1:].partition(" ")
+        argument = argument.strip()
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        if command == "join" and argument:
+            self.join_room(argument)
+        elif command == "leave":
+            self.leave_room(argument or self.current_room)
+        elif command == "msg" and " " in argument:
+            recipient, text = argument.split(" ", 1)
+            self.send(encode_message({"type": "direct", "to": recipient, "text": text}))
+            self.show(f"[{timestamp}] You -> {recipient}: {text}", "direct")
+        elif command == "search" and argument:
+            self.search(argument)
+        elif command == "profile" and len(argument.split()) >= 2:
+            # Operator command: /profile <token> start [sample|cprofile] [seconds], or /profile <token> stop
+            token, action, *options = argument.split()
+            request = {"type": "admin", "token": token, "command": f"profile_{action}"}
+            if options:
+                request["mode"] = options[0]
+            if len(options) > 1:
+                request["duration"] = options[1]
+            self.send(encode_message(request))
+        else:
+            self.show("Commands: /join <room>, /leave [room], /msg <user> <text>, "
+                      "/search [from:<user>] [in:<room>] <words>", "system")
+
+    def search(self, text):
+        # Ask the server to search the history; from:<user> and in:<room> narrow the results
+        request = {"type": "search", "query": ""}
+        words = []
+        for word in text.split():
+            if word.startswith("from:") and len(word) > 5:
+                request["name"] = word[5:]
+            elif word.startswith("in:") and len(word) > 3:
+                request["room"] = word[3:].lstrip("#")
+            else:
+                words.append(word)
+        request["query"] = " ".join(words)
+        self.send(encode_message(request))
+
+    def show_search_results(self, message):
+        # List search results, newest first, in the message display
+        results = message["results"]
+        self.show(f"{len(results)} results for \"{message['query']}\"", "system")
+        for result in results:
+            sent = datetime.fromtimestamp(result["time"]).strftime("%Y-%m-%d %H:%M:%S")
+            if result["kind"] == "file":
+                line = f"[{sent}] #{result['room']} {result['name']} sent file: {result['filename']}"
+            else:
+                line = f"[{sent}] #{result['room']} {result['name']}: {result['text']}"
+            self.show(line, "search")
+
+    def join_room(self, room):
+        # Subscribe to a room (if needed) and make it the current one
+        if room not in self.rooms:
+            self.send(encode_message(self.subscribe_message(room)))
+            self.rooms.append(room)
+            self.room_list_box.insert(tk.END, room)
+        self.switch_room(room)
+
+    def subscribe_message(self, room):
+        # Subscription request that resumes the room's history after the last message seen
+        subscribe = {"type": "subscribe", "room": room}
+        if room in self.history_cursors:
+            subscribe["since"] = self.history_cursors[room]
+        return subscribe
+
+    def leave_room(self, room):
+        # Unsubscribe from a room; the lobby cannot be left
+        if room == "lobby" or room not in self.rooms:
+            return
+        self.send(encode_message({"type": "unsubscribe", "room": room}))
+        index = self.rooms.index(room)
+        del self.rooms[index]
+        self.room_list_box.delete(index)
+        if room == self.current_room:
+            self.switch_room("lobby")
+
+    def switch_room(self, room):
+        # Make a subscribed room the target of outgoing messages
+        self.current_room = room
+        self.room_list_box.selection_clear(0, tk.END)
+        self.room_list_box.selection_set(self.rooms.index(room))
+        self.show(f"Now chatting in #{room}", "system")
+
+    def select_room(self, event):
+        # Switch rooms when one is selected in the room list
+        selection = self.room_list_box.curselection()
+        if selection and self.rooms[selection[0]] != self.current_room:
+            self.switch_room(self.rooms[selection[0]])
+
+    def read_frame(self):
+        # Block until a complete frame has been received; None means the server closed the connection
+        frame = self.decoder.next_frame()
+        while frame is None:
+            if not self.decoder.recv_into(self.client_socket):
+                return None
+            frame = self.decoder.next_frame()
+        return frame
+
     def receive_messages(self):
         try:
             # Receive messages from the server
             while True:
-                data = self.client_socket.recv(1024)
-                if not data:
+                frame = self.read_frame()
+                if frame is None:
                     break
-                message = json.loads(data.decode())
-                message_type = message["type"]
-                if message_type == "text":
-                    self.message_display.insert("end", f"[{message['timestamp']}] {message['name']}: {message['text']}\n")
-                    self.message_display.see("end")
-                    self.window.update()
-                elif message_type == "file":
-                    file_data = self.receive_file(message, message["length"])
-                    self.save_file(self.name, file_data, message['filename'])
-                elif message_type == "system":
-                    self.message_display.insert("end", f"[{message['timestamp']}] {message['text']}\n", "system")
-                elif message_type == "user_list":
-                    self.refresh_user_list(message["users"])
+                frame_type, payload = frame
+                if frame_type == FRAME_STREAM_CHUNK:
+                    self.receive_chunk(payload)
+                    continue
+                if frame_type not in MESSAGE_FRAMES:
+                    continue
+                self.handle_message(decode_message(payload, frame_type))
         except Exception as e:
             self.log_error(f"Failed to recieve message: {e}")
+        # Wake uploads waiting for an answer that will not come on this connection
+        for waiter in list(self.pending_uploads.values()):
+            waiter[0].set()
+
+    def handle_message(self, message):
+        # Dispatch a message from the server based on its type
+        message_type = message["type"]
+        if message_type == "text":
+            room = message.get("room", "lobby")
+            request = self.page_request
+            if request is not None and room == request[0] and message.get("offset", request[1]) < request[1]:
+                # Part of a history page asked for while scrolling back
+                self.page_lines.append(self.text_line(message))
+                return
+            if "offset" in message:
+                self.history_cursors[room] = message["offset"] + 1
+            self.gui_queue.put((None, self.text_line(message)))
+        elif message_type == "direct":
+            self.show(f"[{message['timestamp']}] {message['name']} -> You: {message['text']}", "direct")
+        elif message_type == "file":
+            self.start_download(message)
+        elif message_type in ("file_abort", "file_skipped"):
+            self.end_download(message)
+        elif message_type == "system":
+            self.show(f"[{message['timestamp']}] {message['text']}", "system")
+        elif message_type == "user_list":
+            self.refresh_user_list(message["users"], message["version"])
+        elif message_type == "presence":
+            self.apply_presence(message)
+        elif message_type == "capabilities":
+            compression = message.get("compression")
+            if compression in COMPRESSIONS:
+                self.compressor = FrameCompressor(COMPRESSIONS[compression], message["compress_threshold"])
+        elif message_type == "file_resume":
+            waiter = self.pending_uploads.get(message["transfer"])
+            if waiter is not None:
+                waiter[1] = message["offset"]
+                waiter[0].set()
+        elif message_type == "file_queued":
+            waiter = self.pending_uploads.get(message["transfer"])
+            if waiter is not None:
+                waiter[3] = message["timeout"]
+        elif message_type == "file_refused":
+            waiter = self.pending_uploads.get(message["transfer"])
+            if waiter is not None:
+                waiter[2] = message.get("reason", "refused by the server")
+                waiter[0].set()
+        elif message_type == "search_results":
+            self.show_search_results(message)
+        elif message_type == "history" and "before" in message:
+            # Marks the end of a page of older messages
+            lines, self.page_lines = self.page_lines, []
+            self.post(self.show_history_page, message["room"], lines, message["cursor"], message["count"])
+        elif message_type == "history":
+            # Marks the end of the messages replayed when subscribing to a room
+            self.history_cursors[message["room"]] = message["cursor"]
+            if message["count"]:
+                self.show(f"Loaded {message['count']} earlier messages in #{message['room']}", "system")
 
     def choose_file(self):
         try:
             # Open a dialog to choose a file to send
             file_path = filedialog.askopenfilename()
             if file_path:
-                self.send_file(file_path)
+                # Uploads run in the background so chat can be sent meanwhile
+                threading.Thread(target=self.send_file, args=(file_path,), daemon=True).start()
         except Exception as e:
             self.log_error(f"Failed to choose file: {e}")
 
@@ -156,12 +756,10 @@ class ChatClient:
         self.name = self.name_entry.get()
         self.name_entry.config(state="disabled")
         self.name_button.pack_forget()
-        self.client_socket.send(self.name.encode())
+        self.send(encode_message(self.join_message()))
         timestamp = datetime.now().strftime("%H:%M:%S")
-        self.message_display.insert("end", f"[{timestamp}] Welcome to the chat {self.name}\n", "system")
-        self.message_display.see("end")
+        self.show(f"[{timestamp}] Welcome to the chat {self.name}", "system")
         self.create_file_widgets()
-        self.window.update()
 
     def create_gui(self):
         # Create the GUI for the chat client
@@ -175,6 +773,7 @@ class ChatClient:
             self.create_name_widgets()
             self.create_message_widgets()
             self.create_user_list_widgets()
+            self.create_room_widgets()
         except tk.TclError as e:
             self.log_error(f"Modern theme not available, using default. {e}")
         except Exception as e:
@@ -191,6 +790,32 @@ class ChatClient:
         except Exception as e:
             self.log_error(f"Failed to create Graphical User Interface - User list widgets: {e}")
 
+    def create_room_widgets(self):
+        try:
+            # Creates GUI components for listing and switching between rooms
+            room_frame = tk.Frame(self.window)
+            room_frame.pack(padx=10, pady=5, fill=tk.X, side=tk.RIGHT)
+            tk.Label(room_frame, text="Rooms").pack()
+            self.room_list_box = tk.Listbox(room_frame, exportselection=False)
+            self.room_list_box.pack(fill=tk.BOTH, expand=True)
+            for room in self.rooms:
+                self.room_list_box.insert(tk.END, room)
+            self.room_list_box.selection_set(0)
+            self.room_list_box.bind("<<ListboxSelect>>", self.select_room)
+
+            self.room_entry = tk.Entry(room_frame)
+            self.room_entry.pack(fill=tk.X, pady=(5, 0))
+            tk.Button(room_frame, text="Join Room", command=self.join_room_from_entry).pack(fill=tk.X)
+        except Exception as e:
+            self.log_error(f"Failed to create Graphical User Interface - room widgets: {e}")
+
+    def join_room_from_entry(self):
+        # Join the room typed into the room entry
+        room = self.room_entry.get().strip()
+        if room:
+            self.join_room(room)
+            self.room_entry.delete(0, "end")
+
     def create_message_widgets(self):
         try:
             # Create widgets for message display and sending
@@ -206,6 +831,9 @@ class ChatClient:
             self.message_display.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
             self.message_display.tag_config('sender', foreground="#61d461")
             self.message_display.tag_config('system', foreground="#ffd633")
+            self.message_display.tag_config('direct', foreground="#d68aff")
+            self.message_display.tag_config('search', foreground="#7ab8ff")
+            self.message_display.configure(yscrollcommand=self.on_scroll)
 
             entry_frame = tk.Frame(message_frame)
             entry_frame.pack(fill=tk.X, padx=10, pady=5)
@@ -252,8 +880,13 @@ class ChatClient:
 
             self.file_list = tk.Listbox(file_frame, font=font)
             self.file_list.pack(expand=True, fill=tk.BOTH)
+            self.file_list.bind("<<ListboxSelect>>", self.open_file)
+            self.transfer_status = tk.Label(file_frame, font=font, anchor="w")
+            self.transfer_status.pack(fill=tk.X)
+            self.window.geometry("600x800")  # Adjust window size if needed
 
-            self.refresh_file_list()  # Populate the file list
+            # Populated, and kept up to date, from a background thread
+            threading.Thread(target=self.watch_files, daemon=True).start()
         except Exception as e:
             self.log_error(f"Failed to create Graphical User Interface - file widgets: {e}")
     
@@ -273,7 +906,8 @@ class ChatClient:
     def start_receive_thread(self):
         try:
         # Start a thread to receive messages from the server
-            threading.Thread(target=self.receive_messages, daemon=True).start()
+            self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
+            self.receive_thread.start()
         except Exception as e:
             self.log_error(f"Failed to open thread for message reciept: {e}")
 
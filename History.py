@@ -0,0 +1,327 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+from Protocol import FRAME_HEADER, HEADER_SIZE
+
+# Each room's history is a directory of segments. A segment is a log file of encoded message frames
+# appended back to back, and an index file holding the log position of every frame as an 8 byte integer,
+# so the position of message `offset` is entry `offset - base` of the segment whose base precedes it.
+INDEX_ENTRY = struct.Struct("!Q")
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+# Log bytes after which a segment is sealed and a new one started
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+# Largest number of messages replayed to a client at once
+MAX_BACKFILL = 1000
+# Rooms whose files are kept open; the files of the least recently used room beyond these are closed
+MAX_OPEN_LOGS = 256
+# Longest directory name a room is stored under as is; longer ones are cut short and end in a digest,
+# well within the 255 bytes file systems allow
+MAX_DIRECTORY_NAME = 200
+
+# Durability policies for appended messages
+FSYNC_ALWAYS = "always"  # fsync in the background as soon as a message is recorded
+FSYNC_BATCH = "batch"    # fsync in the background every interval, or sooner once a batch of messages is pending
+FSYNC_NEVER = "never"    # leave writeback to the operating system
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_NEVER)
+
+
+def room_directory(room):
+    # Directory name of a room: separators and dots ("." and "..") are escaped, and an escaped name that
+    # is too long keeps a prefix followed by "%%" (which escaping never produces) and a digest of the name
+    name = quote(room, safe="").replace(".", "%2E") or "%00"
+    if len(name) > MAX_DIRECTORY_NAME:
+        digest = hashlib.sha256(room.encode()).hexdigest()
+        name = f"{name[:MAX_DIRECTORY_NAME - len(digest) - 2]}%%{digest}"
+    return name
+
+
+class Segment:
+    # One log file and its offset index. Reads go through read-only memory maps that are
+    # re-created when the active segment has grown past what was mapped.
+
+    def __init__(self, directory, base):
+        self.base = base
+        name = os.path.join(directory, f"{base:020d}")
+        self.log_path = name + LOG_SUFFIX
+        self.index_path = name + INDEX_SUFFIX
+        self.log_fd = None
+        self.index_fd = None
+        self.size = 0
+        self.count = 0
+        self.log_map = None
+        self.index_map = None
+
+    def open_for_append(self):
+        self.log_fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def load(self):
+        # Sizes of a sealed segment as found on disk
+        self.size = os.path.getsize(self.log_path)
+        self.count = os.path.getsize(self.index_path) // INDEX_ENTRY.size
+
+    def recover(self):
+        # Drop a torn tail left by a crash: partial index entries, entries whose frame was not
+        # completely written, and log bytes that no index entry points at
+        self.load()
+        with open(self.log_path, 'rb') as log:
+            while self.count:
+                with open(self.index_path, 'rb') as index:
+                    index.seek((self.count - 1) * INDEX_ENTRY.size)
+                    (position,) = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))
+                log.seek(position)
+                header = log.read(HEADER_SIZE)
+                if len(header) == HEADER_SIZE:
+                    length, _ = FRAME_HEADER.unpack(header)
+                    if position + HEADER_SIZE + length <= self.size:
+                        self.size = position + HEADER_SIZE + length
+                        break
+                self.count -= 1
+            else:
+                self.size = 0
+        os.truncate(self.index_path, self.count * INDEX_ENTRY.size)
+        os.truncate(self.log_path, self.size)
+
+    def append(self, frame):
+        # Write the frame before its index entry so an indexed frame is always complete
+        os.write(self.log_fd, frame)
+        os.write(self.index_fd, INDEX_ENTRY.pack(self.size))
+        self.size += len(frame)
+        self.count += 1
+
+    def sync(self):
+        if self.log_fd is not None:
+            os.fsync(self.log_fd)
+            os.fsync(self.index_fd)
+
+    def mapped(self, current, path, size):
+        # Map a file read-only, replacing a mapping that no longer covers `size` bytes
+        if current is not None and len(current) >= size:
+            return current
+        if current is not None:
+            current.close()
+        with open(path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, start, end):
+        # Frames `start` to `end` (segment-relative) as one contiguous run of encoded bytes
+        if start >= end:
+            return b""
+        # The entry after `end` marks where its last frame stops
+        self.index_map = self.mapped(self.index_map, self.index_path, min(end + 1, self.count) * INDEX_ENTRY.size)
+        self.log_map = self.mapped(self.log_map, self.log_path, self.size)
+        (first,) = INDEX_ENTRY.unpack_from(self.index_map, start * INDEX_ENTRY.size)
+        if end < self.count:
+            (last,) = INDEX_ENTRY.unpack_from(self.index_map, end * INDEX_ENTRY.size)
+        else:
+            last = self.size
+        return self.log_map[first:last]
+
+    def close(self):
+        for current in (self.log_map, self.index_map):
+            if current is not None:
+                current.close()
+        self.log_map = self.index_map = None
+        for fd in (self.log_fd, self.index_fd):
+            if fd is not None:
+                os.close(fd)
+        self.log_fd = self.index_fd = None
+
+
+class HistoryLog:
+    # Append-only history of one room. Offsets number the room's messages from 0 and never change;
+    # clients hold on to the offset after the last message they saw and ask for everything since.
+    # The room's directory is created with its first message, and its files are only open while in use.
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, fsync=FSYNC_BATCH):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        # Held across recording a message and queueing it to subscribers, and across replaying
+        # history and subscribing, so a new subscriber sees every message exactly once
+        self.lock = threading.RLock()
+        self.pending = 0
+        names = os.listdir(directory) if os.path.isdir(directory) else []
+        bases = sorted(int(name[:-len(LOG_SUFFIX)]) for name in names if name.endswith(LOG_SUFFIX))
+        self.segments = [Segment(directory, base) for base in bases]
+        for segment in self.segments[:-1]:
+            segment.load()
+        if self.segments:
+            self.segments[-1].recover()
+        else:
+            self.segments.append(Segment(directory, 0))
+
+    @property
+    def first_offset(self):
+        return self.segments[0].base
+
+    @property
+    def next_offset(self):
+        active = self.segments[-1]
+        return active.base + active.count
+
+    def record(self, message, encode):
+        # Stamp a message with its offset, encode it once and append the frame; returns the frame
+        with self.lock:
+            message["offset"] = self.next_offset
+            frame = encode(message)
+            active = self.segments[-1]
+            if active.log_fd is None:
+                os.makedirs(self.directory, exist_ok=True)
+                active.open_for_append()
+            active.append(frame)
+            self.pending += 1
+            if active.size >= self.segment_size:
+                self.roll()
+            return frame
+
+    def roll(self):
+        # Seal the active segment and start a new one at the next offset, created by its first append
+        active = self.segments[-1]
+        if self.fsync != FSYNC_NEVER:
+            active.sync()
+            self.pending = 0
+        os.close(active.log_fd)
+        os.close(active.index_fd)
+        active.log_fd = active.index_fd = None
+        self.segments.append(Segment(self.directory, self.next_offset))
+
+    def sync(self):
+        # Flush appended messages to stable storage. Recording and subscribing hold the lock, so only
+        # the files are picked under it; their descriptors are duplicated, since the segment may be
+        # sealed or closed meanwhile, and flushed once it is released.
+        with self.lock:
+            active = self.segments[-1]
+            if not self.pending or active.log_fd is None:
+                return
+            fds = (os.dup(active.log_fd), os.dup(active.index_fd))
+            self.pending = 0
+        try:
+            for fd in fds:
+                os.fsync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def segment_index(self, offset):
+        # Binary search for the segment holding an offset
+        low, high = 0, len(self.segments) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.segments[middle].base <= offset:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def backfill(self, last=None, since=None, before=None, limit=MAX_BACKFILL):
+        # Encoded frames of the `last` most recent messages, or of every message from offset `since`,
+        # capped at `limit`. With `before`, the messages counted back are those preceding that offset,
+        # which is how clients page through older history. Returns (frames, count, cursor) where cursor
+        # is the offset after the last one. Only the requested messages are touched: one index lookup
+        # per segment crossed.
+        with self.lock:
+            end = self.next_offset
+            if before is not None:
+                end = max(self.first_offset, min(before, end))
+            start = since if since is not None else end - (last or 0)
+            start = max(start, self.first_offset, end - limit)
+            if start >= end:
+                return b"", 0, end
+            chunks = []
+            for segment in self.segments[self.segment_index(start):]:
+                if segment.base >= end:
+                    break
+                first = max(start, segment.base) - segment.base
+                chunks.append(segment.read(first, min(segment.count, end - segment.base)))
+            return b"".join(chunks), end - start, end
+
+    def close(self):
+        # Flush and close the room's files and memory maps; they are opened again when next used
+        with self.lock:
+            if self.fsync != FSYNC_NEVER:
+                self.sync()
+            for segment in self.segments:
+                segment.close()
+
+    def release(self):
+        # Close the files of an idle room; a room whose lock is held is in use and keeps them
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.close()
+        finally:
+            self.lock.release()
+
+
+class HistoryStore:
+    # The histories of every room, stored under one directory, with a background thread that carries
+    # out the fsync policies, so that recording never waits on the disk. Only the files of the `max_open`
+    # most recently used rooms stay open, so rooms that were used once do not hold descriptors.
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, fsync=FSYNC_BATCH,
+                 fsync_interval=1.0, fsync_batch=100, max_open=MAX_OPEN_LOGS):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.max_open = max_open
+        self.logs = {}
+        # Rooms in order of use, least recent first
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        if fsync != FSYNC_NEVER:
+            threading.Thread(target=self.sync_loop, daemon=True).start()
+
+    def log(self, room):
+        # The history of a room, loaded on first use. Rooms keep their HistoryLog, whose lock orders
+        # recording and subscribing, but past max_open rooms the least recently used one closes its files.
+        with self.lock:
+            log = self.logs.get(room)
+            if log is None:
+                log = self.logs[room] = HistoryLog(os.path.join(self.directory, room_directory(room)),
+                                                   self.segment_size, self.fsync)
+            self.recent[room] = log
+            self.recent.move_to_end(room)
+            idle = self.recent.popitem(last=False)[1] if len(self.recent) > self.max_open else None
+        if idle is not None:
+            idle.release()
+        return log
+
+    def record(self, room, message, encode):
+        # Append a message to its room's history and return its encoded frame
+        log = self.log(room)
+        frame = log.record(message, encode)
+        if self.fsync == FSYNC_ALWAYS or (self.fsync == FSYNC_BATCH and log.pending >= self.fsync_batch):
+            self.wakeup.set()
+        return frame
+
+    def sync(self):
+        with self.lock:
+            logs = list(self.logs.values())
+        for log in logs:
+            log.sync()
+
+    def sync_loop(self):
+        # fsync every interval, or as soon as a room has a full batch pending; under FSYNC_ALWAYS every
+        # message wakes the loop, and messages recorded during one fsync are flushed together by the next
+        while not self.closed:
+            self.wakeup.wait(self.fsync_interval)
+            self.wakeup.clear()
+            self.sync()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        with self.lock:
+            logs = list(self.logs.values())
+        for log in logs:
+            log.close()
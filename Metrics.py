@@ -0,0 +1,179 @@
+import bisect
+import json
+import logging
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("quickchat.metrics")
+
+# Upper bounds in seconds of the latency histogram buckets, from 10 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Log output formats: readable lines, or one JSON object per line for log collectors
+LOG_FORMATS = ("text", "json")
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+# Attributes every log record has; anything else on a record came from `extra` and is logged as a field
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class Histogram:
+    # Counts of observations per bucket, plus their sum
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def format_labels(labels, extra=()):
+    # Prometheus label set for a tuple of (name, value) pairs
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metrics:
+    # Counters, gauges and latency histograms of one server process, rendered in the Prometheus text format.
+    # An update takes one short lock. Gauges are callbacks read only when the metrics are scraped.
+    # Labels are tuples of (name, value) pairs; callers keep their values to a small fixed set.
+
+    def __init__(self, prefix="quickchat"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def count(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, callback):
+        # Register a gauge; the callback returns a number, or a dict of numbers exported as name_<key>
+        self.gauges[name] = callback
+
+    def snapshot(self):
+        # Copies of the counters and histograms, taken under the lock
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(histogram.counts), histogram.total, histogram.count, histogram.bounds)
+                          for key, histogram in self.histograms.items()}
+        return counters, histograms
+
+    def render(self):
+        # Every metric in the Prometheus text exposition format
+        counters, histograms = self.snapshot()
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            metric = f"{self.prefix}_{name}_total"
+            declare(metric, "counter")
+            lines.append(f"{metric}{format_labels(labels)} {value}")
+        for (name, labels), (counts, total, count, bounds) in sorted(histograms.items()):
+            metric = f"{self.prefix}_{name}_seconds"
+            declare(metric, "histogram")
+            cumulative = 0
+            for bound, bucket in zip(bounds + (float("inf"),), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{metric}_bucket{format_labels(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{metric}_sum{format_labels(labels)} {total}")
+            lines.append(f"{metric}_count{format_labels(labels)} {count}")
+        for name, callback in sorted(self.gauges.items()):
+            try:
+                value = callback()
+            except Exception as e:
+                logger.warning(f"Gauge {name} failed: {e}")
+                continue
+            values = value.items() if isinstance(value, dict) else ((None, value),)
+            for key, number in values:
+                metric = f"{self.prefix}_{name}" if key is None else f"{self.prefix}_{name}_{key}"
+                declare(metric, "gauge")
+                lines.append(f"{metric} {number}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # Serves the metrics of the server that started the endpoint at / and /metrics
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def serve_metrics(metrics, host, port):
+    # Serve metrics over HTTP from a background thread; returns the HTTP server so it can be shut down
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Metrics available at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class TextFormatter(logging.Formatter):
+    # Readable log lines; fields passed with `extra` follow the message as key=value pairs
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = [f"{key}={value}" for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES]
+        return " ".join([line] + fields)
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line with the time, level, logger, message and any fields passed with `extra`
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage()}
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level="INFO", log_format="text"):
+    # Send the quickchat loggers to stdout at `level`, as text or JSON lines
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+    root = logging.getLogger("quickchat")
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    root.propagate = False
@@ -0,0 +1,293 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+# Bytes of queued frames a client may fall behind by before the slow consumer policy applies
+DEFAULT_HIGH_WATER = 1024 * 1024
+# Seconds a file transfer waits for a recipient to catch up before that recipient is evicted
+DEFAULT_SLOW_TIMEOUT = 10.0
+# File transfers relayed from another worker cannot wait for a recipient here, so a recipient may fall
+# behind on them by this many high water marks before it is evicted instead
+RELAY_BACKLOG = 2
+
+# Slow consumer policies for chat frames that would exceed the high water mark
+POLICY_DROP = "drop"              # Discard the frame and keep the client
+POLICY_DISCONNECT = "disconnect"  # Evict the client
+POLICIES = (POLICY_DROP, POLICY_DISCONNECT)
+
+# Bytes of queued frames a writer coalesces into one write; 0 writes every frame on its own
+DEFAULT_COALESCE_BYTES = 64 * 1024
+# Buffers passed to one sendmsg call, well below the IOV_MAX of common platforms
+MAX_BATCH_PARTS = 512
+
+
+class FileRegion:
+    # A byte range of a stored file, written to the socket with sendfile instead of being read into memory
+    __slots__ = ("path", "offset", "count")
+
+    def __init__(self, path, offset, count):
+        self.path = path
+        self.offset = offset
+        self.count = count
+
+    def send(self, sock):
+        # Copy the region from disk to the socket in the kernel where the platform allows it
+        with open(self.path, 'rb') as file:
+            sock.sendfile(file, self.offset, self.count)
+
+
+def add_parts(batch, item):
+    # Append a queued item to a write batch, with the parts of a tuple in order
+    if isinstance(item, tuple):
+        for part in item:
+            add_parts(batch, part)
+    else:
+        batch.append(item)
+
+
+def send_buffers(sock, buffers):
+    # Write buffers with as few system calls as possible: one sendmsg per MAX_BATCH_PARTS buffers,
+    # resumed where a partial write stopped
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    views = [memoryview(buffer).cast("B") for buffer in buffers]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + MAX_BATCH_PARTS])
+        while sent and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+
+class OutboundQueue:
+    # Bounded queue of frames waiting to be written to one client by its writer thread.
+    # Chat frames and file transfers wait in separate lanes: the writer always sends queued chat
+    # frames first and fills the remaining time with file chunks, so a chat message waits behind
+    # at most the one chunk being written. An item may be a tuple of parts written back to back.
+
+    def __init__(self, high_water=DEFAULT_HIGH_WATER, policy=POLICY_DISCONNECT):
+        self.items = deque()
+        self.background = deque()
+        self.high_water = high_water
+        self.policy = policy
+        self.queued_bytes = 0
+        self.background_bytes = 0
+        self.closed = False
+        self.evicted = False
+        self.condition = threading.Condition()
+        # Counters
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.peak_depth = 0
+
+    def size_of(self, item):
+        # File regions stay on disk and do not count against the high water mark
+        if isinstance(item, tuple):
+            return sum(self.size_of(part) for part in item)
+        return 0 if isinstance(item, FileRegion) else len(item)
+
+    def pending(self):
+        return self.items or self.background
+
+    def notify(self):
+        # Wake the writer and anyone waiting for space
+        self.condition.notify_all()
+
+    def put(self, item, bulk=False, background=False, limit=None):
+        # Queue a frame; returns False if it was refused because the client is too far behind.
+        # Bulk frames are only refused past `limit` bytes, evicting the client since they cannot be
+        # dropped; without one their producer waits for space afterwards instead.
+        # Background frames (file transfers) are bulk frames sent only while no chat frame is waiting;
+        # chat frames are refused by their own backlog, not by file chunks queued behind them.
+        size = self.size_of(item)
+        with self.condition:
+            if self.closed:
+                return False
+            if limit is not None and self.pending() and self.queued_bytes + size > limit:
+                self.dropped += 1
+                self.evicted = True
+                self.close_locked()
+                return False
+            if (not bulk and not background and self.items
+                    and self.queued_bytes - self.background_bytes + size > self.high_water):
+                self.dropped += 1
+                if self.policy == POLICY_DISCONNECT:
+                    self.evicted = True
+                    self.close_locked()
+                return False
+            if background:
+                self.background.append(item)
+                self.background_bytes += size
+            else:
+                self.items.append(item)
+            self.queued_bytes += size
+            self.enqueued += 1
+            self.peak_depth = max(self.peak_depth, len(self.items) + len(self.background))
+            self.notify()
+            return True
+
+    def has_space(self):
+        return self.closed or self.queued_bytes <= self.high_water
+
+    def wait_for_space(self, timeout=DEFAULT_SLOW_TIMEOUT):
+        # Block a bulk producer until the backlog is below the high water mark; evicts the client on timeout
+        with self.condition:
+            if not self.condition.wait_for(self.has_space, timeout):
+                self.evicted = True
+                self.close_locked()
+            return not self.closed
+
+    def get(self):
+        # Block until an item is available; None once the queue is closed
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending() or self.closed)
+            if self.closed:
+                return None
+            return self.pop_locked()
+
+    def get_batch(self, max_bytes=0, window=0.0):
+        # Block until an item is available, then take every frame queued behind it until the batch holds
+        # max_bytes, waiting up to `window` seconds for more; returns the parts to write, None once closed
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending() or self.closed)
+            if self.closed:
+                return None
+            batch = []
+            size = self.batch_locked(batch, 0, max_bytes)
+            deadline = time.monotonic() + window
+            while window > 0 and not self.batch_full(batch, size, max_bytes):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.condition.wait_for(lambda: self.pending() or self.closed, remaining):
+                    break
+                if self.closed:
+                    return None
+                size = self.batch_locked(batch, size, max_bytes)
+            return batch
+
+    def batch_full(self, batch, size, max_bytes):
+        # A batch ends at max_bytes, at MAX_BATCH_PARTS, or after a file region, which is written with sendfile
+        return size >= max_bytes or len(batch) >= MAX_BATCH_PARTS or isinstance(batch[-1], FileRegion)
+
+    def batch_locked(self, batch, size, max_bytes):
+        # Move queued items into a batch, at least one, until it is full; returns the bytes batched
+        while self.pending() and not (batch and self.batch_full(batch, size, max_bytes)):
+            item = self.pop_locked()
+            add_parts(batch, item)
+            size += self.size_of(item)
+        return size
+
+    def pop_locked(self):
+        # Chat frames first, then file transfers
+        if self.items:
+            item = self.items.popleft()
+        else:
+            item = self.background.popleft()
+            self.background_bytes -= self.size_of(item)
+        self.queued_bytes -= self.size_of(item)
+        self.sent += 1
+        self.notify()
+        return item
+
+    def close_locked(self):
+        self.closed = True
+        self.items.clear()
+        self.background.clear()
+        self.queued_bytes = 0
+        self.background_bytes = 0
+        self.notify()
+
+    def close(self):
+        # Stop the writer and discard anything still queued
+        with self.condition:
+            self.close_locked()
+
+    def stats(self):
+        # Snapshot of the queue counters
+        with self.condition:
+            return {
+                "depth": len(self.items) + len(self.background),
+                "queued_bytes": self.queued_bytes,
+                "peak_depth": self.peak_depth,
+                "enqueued": self.enqueued,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "evicted": self.evicted,
+            }
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    # Outbound queue drained by an asyncio writer task; must be used from the event loop thread
+
+    def __init__(self, high_water=DEFAULT_HIGH_WATER, policy=POLICY_DISCONNECT):
+        super().__init__(high_water, policy)
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+
+    async def wait_changed(self):
+        await self.changed.wait()
+        self.changed.clear()
+
+    async def wait_for_space(self, timeout=DEFAULT_SLOW_TIMEOUT):
+        # Wait until the backlog is below the high water mark; evicts the client on timeout
+        try:
+            await asyncio.wait_for(self.wait_until(self.has_space), timeout)
+        except asyncio.TimeoutError:
+            self.evicted = True
+            self.close()
+        return not self.closed
+
+    async def wait_until(self, predicate):
+        while not predicate():
+            await self.wait_changed()
+
+    async def get(self):
+        # Wait until an item is available; None once the queue is closed
+        await self.wait_until(lambda: self.pending() or self.closed)
+        if self.closed:
+            return None
+        return self.pop_locked()
+
+    async def get_batch(self, max_bytes=0, window=0.0):
+        # Wait until an item is available, then batch the frames queued behind it as OutboundQueue.get_batch does
+        await self.wait_until(lambda: self.pending() or self.closed)
+        if self.closed:
+            return None
+        batch = []
+        size = self.batch_locked(batch, 0, max_bytes)
+        deadline = time.monotonic() + window
+        while window > 0 and not self.batch_full(batch, size, max_bytes):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.wait_until(lambda: self.pending() or self.closed), remaining)
+            except asyncio.TimeoutError:
+                break
+            if self.closed:
+                return None
+            size = self.batch_locked(batch, size, max_bytes)
+        return batch
+
+
+def queue_totals(queues):
+    # Aggregate counters over many outbound queues
+    totals = {"connections": 0, "depth": 0, "queued_bytes": 0, "max_depth": 0,
+              "enqueued": 0, "sent": 0, "dropped": 0, "evicted": 0}
+    for queue in list(queues):
+        stats = queue.stats()
+        totals["connections"] += 1
+        totals["depth"] += stats["depth"]
+        totals["queued_bytes"] += stats["queued_bytes"]
+        totals["max_depth"] = max(totals["max_depth"], stats["depth"])
+        totals["enqueued"] += stats["enqueued"]
+        totals["sent"] += stats["sent"]
+        totals["dropped"] += stats["dropped"]
+        totals["evicted"] += int(stats["evicted"])
+    return totals
@@ -0,0 +1,202 @@
+import cProfile
+import collections
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+# Profiling modes: "sample" records the stacks of every thread at an interval and writes them as collapsed
+# stacks (the input of flamegraph.pl and speedscope); "cprofile" records every call made while processing
+# messages and writes pstats
+MODE_SAMPLE = "sample"
+MODE_CPROFILE = "cprofile"
+PROFILE_MODES = (MODE_SAMPLE, MODE_CPROFILE)
+# Seconds between stack samples
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# Profiling stops by itself after this many seconds unless told otherwise
+DEFAULT_PROFILE_DURATION = 60.0
+MAX_PROFILE_DURATION = 3600.0
+# Functions listed in the text report of a cProfile session
+REPORT_FUNCTIONS = 40
+# From Python 3.12 cProfile records through sys.monitoring: one profile is active for the whole process and
+# covers every thread, and enabling a second one at the same time fails
+PROCESS_WIDE_PROFILE = sys.version_info >= (3, 12)
+
+
+def thread_label(thread):
+    # Thread name without its number, so the stacks of all client threads add up: "Thread (handle_client)"
+    return re.sub(r"-\d+", "", thread.name) if thread is not None else "thread"
+
+
+def collapse_stack(frame):
+    # Frames from the outermost call in, as "function (file:line)" entries
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class StackSampler:
+    # Samples the stack of every thread from a background thread. Sampling measures wall-clock time, so
+    # threads blocked in recv or waiting on a lock show up where they wait, which is how contention shows.
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = [thread_label(threads.get(ident))] + collapse_stack(frame)
+                self.counts[";".join(stack)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        # One "frame;frame;frame count" line per distinct stack
+        with open(path, "w") as output:
+            for stack, count in self.counts.most_common():
+                output.write(f"{stack} {count}\n")
+
+
+class ProfileSession:
+    # One profiling window: the profiles or sampler recording it and per message type timings
+
+    def __init__(self, mode, whole_thread, interval):
+        self.mode = mode
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # Message type -> [count, total seconds, slowest]
+        self.timings = {}
+        self.profiles = []
+        self.local = threading.local()
+        self.sampler = None
+        self.thread_profile = None
+        if mode == MODE_SAMPLE:
+            self.sampler = StackSampler(interval)
+            self.sampler.start()
+        elif whole_thread or PROCESS_WIDE_PROFILE:
+            # Everything the calling thread runs is recorded, for servers doing all work on one event loop,
+            # or every thread where one profile covers the process
+            self.thread_profile = cProfile.Profile()
+            self.profiles.append(self.thread_profile)
+            self.thread_profile.enable()
+
+    def profile(self):
+        # This thread's profile for running message processing under, or None when not recording calls
+        if self.mode != MODE_CPROFILE or self.thread_profile is not None:
+            return None
+        profile = getattr(self.local, "profile", None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        return profile
+
+    def record(self, message_type, seconds):
+        with self.lock:
+            timing = self.timings.get(message_type)
+            if timing is None:
+                timing = self.timings[message_type] = [0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def finish(self):
+        # Stop recording; before Python 3.12, must run on the thread that started a whole-thread profile
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.thread_profile is not None:
+            self.thread_profile.disable()
+
+    def report(self):
+        # Text summary: per message type timings, then the most expensive functions for cProfile sessions
+        lines = [f"{self.mode} profile of {time.time() - self.started:.1f} seconds", "",
+                 f"{'message type':<16} {'count':>8} {'total ms':>10} {'mean us':>10} {'max us':>10}"]
+        with self.lock:
+            timings = sorted(self.timings.items(), key=lambda item: -item[1][1])
+        for message_type, (count, total, slowest) in timings:
+            lines.append(f"{message_type:<16} {count:>8} {total * 1e3:>10.1f} {total / count * 1e6:>10.1f} "
+                         f"{slowest * 1e6:>10.1f}")
+        if self.sampler is not None:
+            lines += ["", f"{self.sampler.samples} samples every {self.sampler.interval * 1e3:g} ms"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory, name):
+        # Write the session's output files and return their paths
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, name)
+        paths = []
+        report = self.report()
+        if self.sampler is not None:
+            self.sampler.write(base + ".collapsed")
+            paths.append(base + ".collapsed")
+        else:
+            profiles = [profile for profile in self.profiles if profile.getstats()]
+            if profiles:
+                stats = pstats.Stats(*profiles)
+                stats.dump_stats(base + ".pstats")
+                paths.append(base + ".pstats")
+                listing = io.StringIO()
+                pstats.Stats(*profiles, stream=listing).sort_stats("cumulative").print_stats(REPORT_FUNCTIONS)
+                report += "\n" + listing.getvalue()
+        with open(base + ".txt", "w") as output:
+            output.write(report)
+        paths.append(base + ".txt")
+        return paths
+
+
+class Profiler:
+    # Profiling that is switched on and off while the server runs. When off, the hot path pays one
+    # attribute check per message.
+
+    def __init__(self, directory="profiles", prefix="profile"):
+        self.directory = directory
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.session = None
+
+    @property
+    def active(self):
+        return self.session is not None
+
+    def start(self, mode=MODE_SAMPLE, whole_thread=False, interval=DEFAULT_SAMPLE_INTERVAL):
+        # Begin a session; returns it, or raises ValueError if one is already running
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}")
+        with self.lock:
+            if self.session is not None:
+                raise ValueError("Profiling is already running")
+            self.session = ProfileSession(mode, whole_thread, interval)
+            return self.session
+
+    def stop(self, session=None):
+        # End the running session (only if it is `session`, when given) and write its output;
+        # returns the paths written, or None if there was nothing to stop
+        with self.lock:
+            current = self.session
+            if current is None or (session is not None and current is not session):
+                return None
+            self.session = None
+        current.finish()
+        name = f"{self.prefix}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(current.started))}-{current.mode}"
+        return current.write(self.directory, name)
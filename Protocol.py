@@ -0,0 +1,422 @@
+import json
+import struct
+import threading
+import zlib
+
+# Faster codecs are used when installed, the standard library otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Every frame on the wire is a 4 byte big-endian payload length, a 1 byte frame type, then the payload
+FRAME_HEADER = struct.Struct("!IB")
+HEADER_SIZE = FRAME_HEADER.size
+
+# Frame types
+FRAME_JSON = 1        # UTF-8 JSON encoded message dictionary
+FRAME_FILE_CHUNK = 2  # Raw bytes belonging to the file announced by the preceding "file" message
+FRAME_MSGPACK = 3     # MessagePack encoded message dictionary
+FRAME_BUS = 4         # Envelope exchanged between server worker processes, never sent to clients
+FRAME_TRANSFER_CHUNK = 5  # File bytes prefixed with their offset in the file and a CRC-32 of the bytes
+FRAME_STREAM_CHUNK = 6    # File bytes prefixed with the stream id of their transfer and their offset in the file
+FRAME_COMPRESSED = 7      # A compression method id, then one or more complete frames compressed together
+FILE_CHUNK_FRAMES = (FRAME_FILE_CHUNK, FRAME_TRANSFER_CHUNK)
+
+# Prefix of a FRAME_TRANSFER_CHUNK payload: 8 byte offset, 4 byte CRC-32
+TRANSFER_CHUNK_HEADER = struct.Struct("!QI")
+# Prefix of a FRAME_STREAM_CHUNK payload: 8 byte stream id, 8 byte offset. The server sends files to clients
+# as streams so several transfers, and chat messages, can be interleaved on one connection.
+STREAM_CHUNK_HEADER = struct.Struct("!QQ")
+
+# File bodies are split into chunks of at most this many bytes
+CHUNK_SIZE = 64 * 1024
+# Frames smaller than this are sent uncompressed: the saving would not pay for the work
+DEFAULT_COMPRESS_THRESHOLD = 256
+# Refuse frames larger than this so a corrupt length cannot make us allocate unbounded memory
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Receive buffer a frame decoder starts with and returns to once large frames stop coming
+DECODER_BUFFER_SIZE = 4096
+# Frames that fit that size a decoder must take in a row after a larger one before it gives the grown
+# buffer back, so a run of file chunks reuses one buffer instead of regrowing it for every chunk
+DECODER_SHRINK_AFTER = 64
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(frame_type, payload):
+    # Prefix a payload with its length and type
+    return FRAME_HEADER.pack(len(payload), frame_type) + payload
+
+
+class JsonCodec:
+    # JSON message encoding; orjson produces the same wire format several times faster
+    name = "json"
+    frame_type = FRAME_JSON
+
+    def encode(self, message):
+        if orjson is not None:
+            return orjson.dumps(message)
+        return json.dumps(message, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, payload):
+        if orjson is not None:
+            return orjson.loads(payload)
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    # Compact binary message encoding, only available when msgpack is installed
+    name = "msgpack"
+    frame_type = FRAME_MSGPACK
+
+    def encode(self, message):
+        return msgpack.packb(message)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload)
+
+
+# Codecs usable in this process, by name and by the frame type that carries them
+CODECS = {codec.name: codec for codec in [JsonCodec()] + ([MsgpackCodec()] if msgpack is not None else [])}
+MESSAGE_FRAMES = {codec.frame_type: codec for codec in CODECS.values()}
+DEFAULT_CODEC = CODECS["json"]
+
+
+def get_codec(name):
+    # Look up a codec by name, failing if its library is not installed
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Codec {name!r} is not available") from None
+
+
+def encode_message(message, codec=DEFAULT_CODEC):
+    # Encode a message dictionary as a message frame. Broadcasts call this once and share the bytes.
+    return encode_frame(codec.frame_type, codec.encode(message))
+
+
+def decode_message(payload, frame_type=FRAME_JSON):
+    # Decode the payload of a message frame back into a dictionary
+    codec = MESSAGE_FRAMES.get(frame_type)
+    if codec is None:
+        raise ProtocolError(f"Unsupported message frame type {frame_type}")
+    return codec.decode(payload)
+
+
+# Frames whose compressed form a FrameCompressor remembers, enough for the broadcasts of every busy thread
+COMPRESS_MEMO_FRAMES = 64
+
+
+class ZlibCompression:
+    # DEFLATE from the standard library; the fastest level, as frames are compressed on the send path
+    name = "zlib"
+    method = 1
+
+    def compress(self, data):
+        return zlib.compress(data, 1)
+
+    def decompress(self, data, limit):
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, limit)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ProtocolError("Compressed frame is truncated or expands beyond the frame size limit")
+        return result
+
+
+class ZstdCompression:
+    # Zstandard, only available when zstandard is installed; compresses better than zlib at a similar speed.
+    # zstandard compressors and decompressors must not be used by two threads at once, so each thread
+    # gets its own pair.
+    name = "zstd"
+    method = 2
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def contexts(self):
+        local = self.local
+        if not hasattr(local, "compressor"):
+            local.compressor = zstandard.ZstdCompressor(level=3)
+            local.decompressor = zstandard.ZstdDecompressor()
+        return local
+
+    def compress(self, data):
+        return self.contexts().compressor.compress(data)
+
+    def decompress(self, data, limit):
+        if not 0 <= zstandard.frame_content_size(data) <= limit:
+            raise ProtocolError("Compressed frame expands beyond the frame size limit")
+        try:
+            return self.contexts().decompressor.decompress(data, max_output_size=limit)
+        except zstandard.ZstdError as e:
+            raise ProtocolError(f"Invalid compressed frame: {e}") from None
+
+
+# Compression methods usable in this process, most preferred first, by name and by the id carried in frames
+COMPRESSIONS = {compression.name: compression
+                for compression in ([ZstdCompression()] if zstandard is not None else []) + [ZlibCompression()]}
+COMPRESSION_METHODS = {compression.method: compression for compression in COMPRESSIONS.values()}
+
+# File types whose content is already compressed, by extension and by the magic bytes they start with
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".aac", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg", ".jpg",
+    ".lz4", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".opus", ".png", ".pptx", ".rar", ".tgz", ".webm",
+    ".webp", ".xlsx", ".xz", ".zip", ".zst",
+}
+COMPRESSED_MAGIC = (
+    b"\x1f\x8b",                 # gzip
+    b"PK\x03\x04",               # zip and the formats built on it
+    b"\x89PNG",                   # PNG
+    b"\xff\xd8\xff",              # JPEG
+    b"GIF8",                      # GIF
+    b"BZh",                       # bzip2
+    b"\xfd7zXZ\x00",              # xz
+    b"\x28\xb5\x2f\xfd",          # zstd
+    b"7z\xbc\xaf\x27\x1c",        # 7-Zip
+    b"Rar!",                      # RAR
+    b"OggS",                      # Ogg
+    b"ID3",                       # MP3
+    b"\x1a\x45\xdf\xa3",          # Matroska and WebM
+)
+
+
+def negotiate_compression(offered, allowed=None):
+    # Pick the first method the peer offered that this process supports and allows, or None
+    for name in offered or ():
+        if name in COMPRESSIONS and (allowed is None or name in allowed):
+            return name
+    return None
+
+
+def worth_compressing(filename, head=b""):
+    # Whether a file's content may shrink: not when its extension or first bytes name a compressed format
+    name = filename.lower()
+    if any(name.endswith(extension) for extension in COMPRESSED_EXTENSIONS):
+        return False
+    if any(head.startswith(magic) for magic in COMPRESSED_MAGIC):
+        return False
+    # MP4 and QuickTime files start with a box size and "ftyp"; RIFF containers include WebP and AVI
+    return head[4:8] != b"ftyp" and not (head.startswith(b"RIFF") and head[8:12] in (b"WEBP", b"AVI "))
+
+
+class FrameCompressor:
+    # Compresses outgoing frames with one method. Frames below the threshold, or that would not shrink,
+    # go out as they are. Results of the last few frames are remembered by frame object, so a broadcast,
+    # which queues the same frame for every recipient, is compressed once for all connections sharing this
+    # compressor even while other threads broadcast other frames.
+
+    def __init__(self, compression, threshold=DEFAULT_COMPRESS_THRESHOLD):
+        self.compression = compression
+        self.threshold = threshold
+        self.method = bytes([compression.method])
+        # id(frame) -> (frame, result), oldest first; holding the frame keeps its id from being reused
+        self.memo = {}
+        self.lock = threading.Lock()
+
+    def compress(self, data):
+        # `data` is one or more complete frames
+        if not self.threshold <= len(data) <= MAX_FRAME_SIZE:
+            return data
+        with self.lock:
+            memo = self.memo.get(id(data))
+        if memo is not None and memo[0] is data:
+            return memo[1]
+        compressed = encode_frame(FRAME_COMPRESSED, self.method + self.compression.compress(data))
+        result = compressed if len(compressed) < len(data) else data
+        with self.lock:
+            self.memo[id(data)] = (data, result)
+            if len(self.memo) > COMPRESS_MEMO_FRAMES:
+                del self.memo[next(iter(self.memo))]
+        return result
+
+
+def decompress_frames(payload, limit):
+    # The frames carried by a FRAME_COMPRESSED payload, expanding to at most `limit` bytes
+    if not payload:
+        raise ProtocolError("Empty compressed frame")
+    compression = COMPRESSION_METHODS.get(payload[0])
+    if compression is None:
+        raise ProtocolError(f"Unsupported compression method {payload[0]}")
+    return compression.decompress(memoryview(payload)[1:], limit)
+
+
+def encode_chunks(data, chunk_size=CHUNK_SIZE):
+    # Split file data into a sequence of chunk frames
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        yield encode_frame(FRAME_FILE_CHUNK, bytes(view[offset:offset + chunk_size]))
+
+
+def encode_transfer_chunk(offset, data):
+    # Frame file bytes with their position and checksum so a receiver can verify and resume a transfer
+    return encode_frame(FRAME_TRANSFER_CHUNK, TRANSFER_CHUNK_HEADER.pack(offset, zlib.crc32(data)) + data)
+
+
+def decode_transfer_chunk(payload):
+    # Return (offset, data) of a transfer chunk payload after checking its CRC-32
+    if len(payload) < TRANSFER_CHUNK_HEADER.size:
+        raise ProtocolError("Truncated transfer chunk")
+    offset, crc = TRANSFER_CHUNK_HEADER.unpack_from(payload)
+    data = memoryview(payload)[TRANSFER_CHUNK_HEADER.size:]
+    if zlib.crc32(data) != crc:
+        raise ProtocolError(f"Checksum mismatch in file chunk at offset {offset}")
+    return offset, data
+
+
+def stream_chunk_prefix(stream, offset, count):
+    # Frame header and prefix of a stream chunk whose `count` data bytes are written separately
+    return FRAME_HEADER.pack(STREAM_CHUNK_HEADER.size + count, FRAME_STREAM_CHUNK) + STREAM_CHUNK_HEADER.pack(stream, offset)
+
+
+def encode_stream_chunk(stream, offset, data):
+    # Frame file bytes as part of stream `stream`
+    return stream_chunk_prefix(stream, offset, len(data)) + data
+
+
+def decode_stream_chunk(payload):
+    # Return (stream, offset, data) of a stream chunk payload
+    if len(payload) < STREAM_CHUNK_HEADER.size:
+        raise ProtocolError("Truncated stream chunk")
+    stream, offset = STREAM_CHUNK_HEADER.unpack_from(payload)
+    return stream, offset, memoryview(payload)[STREAM_CHUNK_HEADER.size:]
+
+
+class FrameDecoder:
+    # Incrementally decodes frames from a stream into one reusable buffer.
+    # A single recv may complete many frames, and a frame may span many recvs.
+    # Compressed frames are expanded transparently: the frames inside are returned in their place.
+    # The buffer starts small and grows while a larger frame is in flight. It keeps that size while large
+    # frames keep coming and shrinks back once `shrink_after` smaller ones in a row have been consumed, so a
+    # connection that chats holds only `buffer_size` bytes.
+
+    def __init__(self, buffer_size=DECODER_BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE, allow_compressed=True,
+                 shrink_after=DECODER_SHRINK_AFTER):
+        self.buffer_size = buffer_size
+        self.shrink_after = shrink_after
+        # Frames no larger than buffer_size taken since the last larger one
+        self.small_frames = 0
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.max_frame_size = max_frame_size
+        # Unconsumed bytes live in buffer[start:end]
+        self.start = 0
+        self.end = 0
+        self.allow_compressed = allow_compressed
+        # Decoder over the frames expanded from the last compressed frame, consumed before the buffer
+        self.inflated = None
+
+    def pending(self):
+        # Number of buffered bytes not yet returned as frames
+        return self.end - self.start
+
+    def reserve(self, needed):
+        # Make room for at least `needed` more bytes after `end`
+        if len(self.buffer) - self.end >= needed:
+            return
+        pending = self.pending()
+        if self.start:
+            # Move the partial frame to the front of the buffer
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        if len(self.buffer) - self.end < needed:
+            # The partial frame is bigger than the buffer, grow it
+            self.view.release()
+            self.buffer.extend(bytes(pending + needed - len(self.buffer)))
+            self.view = memoryview(self.buffer)
+
+    def wanted(self):
+        # Bytes still missing for the frame at the head of the buffer, or a sensible read size
+        pending = self.pending()
+        if pending >= HEADER_SIZE:
+            length, _ = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            missing = HEADER_SIZE + length - pending
+            if missing > 0:
+                return missing
+        return 4096
+
+    def recv_into(self, sock):
+        # Read directly from a socket into the free tail of the buffer
+        self.reserve(self.wanted())
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        # Append bytes that were read elsewhere (e.g. by an asyncio StreamReader)
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def take_frame(self, include_header):
+        # Return the next frame, expanding compressed frames into the frames they carry
+        while True:
+            if self.inflated is not None:
+                frame = self.inflated.take_frame(include_header)
+                if frame is not None:
+                    return frame
+                if self.inflated.pending():
+                    raise ProtocolError("Compressed frame ends inside a frame")
+                self.inflated = None
+            frame = self.take_buffered_frame(include_header)
+            if frame is None or frame[0] != FRAME_COMPRESSED:
+                return frame
+            if not self.allow_compressed:
+                raise ProtocolError("Nested compressed frame")
+            payload = memoryview(frame[1])[HEADER_SIZE:] if include_header else frame[1]
+            self.inflated = FrameDecoder(0, self.max_frame_size, allow_compressed=False)
+            self.inflated.feed(decompress_frames(payload, self.max_frame_size + HEADER_SIZE))
+
+    def take_buffered_frame(self, include_header):
+        # Copy the frame at the head of the buffer out and consume it
+        pending = self.pending()
+        if pending < HEADER_SIZE:
+            return None
+        length, frame_type = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_frame_size:
+            raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+        if pending < HEADER_SIZE + length:
+            return None
+        frame_end = self.start + HEADER_SIZE + length
+        data_start = self.start if include_header else self.start + HEADER_SIZE
+        data = bytes(self.view[data_start:frame_end])
+        self.start = frame_end
+        self.small_frames = self.small_frames + 1 if HEADER_SIZE + length <= self.buffer_size else 0
+        if self.start == self.end:
+            # Buffer fully consumed, rewind so the next read starts at the front
+            self.start = self.end = 0
+            if len(self.buffer) > self.buffer_size and self.small_frames >= self.shrink_after:
+                # Large frames have stopped coming; give back what they made the buffer grow to
+                self.view.release()
+                self.buffer = bytearray(self.buffer_size)
+                self.view = memoryview(self.buffer)
+        return frame_type, data
+
+    def next_frame(self):
+        # Return the next complete (frame_type, payload) pair, or None if more data is needed
+        return self.take_frame(False)
+
+    def next_raw_frame(self):
+        # Return the next complete (frame_type, encoded frame) pair so it can be relayed without re-encoding
+        return self.take_frame(True)
+
+    def frames(self):
+        # Yield every complete frame currently buffered
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
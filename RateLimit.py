@@ -0,0 +1,147 @@
+import threading
+import time
+
+# What happens to a client going past a rate limit: its messages wait until the limit allows them, are
+# discarded, or the client is disconnected. Upload bytes are never discarded; they wait under "drop" too.
+RATE_DELAY = "delay"
+RATE_DROP = "drop"
+RATE_DISCONNECT = "disconnect"
+RATE_POLICIES = (RATE_DELAY, RATE_DROP, RATE_DISCONNECT)
+# Limited quantities: chat messages and upload bytes per second
+LIMIT_MESSAGES = "messages"
+LIMIT_BYTES = "bytes"
+# Seconds between checks for a free transfer slot while an upload waits for one, and the longest an upload
+# waits before it is refused; the sender is told how long it may wait
+TRANSFER_RETRY = 0.1
+TRANSFER_WAIT = 60.0
+
+
+class TokenBucket:
+    # Allows `rate` units per second on average and bursts of up to `burst` units. Tokens may be borrowed:
+    # the bucket then goes negative and the borrower waits until it has refilled to zero.
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "lock")
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill_locked(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount):
+        # Take `amount` tokens if the bucket holds them, or is full for amounts larger than a burst
+        with self.lock:
+            self.refill_locked()
+            if self.tokens < min(amount, self.burst):
+                return False
+            self.tokens -= amount
+            return True
+
+    def borrow(self, amount):
+        # Take `amount` tokens, going into debt if need be; returns the seconds until the debt is repaid
+        with self.lock:
+            self.refill_locked()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def give(self, amount):
+        # Return tokens taken for work that was not done after all
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + amount)
+
+
+class ConnectionLimits:
+    # One connection's own buckets; None where that limit is off
+    __slots__ = ("messages", "bytes")
+
+    def __init__(self, message_rate, byte_rate, byte_burst):
+        self.messages = TokenBucket(message_rate) if message_rate else None
+        self.bytes = TokenBucket(byte_rate, max(byte_rate, byte_burst)) if byte_rate else None
+
+
+class RateLimiter:
+    # Rate limits of a server: messages and upload bytes per second for each connection and for all of them
+    # together, and concurrent uploads per user and in total. Counters of what the limits did go to `metrics`.
+
+    def __init__(self, metrics, policy=RATE_DELAY, message_rate=None, byte_rate=None, transfers=None,
+                 global_message_rate=None, global_byte_rate=None, global_transfers=None, byte_burst=0):
+        if policy not in RATE_POLICIES:
+            raise ValueError(f"Unknown rate limit policy {policy!r}")
+        self.metrics = metrics
+        self.policy = policy
+        self.message_rate = message_rate
+        self.byte_rate = byte_rate
+        # A byte bucket holds at least one chunk, the largest amount charged at once
+        self.byte_burst = byte_burst
+        self.transfers = transfers
+        self.global_transfers = global_transfers
+        self.global_buckets = {
+            LIMIT_MESSAGES: TokenBucket(global_message_rate) if global_message_rate else None,
+            LIMIT_BYTES: TokenBucket(global_byte_rate, max(global_byte_rate, byte_burst)) if global_byte_rate else None,
+        }
+        self.lock = threading.Lock()
+        self.active = 0
+        self.active_by_user = {}
+
+    def connection_limits(self):
+        # Buckets for a new connection
+        return ConnectionLimits(self.message_rate, self.byte_rate, self.byte_burst)
+
+    def rate_limited(self, limit, action):
+        self.metrics.count("rate_limited", labels=(("limit", limit), ("action", action)))
+
+    def admit(self, limits, limit, amount=1):
+        # Charge `amount` against a connection's bucket for `limit` and the global one. Returns the seconds
+        # the caller waits before going on (0.0 within the limits), or None when the message is to be
+        # discarded; raises ConnectionError when the client is to be disconnected.
+        buckets = [bucket for bucket in (getattr(limits, limit), self.global_buckets[limit]) if bucket is not None]
+        if not buckets:
+            return 0.0
+        if self.policy == RATE_DELAY or (self.policy == RATE_DROP and limit == LIMIT_BYTES):
+            delay = max(bucket.borrow(amount) for bucket in buckets)
+            if delay:
+                self.rate_limited(limit, RATE_DELAY)
+            return delay
+        taken = []
+        for bucket in buckets:
+            if not bucket.take(amount):
+                for other in taken:
+                    other.give(amount)
+                self.rate_limited(limit, self.policy)
+                if self.policy == RATE_DISCONNECT:
+                    raise ConnectionError(f"Rate limit exceeded ({limit} per second)")
+                return None
+            taken.append(bucket)
+        return 0.0
+
+    def start_transfer(self, name):
+        # Claim an upload slot for a user; False when the user or the server is at its limit
+        with self.lock:
+            count = self.active_by_user.get(name, 0)
+            if ((self.transfers is not None and count >= self.transfers)
+                    or (self.global_transfers is not None and self.active >= self.global_transfers)):
+                return False
+            self.active_by_user[name] = count + 1
+            self.active += 1
+            return True
+
+    def end_transfer(self, name):
+        with self.lock:
+            count = self.active_by_user.pop(name, 0) - 1
+            if count > 0:
+                self.active_by_user[name] = count
+            self.active -= 1
+
+    def refuse_transfer(self):
+        # An upload found no free slot: returns True to wait for one, False to refuse the upload;
+        # raises ConnectionError when the client is to be disconnected
+        self.rate_limited("transfers", self.policy)
+        if self.policy == RATE_DISCONNECT:
+            raise ConnectionError("Too many concurrent uploads")
+        return self.policy == RATE_DELAY
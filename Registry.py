@@ -0,0 +1,77 @@
+import threading
+
+
+class Session:
+    # Everything the server holds for one connection; slots keep the record small with many thousands connected
+
+    __slots__ = ("id", "connection", "address", "queue", "decoder", "limits", "compressor", "name", "rooms",
+                 "writer_task")
+
+    def __init__(self, connection, address, queue, decoder, limits=None):
+        self.id = id(connection)
+        self.connection = connection
+        self.address = address
+        self.queue = queue
+        self.decoder = decoder
+        # Rate limit buckets of the connection
+        self.limits = limits
+        # Compressor negotiated for frames sent to the client, if any
+        self.compressor = None
+        # User name, set once the client has joined
+        self.name = None
+        # Rooms the connection is subscribed to
+        self.rooms = set()
+        # Task draining the queue, on the asyncio engine
+        self.writer_task = None
+
+
+class ConnectionRegistry:
+    # Live connections keyed by id(connection). Adding and removing a session is O(1) under a short lock.
+    # Broadcasts iterate an immutable snapshot of the connections, read without locking and rebuilt at
+    # most once per change, by the first broadcast after it; lookups are plain dict reads.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.snapshot = ()
+        self.stale = False
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, connection, address, queue, decoder, limits=None):
+        session = Session(connection, address, queue, decoder, limits)
+        with self.lock:
+            self.sessions[session.id] = session
+            self.stale = True
+        return session
+
+    def remove(self, connection):
+        # Forget a connection; returns its session, or None if it was not registered
+        with self.lock:
+            session = self.sessions.pop(id(connection), None)
+            if session is not None:
+                self.stale = True
+        return session
+
+    def get(self, connection):
+        # Session of a connection, or None once it is gone
+        return self.sessions.get(id(connection))
+
+    def connections(self):
+        # Tuple of every registered connection
+        if self.stale:
+            with self.lock:
+                if self.stale:
+                    self.snapshot = tuple(session.connection for session in self.sessions.values())
+                    self.stale = False
+        return self.snapshot
+
+    def all_sessions(self):
+        # List of every session, for statistics and roster snapshots
+        with self.lock:
+            return list(self.sessions.values())
+
+    def names(self):
+        # Names of the joined connections in the order they connected
+        return [session.name for session in self.all_sessions() if session.name is not None]
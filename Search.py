@@ -0,0 +1,164 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("quickchat.search")
+
+# Results returned for one search unless the request asks for fewer
+MAX_RESULTS = 50
+# Seconds between background commits of newly indexed messages
+COMMIT_INTERVAL = 0.5
+
+# Messages are rows of an ordinary table with B-tree indexes for sender and time ranges; their text and
+# filenames are tokenized into an FTS5 table, SQLite's on-disk inverted index, so term lookups never scan.
+# Two and three character prefixes are indexed too, so short prefix queries stay a single lookup.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    time REAL NOT NULL,
+    room TEXT NOT NULL,
+    name TEXT NOT NULL,
+    text TEXT NOT NULL DEFAULT '',
+    filename TEXT NOT NULL DEFAULT '',
+    offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+CREATE INDEX IF NOT EXISTS messages_name_time ON messages (name, time);
+CREATE INDEX IF NOT EXISTS messages_room_time ON messages (room, time);
+CREATE VIRTUAL TABLE IF NOT EXISTS terms USING fts5 (
+    text, filename, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+"""
+
+# Words of a query; everything else is ignored so user input can never form FTS5 syntax
+WORD = re.compile(r"\w+")
+
+
+def match_expression(query):
+    # Every word must match, the last one also as a prefix so results appear while typing
+    words = WORD.findall(query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*']
+    return " AND ".join(terms)
+
+
+class SearchIndex:
+    # Full-text index over the text messages and uploaded filenames relayed by the server.
+    # Indexing only queues a row; a background thread writes the queue in one transaction
+    # every COMMIT_INTERVAL so the message path never waits on the disk. `lock` guards only the
+    # queue, `db_lock` the connection, so broadcasts never wait for a transaction or a search.
+
+    def __init__(self, path):
+        self.path = path
+        # Worker processes may share one database, so wait for each other's write transactions
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        try:
+            self.db.executescript(SCHEMA)
+        except sqlite3.OperationalError as e:
+            raise RuntimeError(f"Search needs SQLite with FTS5: {e}") from e
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.pending = []
+        self.closed = False
+        self.wakeup = threading.Event()
+        threading.Thread(target=self.commit_loop, daemon=True).start()
+
+    def add_text(self, room, name, text, offset=None):
+        with self.lock:
+            self.pending.append(("text", time.time(), room, name, text, "", offset))
+
+    def add_file(self, room, name, filename):
+        with self.lock:
+            self.pending.append(("file", time.time(), room, name, "", filename, None))
+
+    def commit(self):
+        # Write every queued row and its terms in one transaction. A row SQLite rejects must not take
+        # the rest of the batch down with it, so after such an error the rows are written one at a
+        # time and only the bad ones are skipped; errors of the database itself are raised.
+        with self.lock:
+            rows, self.pending = self.pending, []
+        if not rows:
+            return
+        with self.db_lock:
+            try:
+                self.insert(rows)
+            except sqlite3.OperationalError:
+                raise
+            except sqlite3.Error:
+                for row in rows:
+                    try:
+                        self.insert([row])
+                    except sqlite3.OperationalError:
+                        raise
+                    except sqlite3.Error as e:
+                        logger.error(f"Could not index a message from {row[3]!r} in #{row[2]}: {e}")
+
+    def insert(self, rows):
+        # Write rows and their terms in one transaction; the caller holds db_lock
+        self.db.execute("BEGIN")
+        try:
+            for row in rows:
+                cursor = self.db.execute(
+                    "INSERT INTO messages (kind, time, room, name, text, filename, offset) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    row)
+                self.db.execute("INSERT INTO terms (rowid, text, filename) VALUES (?, ?, ?)",
+                                (cursor.lastrowid, row[4], row[5]))
+            self.db.execute("COMMIT")
+        except sqlite3.Error:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def commit_loop(self):
+        while not self.closed:
+            self.wakeup.wait(COMMIT_INTERVAL)
+            try:
+                self.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Could not update the search index: {e}")
+
+    def search(self, query="", name=None, room=None, since=None, until=None, limit=MAX_RESULTS):
+        # Newest messages matching every word of `query` and the given filters. Words are looked up in
+        # the inverted index; without words, sender, room and time filters use the B-tree indexes.
+        # Messages still queued are not searched; they are at most COMMIT_INTERVAL old.
+        conditions = []
+        parameters = []
+        expression = match_expression(query)
+        if expression is not None:
+            # Walk the matching postings newest first (ids grow with time) and stop at the limit
+            source = "terms JOIN messages ON messages.id = terms.rowid"
+            order = "terms.rowid"
+            conditions.append("terms MATCH ?")
+            parameters.append(expression)
+        else:
+            source = "messages"
+            order = "messages.id"
+        for column, operator, value in (("name", "=", name), ("room", "=", room),
+                                        ("time", ">=", since), ("time", "<", until)):
+            if value is not None:
+                conditions.append(f"messages.{column} {operator} ?")
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        parameters.append(max(1, min(int(limit), MAX_RESULTS)))
+        with self.db_lock:
+            rows = self.db.execute(
+                "SELECT messages.kind, messages.time, messages.room, messages.name, messages.text, "
+                f"messages.filename, messages.offset FROM {source} {where} ORDER BY {order} DESC LIMIT ?",
+                parameters).fetchall()
+        return [{"kind": kind, "time": sent, "room": room, "name": name, "text": text,
+                 "filename": filename, "offset": offset}
+                for kind, sent, room, name, text, filename, offset in rows]
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        try:
+            self.commit()
+        finally:
+            with self.db_lock:
+                self.db.close()
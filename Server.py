@@ -1,23 +1,200 @@
 import socket
 import threading
-import json
 import os
+import asyncio
+import argparse
+import hmac
+import itertools
+import logging
+import math
+import multiprocessing
+import signal
+import tempfile
+import time
 from datetime import datetime
+from Protocol import FrameDecoder, DECODER_BUFFER_SIZE, ProtocolError, encode_message, decode_message, get_codec, CODECS, MESSAGE_FRAMES, FRAME_FILE_CHUNK, FRAME_TRANSFER_CHUNK, HEADER_SIZE, decode_transfer_chunk, encode_stream_chunk, stream_chunk_prefix, COMPRESSIONS, DEFAULT_COMPRESS_THRESHOLD, FrameCompressor, negotiate_compression, worth_compressing
+from Outbound import OutboundQueue, AsyncOutboundQueue, FileRegion, queue_totals, send_buffers, DEFAULT_HIGH_WATER, DEFAULT_SLOW_TIMEOUT, DEFAULT_COALESCE_BYTES, POLICIES, POLICY_DISCONNECT, RELAY_BACKLOG
+from Bus import BusHub, BusClient
+from History import HistoryStore, FSYNC_POLICIES, FSYNC_BATCH, DEFAULT_SEGMENT_SIZE
+from Search import SearchIndex, MAX_RESULTS
+from Blobs import BlobStore, valid_digest, valid_transfer_id
+from Metrics import Metrics, serve_metrics, configure_logging, LOG_FORMATS, LOG_LEVELS
+from Profiler import Profiler, MODE_SAMPLE, DEFAULT_PROFILE_DURATION, MAX_PROFILE_DURATION, DEFAULT_SAMPLE_INTERVAL
+from Registry import ConnectionRegistry
+from RateLimit import RateLimiter, RATE_POLICIES, RATE_DELAY, LIMIT_MESSAGES, LIMIT_BYTES, TRANSFER_RETRY, TRANSFER_WAIT
+
+logger = logging.getLogger("quickchat.server")
+
+# Room every client is subscribed to when it joins, and the room used by messages that name none
+DEFAULT_ROOM = "lobby"
+
+# Routes say which connections a frame is for; they are also what workers exchange over the bus
+ROUTE_ALL = {"to": "all"}
+
+
+def room_route(room):
+    return {"to": "room", "room": room}
+
+
+def user_route(name):
+    return {"to": "user", "name": name}
+
+
+# Message types timed separately; anything else a client sends is counted as "other"
+MESSAGE_TYPES = ("text", "direct", "file", "subscribe", "unsubscribe", "file_skip", "search", "history_request",
+                 "roster_request", "admin")
+
+
+# Message fields that must be strings: names of rooms, users and files become dictionary keys and paths,
+# and text and search queries are indexed
+STRING_FIELDS = ("type", "room", "name", "to", "filename", "text", "query")
+# Room and user names are stored and listed everywhere, and room names name history directories
+NAME_FIELDS = ("room", "name", "to")
+MAX_NAME_LENGTH = 64
+
+# Reasons sent with a file_refused
+TOO_MANY_UPLOADS = "too many uploads in progress"
+FOREIGN_TRANSFER = "transfer belongs to another user"
+
+
+def check_message(message):
+    # A message from a client must be an object with a type, and its names must be strings
+    if not isinstance(message, dict) or "type" not in message:
+        raise ProtocolError("A message must be an object with a type")
+    for field in STRING_FIELDS:
+        if field in message and not isinstance(message[field], str):
+            raise ProtocolError(f"Message field {field!r} must be a string")
+    for field in NAME_FIELDS:
+        if len(message.get(field, "")) > MAX_NAME_LENGTH:
+            raise ProtocolError(f"Message field {field!r} is longer than {MAX_NAME_LENGTH} characters")
+    return message
+
+
+def message_labels(message):
+    # Metric labels of a client message, from a fixed set
+    message_type = message.get("type")
+    return (("type", message_type if message_type in MESSAGE_TYPES else "other"),)
+
+
+def item_size(item):
+    # Bytes a queued item puts on the wire before compression, file regions included
+    if isinstance(item, tuple):
+        return sum(item_size(part) for part in item)
+    return item.count if isinstance(item, FileRegion) else len(item)
+
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=8888):
+    # Each connection is served by its own threads, so a cProfile session records the calls of every
+    # reader thread while it processes a message
+    profile_whole_thread = False
+
+    def __init__(self, host='0.0.0.0', port=8888, backlog=socket.SOMAXCONN, file_window=256 * 1024, file_delivery="stream",
+                 queue_high_water=DEFAULT_HIGH_WATER, slow_consumer_policy=POLICY_DISCONNECT,
+                 slow_consumer_timeout=DEFAULT_SLOW_TIMEOUT, codec="json", reuse_port=False,
+                 bus_path=None, worker_id=0, history_dir=None, history_backfill=50, history_fsync=FSYNC_BATCH,
+                 history_fsync_interval=1.0, history_segment_size=DEFAULT_SEGMENT_SIZE, search_db=None,
+                 compression="auto", compress_threshold=DEFAULT_COMPRESS_THRESHOLD, metrics_host="127.0.0.1",
+                 metrics_port=None, admin_token=None, profile_dir="profiles", tcp_nodelay=True,
+                 coalesce_bytes=DEFAULT_COALESCE_BYTES, coalesce_window=0.0, rate_policy=RATE_DELAY,
+                 message_rate=None, upload_rate=None, max_uploads=None, global_message_rate=None,
+                 global_upload_rate=None, global_max_uploads=None):
         # Initialize server with host and port
         self.host = host
         self.port = port
-        # List to store client connections
-        self.clients = []
-        self.client_names = {}  # Maps client sockets to names
+        self.backlog = backlog
+        # Several worker processes can share the port with SO_REUSEPORT
+        self.reuse_port = reuse_port
+        # Largest frame accepted from a client, which bounds the memory held per file transfer
+        self.file_window = file_window
+        # "stream" relays chunks while they are uploaded, "sendfile" serves the stored copy once complete
+        self.file_delivery = file_delivery
+        # Outbound queue limits: bytes a client may fall behind, what to do past that, and how long file transfers wait
+        self.queue_high_water = queue_high_water
+        self.slow_consumer_policy = slow_consumer_policy
+        self.slow_consumer_timeout = slow_consumer_timeout
+        # Writers send the frames queued for a client together, up to coalesce_bytes in one sendmsg, and may
+        # wait coalesce_window seconds for more to arrive. Small frames go out at once unless tcp_nodelay is off.
+        self.tcp_nodelay = tcp_nodelay
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_window = coalesce_window
+        # Codec used for every message frame the server sends
+        self.codec = get_codec(codec)
+        # Compression methods clients may negotiate when they join ("auto" allows every available one)
+        # and one shared compressor per method; each session holds the one its client negotiated
+        if compression not in ("auto", "none") and compression not in COMPRESSIONS:
+            raise ValueError(f"Compression {compression!r} is not available")
+        self.compression = None if compression == "auto" else () if compression == "none" else (compression,)
+        self.compress_threshold = compress_threshold
+        self.frame_compressors = {name: FrameCompressor(method, compress_threshold) for name, method in COMPRESSIONS.items()}
+        # Every live connection and its session: name, outbound queue, frame decoder, compressor and rooms
+        self.registry = ConnectionRegistry()
+        # Every join or leave bumps the roster version; clients apply deltas and resync on a gap
+        self.roster_version = 0
+        self.roster_lock = threading.Lock()
+        # Subscription index: room name -> frozenset of connections, replaced (never mutated) under
+        # rooms_lock so fan-out can iterate a room without locking. names indexes connections by user.
+        self.rooms = {}
+        self.names = {}  # Maps user names to the frozenset of their connections
+        self.rooms_lock = threading.Lock()
+        # When running as one of several workers, traffic is also published on a bus and the roster
+        # is owned by the bus hub; global_roster mirrors it and pending_joins await their version.
+        self.bus_path = bus_path
+        self.worker_id = worker_id
+        self.bus = None
+        self.global_roster = []
+        self.pending_joins = {}
+        # Durable per-room history of text messages, replayed to clients when they join or subscribe
+        self.history = None
+        if history_dir is not None:
+            self.history = HistoryStore(history_dir, history_segment_size, history_fsync, history_fsync_interval)
+        # Messages replayed to a client that does not say how many it wants
+        self.history_backfill = history_backfill
+        # Full-text index of text messages and uploaded filenames; worker processes can share one database
+        self.search_index = SearchIndex(search_db) if search_db is not None else None
+        # Uploads are stored once per distinct content and listed under their names as hard links
+        self.blobs = BlobStore("files")
+        self.blobs.prune_partials()
+        # Transfers in progress by announced digest, each with the set of recipients that already have it
+        self.transfers = {}
+        # Ids of resumable uploads currently being received, so one cannot be resumed twice at once
+        self.active_uploads = set()
+        # Files are sent to clients as numbered streams so several can share a connection
+        self.stream_ids = itertools.count(1)
+        self.transfers_lock = threading.Lock()
+        # Counters and latency histograms of the hot paths, served over HTTP when a metrics port is given
+        self.metrics = Metrics()
+        self.metrics.gauge("connections", lambda: len(self.registry))
+        self.metrics.gauge("uploads_active", lambda: len(self.active_uploads))
+        self.metrics.gauge("outbound", self.outbound_stats)
+        # Token buckets limiting the messages and upload bytes a connection, and all of them together, may
+        # send per second, and counts of concurrent uploads per user and in total; all limits are off by default
+        self.limiter = RateLimiter(self.metrics, rate_policy, message_rate, upload_rate, max_uploads,
+                                   global_message_rate, global_upload_rate, global_max_uploads,
+                                   byte_burst=file_window)
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # Operator commands such as profiling are accepted from clients that present this token (never without one)
+        self.admin_token = admin_token
+        self.profiler = Profiler(profile_dir, "profile" if bus_path is None else f"profile-worker{worker_id}")
         # Server socket
         self.server_socket = None
         self.setup_socket()
 
     def log_error(self, error_message):
-        print(f"ERROR: {error_message}")
+        logger.error(error_message)
+
+    def start_metrics(self):
+        # Serve the metrics endpoint; workers sharing a port each use the metrics port plus their id
+        if self.metrics_port is not None:
+            try:
+                self.metrics_server = serve_metrics(self.metrics, self.metrics_host, self.metrics_port + self.worker_id)
+            except OSError as e:
+                self.log_error(f"Could not serve metrics on port {self.metrics_port + self.worker_id}: {e}")
+
+    def count_received(self, size):
+        self.metrics.count("recv_calls")
+        self.metrics.count("recv_bytes", size)
 
     def setup_socket(self):
         try:
@@ -25,73 +202,485 @@ class ChatServer:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # Reuse address to avoid 'address already in use' error
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                # Let the kernel balance connections across worker processes bound to the same port
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             # Bind the socket to host and port
             self.server_socket.bind((self.host, self.port))
-            # Listen for connections, allowing up to 5 pending connections
-            self.server_socket.listen(5)
-            print(f"Server is listening on {self.host}:{self.port}")
+            # Listen for connections, allowing up to `backlog` pending connections; a short backlog
+            # overflows when many clients connect at once and each refused SYN costs a second to retry
+            self.server_socket.listen(self.backlog)
+            logger.info(f"Server is listening on {self.host}:{self.port}")
         except Exception as e:
             self.log_error(f"Failed to set up server socket: {e}")
     
 
     def accept_connections(self):
         # Accept incoming connections
+        self.start_bus()
+        self.start_metrics()
         try:
             while True:
                 client_socket, client_address = self.server_socket.accept()
-                self.clients.append(client_socket)
-                print(f"Accepted connection from {client_address}")
+                start = time.perf_counter()
+                self.set_nodelay(client_socket)
+                queue = self.create_queue()
+                self.registry.add(client_socket, client_address, queue, self.create_decoder(),
+                                  self.limiter.connection_limits())
+                logger.info(f"Accepted connection from {client_address}")
+
+                # Each client's writes happen on its own writer thread, so a stalled reader only stalls itself
+                writer_thread = threading.Thread(target=self.write_loop, args=(client_socket, queue), daemon=True)
+                writer_thread.start()
 
                 # Handle each client in a separate thread
                 client_thread = threading.Thread(target=self.handle_client, args=(client_socket, client_address))
                 client_thread.start()
+                self.metrics.count("connections_accepted")
+                self.metrics.observe("accept", time.perf_counter() - start)
         except Exception as e:
             self.log_error(f"Error accepting connections: {e}")
 
-    def handle_client(self, client_socket, address):
-        # Receive the client's name
-        client_name = client_socket.recv(1024).decode()
-        print(f"{client_name} has joined the chat.")
-        # Broadcast system message when a user joins
-        self.broadcast_system_message(f"{client_name} has joined the chat.", client_socket)
-        self.client_names[client_socket] = client_name
-        self.broadcast_user_list()
-
-        while True:
+    def set_nodelay(self, sock):
+        # Disable Nagle's algorithm, which holds back a small write until the previous one is acknowledged
+        # and so delays the replies to a join by the peer's delayed ACK; writers coalesce frames themselves
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.tcp_nodelay else 0)
+        except OSError:
+            pass
+
+    def create_queue(self):
+        # Outbound queue for a new connection
+        return OutboundQueue(self.queue_high_water, self.slow_consumer_policy)
+
+    def write_loop(self, client_socket, queue):
+        # Drain a client's outbound queue onto its socket
+        try:
+            while True:
+                batch = queue.get_batch(self.coalesce_bytes, self.coalesce_window)
+                if batch is None:
+                    break
+                self.write_batch(client_socket, batch)
+        except OSError as e:
+            if not queue.closed:
+                self.log_error(f"Error writing to {client_socket}: {e}")
+        finally:
+            queue.close()
+            if queue.evicted:
+                self.log_error(f"Evicted slow consumer {self.connection_name(client_socket)}")
+            # Wake the client's reader thread so it cleans up the connection
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def write_batch(self, client_socket, batch):
+        # Write a batch of queued frames with one sendmsg, and a file region that ends it with sendfile
+        region = batch.pop() if isinstance(batch[-1], FileRegion) else None
+        if batch:
+            send_buffers(client_socket, batch)
+            self.metrics.count("writes")
+            self.metrics.count("frames_written", len(batch))
+        if region is not None:
+            region.send(client_socket)
+
+    def outbound_stats(self):
+        # Aggregate queue depth and drop/eviction counters over all connections
+        return queue_totals([session.queue for session in self.registry.all_sessions()])
+
+    def connection_name(self, client):
+        # User name of a connection for log messages, or the connection itself before it joined
+        session = self.registry.get(client)
+        return session.name if session is not None and session.name is not None else client
+
+    def drop_connection(self, client):
+        # Stop serving a connection that failed or was evicted. Shutting the socket down wakes a writer
+        # blocked on a stalled peer as well as the connection's reader, which removes it from the registry.
+        session = self.registry.get(client)
+        if session is not None:
+            session.queue.close()
             try:
-                data = client_socket.recv(1024).decode("utf-8")
-                if not data:
-                    # Broadcast system message when a user leaves
-                    self.broadcast_system_message(f"{client_name} has left the chat.", client_socket)
-                    print(f"{client_name} disconnected.")
-                    del self.client_names[client_socket]  # Remove client from the names list
-                    self.broadcast_user_list()  # Broadcast updated user list
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def create_decoder(self):
+        # Each connection gets a small receive buffer that grows to at most one file window while a chunk arrives
+        return FrameDecoder(DECODER_BUFFER_SIZE, self.file_window)
+
+    def read_frame(self, client_socket):
+        # Block until the client's decoder holds a complete frame; None means the peer closed
+        decoder = self.registry.get(client_socket).decoder
+        frame = decoder.next_frame()
+        while frame is None:
+            received = decoder.recv_into(client_socket)
+            if not received:
+                return None
+            self.count_received(received)
+            frame = decoder.next_frame()
+        return frame
+
+    def read_message(self, client_socket):
+        # Read the next frame and decode it as a JSON message
+        frame = self.read_frame(client_socket)
+        if frame is None:
+            return None
+        return self.parse_message(frame)
+
+    def parse_message(self, frame):
+        # Decode a message frame, timing the decode
+        frame_type, payload = frame
+        if frame_type not in MESSAGE_FRAMES:
+            raise ProtocolError(f"Expected a message frame, got frame type {frame_type}")
+        start = time.perf_counter()
+        message = check_message(decode_message(payload, frame_type))
+        self.metrics.observe("parse", time.perf_counter() - start)
+        return message
+
+    def handle_client(self, client_socket, address):
+        client_name = None
+        try:
+            # Receive the client's name
+            join = self.read_message(client_socket)
+            if join is None or join.get("type") != "join":
+                raise ProtocolError("Expected a join message")
+            client_name = join["name"]
+            self.negotiate_capabilities(client_socket, join)
+            logger.info(f"{client_name} has joined the chat.", extra={"address": address})
+            # Broadcast system message when a user joins
+            self.broadcast_system_message(f"{client_name} has joined the chat.", client_socket)
+            self.announce_join(client_socket, client_name, join)
+
+            while True:
+                message = self.read_message(client_socket)
+                if message is None:
                     break
+                if not self.admit_message(client_socket):
+                    continue
+                start = time.perf_counter()
+                session = self.profiler.session
+                profile = session.profile() if session is not None else None
+                if profile is None:
+                    self.process_message(client_socket, client_name, message)
+                else:
+                    profile.runcall(self.process_message, client_socket, client_name, message)
+                self.message_processed(message, time.perf_counter() - start, session)
+
+        except (ValueError, KeyError, TypeError, ProtocolError, ConnectionError) as e:
+            logger.warning(f"Error: {e}", extra={"client": client_name, "address": address})
+        except Exception:
+            logger.exception("Unexpected error serving a client", extra={"client": client_name, "address": address})
+        finally:
+            self.close_client(client_socket, client_name)
+            client_socket.close()
+
+    def close_client(self, client_socket, client_name):
+        # Take a departing client out of the roster and its rooms, then out of the registry; the registry
+        # entry goes even if announcing the departure fails, so nothing of the connection is left behind
+        try:
+            if self.registry.get(client_socket).name is not None:
+                # Broadcast system message when a user leaves
+                self.broadcast_system_message(f"{client_name} has left the chat.", client_socket)
+                logger.info(f"{client_name} disconnected.")
+                self.announce_leave(client_socket, client_name)  # Remove client from the roster
+        finally:
+            self.registry.remove(client_socket).queue.close()
+
+    def negotiate_capabilities(self, client_socket, join):
+        # Answer the capabilities a client offered in its join message. The reply goes out uncompressed;
+        # everything queued after it is compressed with the method chosen, if any.
+        name = negotiate_compression(join.get("compression"), self.compression)
+        self.send_data(client_socket, self.encode({"type": "capabilities", "compression": name,
+                                                   "compress_threshold": self.compress_threshold}))
+        if name is not None:
+            self.registry.get(client_socket).compressor = self.frame_compressors[name]
+
+    def message_processed(self, message, elapsed, session):
+        # Record how long processing a message took, also in the profiling session running while it started
+        labels = message_labels(message)
+        self.metrics.observe("process_message", elapsed, labels)
+        if session is not None:
+            session.record(labels[0][1], elapsed)
 
-                message = json.loads(data)
-                self.process_message(client_socket, client_name, message)
+    def admit_message(self, client_socket):
+        # Apply the message rate limits before a message is processed, waiting if need be; False when the
+        # message is discarded. Raises ConnectionError when the client is to be disconnected.
+        delay = self.limiter.admit(self.registry.get(client_socket).limits, LIMIT_MESSAGES)
+        if delay:
+            time.sleep(delay)
+        return delay is not None
 
-            except (json.JSONDecodeError, UnicodeDecodeError, ConnectionError) as e:
-                print(f"Error: {e}")
-                break
+    def throttle_upload(self, client_socket, size):
+        # Apply the upload byte rate limits to a received chunk before it is forwarded
+        delay = self.limiter.admit(self.registry.get(client_socket).limits, LIMIT_BYTES, size)
+        if delay:
+            time.sleep(delay)
 
-        # Remove client from the list and close the connection
-        self.clients.remove(client_socket)
-        client_socket.close()
+    def claim_transfer(self, client_socket, client_name, message):
+        # Take an upload slot for a user, waiting up to TRANSFER_WAIT for one under the delay policy;
+        # False when the upload is refused
+        if self.limiter.start_transfer(client_name):
+            return True
+        if not self.limiter.refuse_transfer():
+            return False
+        self.queue_upload(client_socket, message)
+        deadline = time.monotonic() + TRANSFER_WAIT
+        while not self.limiter.start_transfer(client_name):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(TRANSFER_RETRY)
+        return True
+
+    def queue_upload(self, client_socket, message):
+        # Tell the sender of a resumable upload that it waits for a slot, and for how long at most, so it
+        # does not take the wait for a lost connection
+        if message.get("transfer") is not None:
+            self.send_data(client_socket, self.encode({"type": "file_queued", "transfer": message["transfer"],
+                                                       "timeout": TRANSFER_WAIT}))
 
     def process_message(self, client_socket, client_name, message):
         # Process and dispatch messages based on their type
+        if message["type"] == "file":
+            if self.foreign_transfer(client_name, message):
+                self.refuse_upload(client_socket, client_name, message, FOREIGN_TRANSFER)
+                return
+            if not self.claim_transfer(client_socket, client_name, message):
+                self.refuse_upload(client_socket, client_name, message)
+                return
+            # Receive, save, and forward files
+            try:
+                self.relay_file(client_socket, client_name, message)
+            finally:
+                self.limiter.end_transfer(client_name)
+        else:
+            self.dispatch_message(client_socket, client_name, message)
+
+    def refuse_upload(self, client_socket, client_name, message, reason=TOO_MANY_UPLOADS):
+        # Turn an upload down, by default because too many are in progress. Senders of resumable uploads
+        # wait for an answer before sending any data; the chunks of other uploads are read and discarded.
+        logger.info(f"Refused upload of {message['filename']} from {client_name}: {reason}")
+        if message.get("transfer") is not None:
+            self.send_data(client_socket, self.encode({"type": "file_refused", "transfer": message["transfer"],
+                                                       "reason": reason}))
+        if not self.awaits_resume(message):
+            self.discard_upload(client_socket, client_name, message)
+
+    def awaits_resume(self, message):
+        # Whether the sender of an upload waits for a file_resume before sending its chunks
+        return message.get("transfer") is not None and "sha256" in message
+
+    def discard_upload(self, client_socket, client_name, message):
+        # Read the chunks of a refused upload without storing or forwarding them
+        received = 0
+        while received < message["length"]:
+            frame = self.read_raw_frame(client_socket)
+            if frame is None:
+                raise ConnectionError("File transfer interrupted")
+            if frame[0] in MESSAGE_FRAMES:
+                message_in_upload = self.interleaved_message(frame)
+                if self.admit_message(client_socket):
+                    self.dispatch_message(client_socket, client_name, message_in_upload)
+                continue
+            received += len(self.check_file_chunk(frame, received, message["length"]))
+
+    def dispatch_message(self, client_socket, client_name, message):
+        # Handle every message type that does not read further frames from the client
         message_type = message["type"]
 
         if message_type == "text":
-            # Broadcast text messages to all clients
+            # Broadcast text messages to the subscribers of the message's room
             self.broadcast_text(client_name, message, client_socket)
-        elif message_type == "file":
-            # Receive, save, and forward files
-            file_data = self.receive_file(client_socket, message["length"])
-            if file_data:
-                self.save_file(client_name, file_data, message['filename'])
-                self.forward_file(client_socket, client_name, file_data, message)
+        elif message_type == "direct":
+            self.send_direct(client_socket, client_name, message)
+        elif message_type == "subscribe":
+            self.subscribe(client_socket, message["room"], message)
+        elif message_type == "unsubscribe":
+            self.unsubscribe(client_socket, message["room"])
+        elif message_type == "file_skip":
+            self.skip_file(client_socket, message)
+        elif message_type == "search":
+            self.send_search_results(client_socket, message)
+        elif message_type == "history_request":
+            self.send_history_page(client_socket, message)
+        elif message_type == "admin":
+            self.handle_admin(client_socket, client_name, message)
+        elif message_type == "roster_request":
+            # The client missed a presence delta and needs a fresh snapshot
+            with self.roster_lock:
+                self.send_user_list(client_socket)
+
+    def handle_admin(self, client_socket, client_name, message):
+        # Operator commands; the reply goes back to the sender as a system message
+        token = message.get("token")
+        if (self.admin_token is None or not isinstance(token, str)
+                or not hmac.compare_digest(token.encode(), self.admin_token.encode())):
+            logger.warning(f"Rejected admin command from {client_name}")
+            self.send_system_message("Not authorized.", client_socket)
+            return
+        command = message.get("command")
+        if command == "profile_start":
+            # The client sends what the operator typed, so numbers may arrive as strings
+            try:
+                duration = float(message.get("duration", DEFAULT_PROFILE_DURATION))
+                interval = float(message.get("interval", DEFAULT_SAMPLE_INTERVAL))
+            except (TypeError, ValueError):
+                duration = interval = math.nan
+            # NaN would slip past the clamps in start_profiling
+            if not (math.isfinite(duration) and math.isfinite(interval) and duration > 0 and interval > 0):
+                reply = "duration and interval must be positive numbers of seconds."
+            else:
+                reply = self.start_profiling(message.get("mode", MODE_SAMPLE), duration, interval)
+        elif command == "profile_stop":
+            paths = self.stop_profiling()
+            reply = "Profiling is not running." if paths is None else f"Profile written to {', '.join(paths)}"
+        else:
+            reply = f"Unknown admin command {command!r}."
+        self.send_system_message(reply, client_socket)
+
+    def start_profiling(self, mode=MODE_SAMPLE, duration=DEFAULT_PROFILE_DURATION, interval=DEFAULT_SAMPLE_INTERVAL):
+        # Start a profiling session that stops by itself after `duration` seconds; returns a status line
+        duration = min(max(duration, 0.1), MAX_PROFILE_DURATION)
+        try:
+            session = self.profiler.start(mode, self.profile_whole_thread, max(interval, 0.001))
+        except ValueError as e:
+            return f"{e}."
+        self.schedule_profile_stop(duration, session)
+        logger.info(f"Profiling ({mode}) for up to {duration:g} seconds")
+        return f"Profiling ({mode}) for up to {duration:g} seconds."
+
+    def schedule_profile_stop(self, duration, session):
+        timer = threading.Timer(duration, self.stop_profiling, (session,))
+        timer.daemon = True
+        timer.start()
+
+    def stop_profiling(self, session=None):
+        # Stop profiling (only `session`, when given) and write the results; returns their paths
+        try:
+            paths = self.profiler.stop(session)
+        except OSError as e:
+            self.log_error(f"Could not write profile: {e}")
+            return []
+        if paths is not None:
+            logger.info(f"Profile written to {', '.join(paths)}")
+        return paths
+
+    def subscribe(self, client_socket, room, request=None):
+        # Add a connection to a room's subscriber set, first replaying the history it asked for
+        if self.history is None:
+            self.add_subscriber(client_socket, room)
+            return
+        log = self.history.log(room)
+        with log.lock:
+            # No message can be recorded in between, so the client neither misses nor repeats one
+            self.send_history(client_socket, room, log, request or {})
+            self.add_subscriber(client_socket, room)
+
+    def add_subscriber(self, client_socket, room):
+        with self.rooms_lock:
+            self.rooms[room] = self.rooms.get(room, frozenset()) | {client_socket}
+            self.registry.get(client_socket).rooms.add(room)
+
+    def send_history(self, client_socket, room, log, request):
+        # Replay the last `history` messages of a room, or those from offset `since` on, then a marker with
+        # the cursor the client passes as `since` next time. The frames are queued as one contiguous block.
+        since = request.get("since")
+        since = None if since is None else int(since)
+        last = int(request.get("history", self.history_backfill))
+        frames, count, cursor = log.backfill(last=last, since=since)
+        if frames:
+            self.send_data(client_socket, frames, bulk=True)
+        self.send_data(client_socket, self.encode({"type": "history", "room": room, "count": count, "cursor": cursor}))
+
+    def send_history_page(self, client_socket, request):
+        # Replay the `history` messages of a room preceding offset `before`, for a client scrolling back past
+        # what it still has. The marker echoes `before` and its cursor is the offset of the oldest message sent.
+        room = request["room"]
+        before = int(request["before"])
+        frames, count = b"", 0
+        if self.history is not None:
+            last = int(request.get("history", self.history_backfill))
+            frames, count, before = self.history.log(room).backfill(last=last, before=before)
+        if frames:
+            self.send_data(client_socket, frames, bulk=True)
+        self.send_data(client_socket, self.encode({"type": "history", "room": room, "count": count,
+                                                   "before": before, "cursor": before - count}))
+
+    def unsubscribe(self, client_socket, room):
+        # Remove a connection from a room, dropping the room once it is empty
+        with self.rooms_lock:
+            subscribers = self.rooms.get(room, frozenset()) - {client_socket}
+            if subscribers:
+                self.rooms[room] = subscribers
+            else:
+                self.rooms.pop(room, None)
+            session = self.registry.get(client_socket)
+            if session is not None:
+                session.rooms.discard(room)
+
+    def unsubscribe_all(self, client_socket):
+        # Remove a disconnecting client from every room it joined
+        for room in list(self.registry.get(client_socket).rooms):
+            self.unsubscribe(client_socket, room)
+
+    def local_recipients(self, route):
+        # Connections in this process that a route addresses
+        destination = route["to"]
+        if destination == "room":
+            return self.rooms.get(route["room"], ())
+        if destination == "user":
+            return self.names.get(route["name"], ())
+        return self.registry.connections()
+
+    def room_recipients(self, message, sender_socket):
+        # Local subscribers of the room a message is addressed to, except the sender
+        route = room_route(message.get("room", DEFAULT_ROOM))
+        return [client for client in self.local_recipients(route) if client != sender_socket]
+
+    def user_online(self, name):
+        # Whether a user is connected to this server (or to any worker when sharded)
+        if self.bus is not None:
+            return name in self.global_roster
+        return name in self.names
+
+    def send_direct(self, client_socket, client_name, message):
+        # Deliver a private message to every connection of the named user
+        if not self.user_online(message["to"]):
+            self.send_system_message(f"No user named {message['to']} is connected.", client_socket)
+            return
+        direct = {
+            "timestamp": datetime.now().strftime("%H:%M:%S"),
+            "name": client_name,
+            "to": message["to"],
+            "text": message["text"],
+            "type": "direct"
+        }
+        self.broadcast(direct, client_socket, user_route(message["to"]))
+
+    def find_messages(self, message):
+        # Results of a search request; reads the index, so this may block on SQLite
+        return self.search_index.search(
+            message.get("query", ""), name=message.get("name"), room=message.get("room"),
+            since=message.get("since"), until=message.get("until"), limit=message.get("limit", MAX_RESULTS))
+
+    def send_search_results(self, client_socket, message, results=None):
+        # Answer a search request from the index; the request's id is echoed so clients can match replies
+        if self.search_index is None:
+            self.send_system_message("Search is not enabled on this server.", client_socket)
+            return
+        if results is None:
+            results = self.find_messages(message)
+        reply = {"type": "search_results", "id": message.get("id"), "query": message.get("query", ""), "results": results}
+        self.send_data(client_socket, self.encode(reply))
+
+    def index_upload(self, client_name, message):
+        # Make a completed upload findable by its filename
+        if self.search_index is not None:
+            self.search_index.add_file(message.get("room", DEFAULT_ROOM), client_name, os.path.basename(message["filename"]))
+
+    def send_system_message(self, text, client_socket):
+        # Send a system message to a single client
+        message = {"timestamp": datetime.now().strftime("%H:%M:%S"), "text": text, "type": "system"}
+        self.send_data(client_socket, self.encode(message))
 
     def broadcast_system_message(self, text, client_socket):
         # Broadcast system messages (e.g., user joined, user left)
@@ -103,96 +692,907 @@ class ChatServer:
         }
         self.broadcast(broadcast_data, client_socket)
 
-    def broadcast_user_list(self):
-        # Broadcasts the list of connected users to all clients
-        user_list = list(self.client_names.values())
-        message = {"type": "user_list", "users": user_list}
-        self.broadcast(message, None)  # Send to all clients
+    def announce_join(self, client_socket, client_name, join=None):
+        # Add a user to the roster: other clients get a join delta, the new client a full snapshot
+        # and the lobby history its join message asked for
+        with self.roster_lock:
+            self.registry.get(client_socket).name = client_name
+            with self.rooms_lock:
+                self.names[client_name] = self.names.get(client_name, frozenset()) | {client_socket}
+            self.subscribe(client_socket, DEFAULT_ROOM, join)
+            if self.bus is not None:
+                # The hub versions the join and echoes it back to every worker, see apply_remote_presence
+                self.pending_joins[id(client_socket)] = client_socket
+                self.bus.publish({"to": "presence", "op": "join", "name": client_name, "conn": id(client_socket)})
+                return
+            self.roster_version += 1
+            self.broadcast({"type": "presence", "op": "join", "name": client_name, "version": self.roster_version}, client_socket)
+            self.send_user_list(client_socket)
+
+    def announce_leave(self, client_socket, client_name):
+        # Remove a user from the roster and send everyone else a leave delta
+        with self.roster_lock:
+            self.registry.get(client_socket).name = None
+            with self.rooms_lock:
+                remaining = self.names.get(client_name, frozenset()) - {client_socket}
+                if remaining:
+                    self.names[client_name] = remaining
+                else:
+                    self.names.pop(client_name, None)
+            self.unsubscribe_all(client_socket)
+            if self.bus is not None:
+                self.pending_joins.pop(id(client_socket), None)
+                self.bus.publish({"to": "presence", "op": "leave", "name": client_name})
+                return
+            self.roster_version += 1
+            self.broadcast({"type": "presence", "op": "leave", "name": client_name, "version": self.roster_version}, client_socket)
+
+    def send_user_list(self, client_socket):
+        # Send one client a snapshot of the connected users; sent on join and when a client reports a version gap
+        users = list(self.global_roster) if self.bus is not None else self.registry.names()
+        message = {"type": "user_list", "users": users, "version": self.roster_version}
+        self.send_data(client_socket, self.encode(message))
 
     def broadcast_text(self, client_name, message, sender_socket):
-        # Broadcast text messages to all clients except the sender
+        # Broadcast a text message to the other subscribers of its room
         timestamp = datetime.now().strftime("%H:%M:%S")
+        room = message.get("room", DEFAULT_ROOM)
         broadcast_data = {
             "timestamp": timestamp,
             "name": client_name,
+            "room": room,
             "text": message['text'],
             "type": message["type"]
         }
-        # Debug print the message
-        print(f"(Debugging) {timestamp} - {client_name}: {message['text']}")
-        self.broadcast(broadcast_data, sender_socket)
+        logger.debug("%s - #%s %s: %s", timestamp, room, client_name, message['text'])
+        if self.history is None:
+            self.broadcast(broadcast_data, sender_socket, room_route(room))
+        else:
+            log = self.history.log(room)
+            with log.lock:
+                # Recorded and queued under the room's history lock, see subscribe
+                frame = self.history.record(room, broadcast_data, self.encode)
+                self.broadcast_frame(frame, sender_socket, room_route(room))
+        if self.search_index is not None:
+            self.search_index.add_text(room, client_name, broadcast_data["text"], broadcast_data.get("offset"))
+
+    def encode(self, message):
+        # Encode a message with the server's codec
+        return encode_message(message, self.codec)
 
-    def broadcast(self, message, sender_socket):
-        # Send a message to all connected clients except the sender
-        for client in self.clients:
+    def broadcast(self, message, sender_socket, route=ROUTE_ALL):
+        # Send a message to the clients a route addresses (all connected clients by default) except the sender.
+        # The frame is encoded once and the same immutable bytes are queued for every recipient.
+        self.broadcast_frame(self.encode(message), sender_socket, route)
+
+    def broadcast_frame(self, frame, sender_socket, route=ROUTE_ALL):
+        # Send an already encoded frame to local recipients and to the other workers
+        self.send_route(route, frame, sender_socket)
+        self.publish(route, frame)
+
+    def send_route(self, route, frame, sender_socket=None, bulk=False):
+        # Queue an encoded frame for every local connection a route addresses. Bulk routes carry
+        # file transfers from other workers, which yield to chat frames. Their sender only waits for
+        # its own recipients, so recipients here that fall RELAY_BACKLOG high water marks behind are evicted.
+        start = time.perf_counter()
+        limit = RELAY_BACKLOG * self.queue_high_water if bulk else None
+        delivered = 0
+        # Room and user sets and the registry snapshot are immutable, so they are iterated without copying
+        for client in self.local_recipients(route):
             if client != sender_socket:
+                delivered += 1
                 try:
-                    client.send(json.dumps(message).encode())
+                    self.send_data(client, frame, bulk, background=bulk, compress=route.get("compress", True), limit=limit)
+                except ConnectionError:
+                    # Closed or evicted, and already dropped; its writer logs an eviction once and its
+                    # reader unregisters it
+                    pass
                 except Exception as e:
                     # Remove the client if message sending fails
                     self.log_error(f"Error broadcasting to {client}, removing: {e}")
-                    self.clients.remove(client)
+                    self.drop_connection(client)
+        self.metrics.count("fanout_deliveries", delivered)
+        self.metrics.observe("fanout", time.perf_counter() - start)
 
-    def receive_file(self, client_socket, data_length):
-        # Receive a file from a client
-        data = b''
-        try:
-            while len(data) < data_length:
-                packet = client_socket.recv(1024)
-                if not packet:
-                    raise ConnectionError("File transfer interrupted")
-                data += packet
-            if len(data) != data_length:
-                raise ValueError("File data incomplete")
-        except Exception as e:
-            self.log_error(f"Error receiving file: {e}")
-            return None
-        return data
+    def start_bus(self):
+        # Join the worker bus when running as one of several processes
+        if self.bus_path is not None:
+            self.bus = BusClient(self.bus_path, self.worker_id, self.on_bus_message)
 
-    def save_file(self, client_name, file_data, filename):
-        # Save received files in a designated directory
-        try:
-            directory = "files"
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-            
-            file_path = os.path.join(directory, f"{client_name}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}")
-            with open(file_path, 'wb') as file:
-                file.write(file_data)
-            print(f"File received and saved to {file_path}")
-        except Exception as e:
-            self.log_error(f"Error saving file: {e}")
+    def publish(self, route, frame):
+        # Hand a frame to the other workers, which deliver it to their own clients on the same route
+        if self.bus is not None:
+            self.bus.publish(route, frame)
+
+    def on_bus_message(self, route, frame):
+        # Deliver traffic published by another worker, or roster updates from the hub
+        destination = route["to"]
+        if destination == "roster":
+            with self.roster_lock:
+                self.global_roster = list(route["users"])
+                self.roster_version = route["version"]
+        elif destination == "presence":
+            self.apply_remote_presence(route)
+        elif "file" in route:
+            # A stored upload on the shared files/ directory, served with sendfile like a local one
+            self.deliver_file(list(self.local_recipients(route)), route["file"], frame, route["stream"])
+        else:
+            self.send_route(route, frame, bulk=route.get("bulk", False))
+
+    def apply_remote_presence(self, route):
+        # Apply a join/leave sequenced by the hub and pass the delta on to local clients
+        with self.roster_lock:
+            name = route["name"]
+            if route["op"] == "join":
+                self.global_roster.append(name)
+            elif name in self.global_roster:
+                self.global_roster.remove(name)
+            self.roster_version = route["version"]
+            joiner = None
+            if route["op"] == "join" and route["worker"] == self.worker_id:
+                joiner = self.pending_joins.pop(route["conn"], None)
+            frame = self.encode({"type": "presence", "op": route["op"], "name": name, "version": self.roster_version})
+            self.send_route(ROUTE_ALL, frame, joiner)
+            if joiner is not None:
+                # The joining client gets a snapshot that already includes itself
+                try:
+                    self.send_user_list(joiner)
+                except ConnectionError:
+                    pass
+
+    def send_data(self, client, data, bulk=False, background=False, compress=True, limit=None):
+        # Queue bytes for a client's writer. Raises if the client is gone or was evicted as a slow
+        # consumer; under the drop policy a frame past the high water mark is silently discarded.
+        # Background data (file transfers) is only written while no chat frame is waiting.
+        # Frames are compressed for clients that negotiated it, unless `compress` is false.
+        # Bulk data past `limit` queued bytes evicts the client.
+        session = self.registry.get(client)
+        if session is None or session.queue.closed:
+            raise ConnectionError("Connection closed")
+        queue = session.queue
+        compressor = session.compressor if compress else None
+        if compressor is not None and isinstance(data, bytes):
+            data = compressor.compress(data)
+        if not queue.put(data, bulk, background, limit) and queue.closed:
+            # Evicted by this frame: disconnect the client now rather than when its writer gets to it
+            self.drop_connection(client)
+            raise ConnectionError("Evicted as a slow consumer" if queue.evicted else "Connection closed")
+
+    def drain(self, recipients):
+        # Wait for recipients to work through their backlog so a file transfer never queues
+        # much more than the high water mark per client; recipients that stay stalled are evicted
+        for client in list(recipients):
+            session = self.registry.get(client)
+            if session is None or not session.queue.wait_for_space(self.slow_consumer_timeout):
+                self.log_error(f"Error forwarding file to client {client}: evicted as a slow consumer")
+                recipients.remove(client)
+                self.drop_connection(client)
+
+    def read_raw_frame(self, client_socket):
+        # Like read_frame, but return the whole encoded frame so it can be relayed as is
+        decoder = self.registry.get(client_socket).decoder
+        frame = decoder.next_raw_frame()
+        while frame is None:
+            received = decoder.recv_into(client_socket)
+            if not received:
+                return None
+            self.count_received(received)
+            frame = decoder.next_raw_frame()
+        return frame
+
+    def upload_path(self, client_name, filename):
+        # Name under which a completed upload is listed, in a designated directory
+        filename = os.path.basename(filename)
+        return os.path.join(self.blobs.directory, f"{client_name}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}")
+
+    def open_upload(self, client_name, message):
+        # Start receiving an upload into the blob store; it is hashed with SHA-256 as it streams in and
+        # not written at all when the sender announced the digest of content that is already stored.
+        # Uploads with a transfer id and a digest are resumable, by the same user only.
+        transfer = message.get("transfer") if self.awaits_resume(message) else None
+        return self.blobs.begin(message.get("sha256"), transfer, client_name)
+
+    def foreign_transfer(self, client_name, message):
+        # Whether a resumable upload names a transfer another user started
+        if not self.awaits_resume(message) or not valid_transfer_id(message["transfer"]):
+            return False
+        owner = self.blobs.partial_owner(message["transfer"])
+        return owner is not None and owner != client_name
 
-    def forward_file(self, sender_socket, sender_name, file_data, message):
-        # Forward a file to all clients except the sender
-        header = {
+    def resume_upload(self, client_socket, upload, message):
+        # Tell the sender of a resumable upload how many bytes the server already has, and return that
+        # offset. Content the store already has is still sent in full: an announced digest proves nothing
+        # about what the sender holds, and only the bytes it sends are hashed, not written, for a duplicate.
+        if not upload.resumable:
+            return 0
+        offset = upload.size
+        if offset > message["length"]:
+            raise ProtocolError("Partial upload is longer than the announced length")
+        self.send_data(client_socket, self.encode({"type": "file_resume", "transfer": message["transfer"], "offset": offset}))
+        return offset
+
+    def read_stored(self, path, offset, count, stream):
+        # One chunk frame of already stored upload data, for recipients joining a resumed transfer
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            return encode_stream_chunk(stream, offset, file.read(count))
+
+    def store_upload(self, upload, client_name, message):
+        # Verify a complete upload against its announced digest and give it its name; returns (digest, path)
+        digest = upload.commit()
+        file_path = self.upload_path(client_name, message["filename"])
+        self.blobs.link(digest, file_path, sender=client_name, room=message.get("room", DEFAULT_ROOM))
+        return digest, file_path
+
+    def start_transfer(self, message):
+        # Register a streamed transfer so recipients that already have its content can opt out
+        transfer = message.get("transfer")
+        if transfer is not None:
+            with self.transfers_lock:
+                if str(transfer).lower() in self.active_uploads:
+                    raise ProtocolError("Transfer is already in progress")
+                self.active_uploads.add(str(transfer).lower())
+        skips = set()
+        if valid_digest(message.get("sha256")):
+            with self.transfers_lock:
+                self.transfers.setdefault(message["sha256"], []).append(skips)
+        return skips
+
+    def end_transfer(self, message, skips):
+        if message.get("transfer") is not None:
+            with self.transfers_lock:
+                self.active_uploads.discard(str(message["transfer"]).lower())
+        if valid_digest(message.get("sha256")):
+            with self.transfers_lock:
+                transfers = self.transfers.get(message["sha256"], [])
+                if skips in transfers:
+                    transfers.remove(skips)
+                if not transfers:
+                    self.transfers.pop(message["sha256"], None)
+
+    def skip_file(self, client_socket, message):
+        # A recipient already has the content being sent; stop sending it the chunks
+        if not valid_digest(message.get("sha256")):
+            return
+        with self.transfers_lock:
+            for skips in self.transfers.get(message["sha256"], []):
+                skips.add(client_socket)
+
+    def skip_recipients(self, recipients, skips, message, stream):
+        # Drop recipients that asked to skip a transfer; the marker tells them no more chunks will follow
+        for client in list(skips):
+            if client in recipients:
+                recipients.remove(client)
+                self.forward_file([client], self.encode({"type": "file_skipped", "sha256": message["sha256"],
+                                                         "filename": message["filename"], "stream": stream}))
+
+    def next_stream(self):
+        # Stream ids are unique per worker, and the worker id keeps them apart across workers
+        return self.worker_id << 32 | next(self.stream_ids)
+
+    def file_header(self, sender_name, message, stream):
+        # Build the header announcing a file to recipients; its chunks follow as stream `stream`
+        return {
+            "stream": stream,
             "type": "file",
             "timestamp": message["timestamp"],
             "name": sender_name,
             "filename": message["filename"],
-            "length": message["length"]
+            "length": message["length"],
+            "room": message.get("room", DEFAULT_ROOM),
+            # Lets recipients that already have the content skip the download
+            "sha256": message.get("sha256")
         }
-        for client in self.clients:
-            if client != sender_socket:
-                try:
-                    client.send(json.dumps(header).encode())
-                    client.sendall(file_data)
-                except Exception as e:
-                    # Remove the client if message sending fails
-                    self.log_error(f"Error forwarding file to client {client}: {e}")
-                    self.clients.remove(client)
+
+    def file_compressible(self, message):
+        # Whether the chunks of a file are worth compressing. The sender looked at the content and says
+        # so in the header; the extension check covers senders that do not.
+        return bool(message.get("compress", True)) and worth_compressing(message["filename"])
+
+    def file_route(self, message):
+        # Bus route for the frames of a file transfer; bulk frames are never dropped
+        return dict(room_route(message.get("room", DEFAULT_ROOM)), bulk=True, compress=self.file_compressible(message))
+
+    def forward_file(self, recipients, data, route=None, compress=True):
+        # Forward one frame of a file transfer to every recipient, dropping those that fail,
+        # and to other workers when a route is given. File frames are sent in the background of chat.
+        if route is not None:
+            self.publish(route, data)
+        self.metrics.count("file_bytes_out", item_size(data) * len(recipients))
+        for client in list(recipients):
+            try:
+                self.send_data(client, data, bulk=True, background=True, compress=compress)
+            except Exception as e:
+                # Remove the client if message sending fails
+                self.log_error(f"Error forwarding file to client {client}: {e}")
+                recipients.remove(client)
+                self.drop_connection(client)
+
+    def check_file_chunk(self, frame, received, data_length):
+        # Validate a relayed frame and return the file bytes it carries. Transfer chunks are checked
+        # against their CRC-32 and must continue exactly where the previous chunk ended.
+        frame_type, data = frame
+        if frame_type == FRAME_TRANSFER_CHUNK:
+            offset, chunk = decode_transfer_chunk(memoryview(data)[HEADER_SIZE:])
+            if offset != received:
+                raise ProtocolError(f"File chunk at offset {offset}, expected {received}")
+        elif frame_type == FRAME_FILE_CHUNK:
+            chunk = memoryview(data)[HEADER_SIZE:]
+        else:
+            raise ProtocolError(f"Expected a file chunk, got frame type {frame_type}")
+        if received + len(chunk) > data_length:
+            raise ProtocolError("File data exceeds announced length")
+        return chunk
+
+    def interleaved_message(self, frame):
+        # Decode a message the sender of an upload sent between its chunks; chat keeps flowing during
+        # an upload, but a connection uploads one file at a time
+        frame_type, data = frame
+        message = self.parse_message((frame_type, bytes(data[HEADER_SIZE:])))
+        if message["type"] == "file":
+            raise ProtocolError("Only one upload at a time per connection")
+        return message
+
+    def abort_upload(self, recipients, route, upload, message, error, stream):
+        # Tell recipients a transfer failed and discard the partial copy, unless the sender can resume it
+        self.log_error(f"Error receiving file: {error}")
+        self.forward_file(recipients, self.encode({"type": "file_abort", "filename": message["filename"],
+                                                   "stream": stream}), route)
+        if upload is None:
+            return
+        if upload.resumable and upload.temp_path is not None:
+            upload.suspend()
+            logger.info(f"Kept {upload.size} bytes of {message['filename']} for transfer {message['transfer']} to resume")
+        else:
+            upload.abort()
+
+    def relay_file(self, client_socket, client_name, message):
+        # Stream an upload to disk and to every other client as its chunks arrive.
+        # Only one chunk (at most `file_window` bytes) is held in memory at a time.
+        data_length = message["length"]
+        stream = self.next_stream()
+        header = self.encode(self.file_header(client_name, message, stream))
+        # In sendfile mode nothing reaches recipients until the upload is complete on disk
+        streaming = self.file_delivery == "stream"
+        recipients = self.room_recipients(message, client_socket) if streaming else []
+        route = self.file_route(message) if streaming else None
+        compress = self.file_compressible(message)
+        skips = self.start_transfer(message)
+        self.forward_file(recipients, header, route)
+        upload = None
+        try:
+            upload = self.open_upload(client_name, message)
+            received = self.resume_upload(client_socket, upload, message)
+            # Recipients of a resumed transfer first get the part received before the interruption
+            for offset, count in self.file_regions(received) if recipients else ():
+                self.forward_file(recipients, self.read_stored(upload.temp_path, offset, count, stream), route, compress)
+                self.drain(recipients)
+            while received < data_length:
+                frame = self.read_raw_frame(client_socket)
+                if frame is None:
+                    raise ConnectionError("File transfer interrupted")
+                if frame[0] in MESSAGE_FRAMES:
+                    message_in_upload = self.interleaved_message(frame)
+                    if self.admit_message(client_socket):
+                        self.dispatch_message(client_socket, client_name, message_in_upload)
+                    continue
+                chunk = self.check_file_chunk(frame, received, data_length)
+                self.metrics.count("file_bytes_in", len(chunk))
+                self.throttle_upload(client_socket, len(chunk))
+                upload.write(chunk)
+                self.skip_recipients(recipients, skips, message, stream)
+                self.forward_file(recipients, encode_stream_chunk(stream, received, chunk), route, compress)
+                received += len(chunk)
+                self.drain(recipients)
+            digest, file_path = self.store_upload(upload, client_name, message)
+        except Exception as e:
+            self.abort_upload(recipients, route, upload, message, e, stream)
+            # The sender's stream is no longer in a known state
+            raise ConnectionError("File transfer failed") from e
+        finally:
+            self.end_transfer(message, skips)
+        logger.info(f"File received and saved to {file_path}" + (" (content already stored)" if upload.duplicate else ""))
+        self.index_upload(client_name, message)
+        if not streaming:
+            # The stored copy is complete and verified, so recipients learn its digest
+            header = self.encode(dict(self.file_header(client_name, message, stream), sha256=digest))
+            self.deliver_file(self.room_recipients(message, client_socket), file_path, header, stream)
+            self.publish(dict(self.file_route(message), file=file_path, stream=stream), header)
+
+    def file_regions(self, size):
+        # Split a stored file into (offset, count) chunks no larger than the file window
+        for offset in range(0, size, self.file_window):
+            yield offset, min(self.file_window, size - offset)
+
+    def deliver_file(self, recipients, file_path, header, stream):
+        # Serve a stored file to each recipient straight from disk; writers copy the regions with sendfile
+        # right after the prefix that frames them
+        size = os.path.getsize(file_path)
+        self.forward_file(recipients, header)
+        for offset, count in self.file_regions(size):
+            self.forward_file(recipients, (stream_chunk_prefix(stream, offset, count), FileRegion(file_path, offset, count)))
 
     def handle_cleanup(self):
         # Cleanup resources on server shutdown
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        self.stop_profiling()
+        if self.history is not None:
+            self.history.close()
+        if self.search_index is not None:
+            self.search_index.close()
         try:
             self.server_socket.shutdown(socket.SHUT_RDWR)
             self.server_socket.close()
         except Exception as e:
             self.log_error(f"Error during shutdown: {e}")
 
-if __name__ == '__main__':
-    chat_server = ChatServer()
+
+class AsyncChatServer(ChatServer):
+    # Everything runs on the event loop thread, so a cProfile session records that whole thread
+    profile_whole_thread = True
+
+    def __init__(self, host='0.0.0.0', port=8888, backlog=socket.SOMAXCONN, **options):
+        # Initialize server; connections are served by one event loop instead of one thread each
+        super().__init__(host, port, backlog, **options)
+        self.server = None
+        self.loop = None
+
+    def raise_file_limit(self):
+        # Lift the open file soft limit to the hard limit so the loop can hold many idle sockets
+        try:
+            import resource
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ImportError, ValueError, OSError) as e:
+            self.log_error(f"Could not raise open file limit: {e}")
+
+    async def serve_forever(self):
+        # Accept connections on the already bound listening socket
+        self.raise_file_limit()
+        self.loop = asyncio.get_running_loop()
+        self.start_bus()
+        self.start_metrics()
+        self.server_socket.setblocking(False)
+        self.server = await asyncio.start_server(self.handle_client, sock=self.server_socket)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        # Serve a single client connection as a coroutine
+        start = time.perf_counter()
+        address = writer.get_extra_info("peername")
+        self.set_nodelay(writer.get_extra_info("socket"))
+        queue = self.create_queue()
+        session = self.registry.add(writer, address, queue, self.create_decoder(), self.limiter.connection_limits())
+        logger.info(f"Accepted connection from {address}")
+        writer_task = session.writer_task = asyncio.create_task(self.write_loop(writer, queue))
+        self.metrics.count("connections_accepted")
+        self.metrics.observe("accept", time.perf_counter() - start)
+        client_name = None
+        try:
+            # Receive the client's name
+            join = await self.read_message(reader, writer)
+            if join is None or join.get("type") != "join":
+                raise ProtocolError("Expected a join message")
+            client_name = join["name"]
+            self.negotiate_capabilities(writer, join)
+            logger.info(f"{client_name} has joined the chat.", extra={"address": address})
+            self.broadcast_system_message(f"{client_name} has joined the chat.", writer)
+            self.announce_join(writer, client_name, join)
+
+            while True:
+                message = await self.read_message(reader, writer)
+                if message is None:
+                    break
+                if not await self.admit_message(writer):
+                    continue
+                start = time.perf_counter()
+                session = self.profiler.session
+                await self.process_message(reader, writer, client_name, message)
+                self.message_processed(message, time.perf_counter() - start, session)
+                # A single read can hold many frames; let writer tasks run between messages
+                await asyncio.sleep(0)
+
+        except (ValueError, KeyError, TypeError, ProtocolError, ConnectionError) as e:
+            logger.warning(f"Error: {e}", extra={"client": client_name, "address": address})
+        except Exception:
+            logger.exception("Unexpected error serving a client", extra={"client": client_name, "address": address})
+        finally:
+            self.close_client(writer, client_name)
+            # The writer task ends once its queue is closed, or was cancelled when the client was dropped
+            await asyncio.gather(writer_task, return_exceptions=True)
+            writer.close()
+
+    def on_bus_message(self, route, frame):
+        # Bus traffic arrives on the bus reader thread; deliver it from the event loop
+        self.loop.call_soon_threadsafe(super().on_bus_message, route, frame)
+
+    def schedule_profile_stop(self, duration, session):
+        # A profile of the loop thread has to be stopped on that thread
+        self.loop.call_later(duration, self.stop_profiling, session)
+
+    def create_queue(self):
+        # Outbound queue for a new connection, drained by a writer task
+        return AsyncOutboundQueue(self.queue_high_water, self.slow_consumer_policy)
+
+    def drop_connection(self, client):
+        # Stop serving a connection that failed or was evicted. Its writer task may be waiting for a
+        # stalled peer to read, so the transport is aborted, discarding what is buffered for it, and the
+        # task cancelled; the reader coroutine then sees the connection closed and unregisters it.
+        session = self.registry.get(client)
+        if session is not None:
+            session.queue.close()
+            client.transport.abort()
+            if session.writer_task is not None:
+                session.writer_task.cancel()
+
+    async def write_loop(self, writer, queue):
+        # Drain a client's outbound queue onto its transport
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                batch = await queue.get_batch(self.coalesce_bytes, self.coalesce_window)
+                if batch is None:
+                    break
+                await self.write_batch(writer, batch, loop)
+        except (OSError, RuntimeError) as e:
+            if not queue.closed:
+                self.log_error(f"Error writing to {writer}: {e}")
+        finally:
+            queue.close()
+            if queue.evicted:
+                self.log_error(f"Evicted slow consumer {self.connection_name(writer)}")
+            # Closing the transport ends the client's reader coroutine
+            writer.close()
+
+    async def write_batch(self, writer, batch, loop):
+        # Hand a batch of queued frames to the transport in one write, and a file region that ends it to sendfile
+        region = batch.pop() if isinstance(batch[-1], FileRegion) else None
+        if batch:
+            writer.writelines(batch)
+            await writer.drain()
+            self.metrics.count("writes")
+            self.metrics.count("frames_written", len(batch))
+        if region is not None:
+            with open(region.path, 'rb') as file:
+                await loop.sendfile(writer.transport, file, region.offset, region.count)
+
+    async def read_frame(self, reader, writer):
+        # Wait until the client's decoder holds a complete frame; None means the peer closed
+        decoder = self.registry.get(writer).decoder
+        frame = decoder.next_frame()
+        while frame is None:
+            data = await reader.read(decoder.wanted())
+            if not data:
+                return None
+            self.count_received(len(data))
+            decoder.feed(data)
+            frame = decoder.next_frame()
+        return frame
+
+    async def read_message(self, reader, writer):
+        # Read the next frame and decode it as a JSON message
+        frame = await self.read_frame(reader, writer)
+        if frame is None:
+            return None
+        return self.parse_message(frame)
+
+    async def admit_message(self, writer):
+        # Apply the message rate limits, waiting without blocking the loop; False when the message is discarded
+        delay = self.limiter.admit(self.registry.get(writer).limits, LIMIT_MESSAGES)
+        if delay:
+            await asyncio.sleep(delay)
+        return delay is not None
+
+    async def throttle_upload(self, writer, size):
+        # Apply the upload byte rate limits to a received chunk before it is forwarded
+        delay = self.limiter.admit(self.registry.get(writer).limits, LIMIT_BYTES, size)
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def claim_transfer(self, writer, client_name, message):
+        # Take an upload slot for a user, waiting up to TRANSFER_WAIT for one under the delay policy;
+        # False when the upload is refused
+        if self.limiter.start_transfer(client_name):
+            return True
+        if not self.limiter.refuse_transfer():
+            return False
+        self.queue_upload(writer, message)
+        deadline = time.monotonic() + TRANSFER_WAIT
+        while not self.limiter.start_transfer(client_name):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(TRANSFER_RETRY)
+        return True
+
+    async def process_message(self, reader, writer, client_name, message):
+        # Process and dispatch messages based on their type
+        if message["type"] == "file":
+            if self.foreign_transfer(client_name, message):
+                await self.refuse_upload(reader, writer, client_name, message, FOREIGN_TRANSFER)
+                return
+            if not await self.claim_transfer(writer, client_name, message):
+                await self.refuse_upload(reader, writer, client_name, message)
+                return
+            try:
+                await self.relay_file(reader, writer, client_name, message)
+            finally:
+                self.limiter.end_transfer(client_name)
+        elif message["type"] == "search" and self.search_index is not None:
+            # The query runs in a thread so the event loop never waits on SQLite
+            results = await asyncio.to_thread(self.find_messages, message)
+            self.send_search_results(writer, message, results)
+        else:
+            self.dispatch_message(writer, client_name, message)
+
+    async def refuse_upload(self, reader, writer, client_name, message, reason=TOO_MANY_UPLOADS):
+        # Turn an upload down, reading the chunks that follow if any
+        logger.info(f"Refused upload of {message['filename']} from {client_name}: {reason}")
+        if message.get("transfer") is not None:
+            self.send_data(writer, self.encode({"type": "file_refused", "transfer": message["transfer"],
+                                                "reason": reason}))
+        if not self.awaits_resume(message):
+            await self.discard_upload(reader, writer, client_name, message)
+
+    async def discard_upload(self, reader, writer, client_name, message):
+        # Read the chunks of a refused upload without storing or forwarding them
+        received = 0
+        while received < message["length"]:
+            frame = await self.read_raw_frame(reader, writer)
+            if frame is None:
+                raise ConnectionError("File transfer interrupted")
+            if frame[0] in MESSAGE_FRAMES:
+                message_in_upload = self.interleaved_message(frame)
+                if await self.admit_message(writer):
+                    self.dispatch_message(writer, client_name, message_in_upload)
+                continue
+            received += len(self.check_file_chunk(frame, received, message["length"]))
+
+    async def read_raw_frame(self, reader, writer):
+        # Like read_frame, but return the whole encoded frame so it can be relayed as is
+        decoder = self.registry.get(writer).decoder
+        frame = decoder.next_raw_frame()
+        while frame is None:
+            data = await reader.read(decoder.wanted())
+            if not data:
+                return None
+            self.count_received(len(data))
+            decoder.feed(data)
+            frame = decoder.next_raw_frame()
+        return frame
+
+    async def drain(self, recipients):
+        # Wait for recipients to work through their backlog; recipients that stay stalled are evicted
+        for client in list(recipients):
+            session = self.registry.get(client)
+            if session is None or not await session.queue.wait_for_space(self.slow_consumer_timeout):
+                self.log_error(f"Error forwarding file to client {client}: evicted as a slow consumer")
+                recipients.remove(client)
+                self.drop_connection(client)
+
+    async def relay_file(self, reader, writer, client_name, message):
+        # Stream an upload to disk and to every other client as its chunks arrive
+        data_length = message["length"]
+        stream = self.next_stream()
+        header = self.encode(self.file_header(client_name, message, stream))
+        streaming = self.file_delivery == "stream"
+        recipients = self.room_recipients(message, writer) if streaming else []
+        route = self.file_route(message) if streaming else None
+        compress = self.file_compressible(message)
+        skips = self.start_transfer(message)
+        self.forward_file(recipients, header, route)
+        upload = None
+        try:
+            upload = await asyncio.to_thread(self.open_upload, client_name, message)
+            received = self.resume_upload(writer, upload, message)
+            for offset, count in self.file_regions(received) if recipients else ():
+                frame = await asyncio.to_thread(self.read_stored, upload.temp_path, offset, count, stream)
+                self.forward_file(recipients, frame, route, compress)
+                await self.drain(recipients)
+            while received < data_length:
+                frame = await self.read_raw_frame(reader, writer)
+                if frame is None:
+                    raise ConnectionError("File transfer interrupted")
+                if frame[0] in MESSAGE_FRAMES:
+                    message_in_upload = self.interleaved_message(frame)
+                    if await self.admit_message(writer):
+                        self.dispatch_message(writer, client_name, message_in_upload)
+                    continue
+                chunk = self.check_file_chunk(frame, received, data_length)
+                self.metrics.count("file_bytes_in", len(chunk))
+                await self.throttle_upload(writer, len(chunk))
+                # Hashing and disk writes run off the event loop so other clients are not stalled
+                await asyncio.to_thread(upload.write, chunk)
+                self.skip_recipients(recipients, skips, message, stream)
+                self.forward_file(recipients, encode_stream_chunk(stream, received, chunk), route, compress)
+                received += len(chunk)
+                await self.drain(recipients)
+            digest, file_path = await asyncio.to_thread(self.store_upload, upload, client_name, message)
+        except Exception as e:
+            self.abort_upload(recipients, route, upload, message, e, stream)
+            raise ConnectionError("File transfer failed") from e
+        finally:
+            self.end_transfer(message, skips)
+        logger.info(f"File received and saved to {file_path}" + (" (content already stored)" if upload.duplicate else ""))
+        self.index_upload(client_name, message)
+        if not streaming:
+            header = self.encode(dict(self.file_header(client_name, message, stream), sha256=digest))
+            self.deliver_file(self.room_recipients(message, writer), file_path, header, stream)
+            self.publish(dict(self.file_route(message), file=file_path, stream=stream), header)
+
+    def handle_cleanup(self):
+        # Cleanup resources on server shutdown
+        if self.server is not None:
+            self.server.close()
+        super().handle_cleanup()
+
+def parse_args():
+    # Parse command line options
+    parser = argparse.ArgumentParser(description="QuickChat server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="serve clients with one thread each or from a single asyncio event loop")
+    parser.add_argument("--file-window", type=int, default=256 * 1024,
+                        help="largest frame accepted from a client in bytes; bounds memory per file transfer")
+    parser.add_argument("--file-delivery", choices=["stream", "sendfile"], default="stream",
+                        help="relay file chunks as they are uploaded, or serve the stored copy with sendfile once complete")
+    parser.add_argument("--queue-high-water", type=int, default=DEFAULT_HIGH_WATER,
+                        help="bytes of queued outbound frames a client may fall behind by")
+    parser.add_argument("--slow-consumer-policy", choices=POLICIES, default=POLICY_DISCONNECT,
+                        help="drop chat frames for, or disconnect, clients past the high water mark")
+    parser.add_argument("--slow-consumer-timeout", type=float, default=DEFAULT_SLOW_TIMEOUT,
+                        help="seconds a file transfer waits for a lagging recipient before evicting it")
+    parser.add_argument("--coalesce-bytes", type=int, default=DEFAULT_COALESCE_BYTES,
+                        help="bytes of queued frames written to a client in one system call (0 writes each frame alone)")
+    parser.add_argument("--coalesce-window", type=int, default=0,
+                        help="microseconds a writer waits for more frames before writing a batch (0 never waits)")
+    parser.add_argument("--no-tcp-nodelay", dest="tcp_nodelay", action="store_false",
+                        help="leave Nagle's algorithm on for client connections")
+    parser.add_argument("--rate-limit-policy", choices=RATE_POLICIES, default=RATE_DELAY,
+                        help="make clients past a rate limit wait, drop their messages, or disconnect them "
+                             "(uploads past a byte limit wait under drop too)")
+    parser.add_argument("--message-rate", type=float,
+                        help="messages per second each connection may send (unlimited when not given)")
+    parser.add_argument("--upload-rate", type=int,
+                        help="upload bytes per second each connection may send (unlimited when not given)")
+    parser.add_argument("--max-uploads", type=int,
+                        help="uploads each user may have in progress at once (unlimited when not given)")
+    parser.add_argument("--global-message-rate", type=float,
+                        help="messages per second all connections together may send (unlimited when not given)")
+    parser.add_argument("--global-upload-rate", type=int,
+                        help="upload bytes per second all connections together may send (unlimited when not given)")
+    parser.add_argument("--global-max-uploads", type=int,
+                        help="uploads that may be in progress at once (unlimited when not given)")
+    parser.add_argument("--codec", choices=list(CODECS), default="json",
+                        help="encoding for message frames sent to clients (msgpack needs clients with msgpack installed)")
+    parser.add_argument("--compression", choices=["auto", "none"] + list(COMPRESSIONS), default="auto",
+                        help="compression clients may negotiate for frames and file chunks (auto allows any available)")
+    parser.add_argument("--compress-threshold", type=int, default=DEFAULT_COMPRESS_THRESHOLD,
+                        help="smallest frame in bytes that is compressed")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of server processes sharing the port (SO_REUSEPORT, Linux) joined by a local bus")
+    parser.add_argument("--bus-path",
+                        help="Unix socket path for the worker bus (default: a per-port path in the temp directory)")
+    parser.add_argument("--history-dir",
+                        help="directory for the persistent message history (history is off when not given)")
+    parser.add_argument("--history-backfill", type=int, default=50,
+                        help="messages replayed to a client joining a room, unless it asks for a number or a cursor")
+    parser.add_argument("--history-fsync", choices=FSYNC_POLICIES, default=FSYNC_BATCH,
+                        help="fsync history in the background after every message, in batches, or never")
+    parser.add_argument("--history-fsync-interval", type=float, default=1.0,
+                        help="seconds between batched history fsyncs")
+    parser.add_argument("--history-segment-size", type=int, default=DEFAULT_SEGMENT_SIZE,
+                        help="bytes after which a history segment is sealed and a new one started")
+    parser.add_argument("--search-db",
+                        help="SQLite database for the full-text search index (search is off when not given)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics over HTTP on this port (workers use this port plus their id)")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="address the metrics endpoint listens on")
+    parser.add_argument("--admin-token", default=os.environ.get("QUICKCHAT_ADMIN_TOKEN"),
+                        help="token clients present to run admin commands such as profiling "
+                             "(default: $QUICKCHAT_ADMIN_TOKEN; admin commands are refused without one)")
+    parser.add_argument("--profile-dir", default="profiles",
+                        help="directory profiles are written to")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO",
+                        help="least severe log messages shown (DEBUG includes every chat message)")
+    parser.add_argument("--log-format", choices=LOG_FORMATS, default="text",
+                        help="log as readable lines or as one JSON object per line")
+    args = parser.parse_args()
+    if args.history_dir and args.workers > 1:
+        # Each worker would append to the same logs with its own offsets
+        parser.error("--history-dir is not supported with --workers > 1")
+    return args
+
+def server_options(args):
+    # Keyword arguments shared by both server engines
+    return {
+        "file_window": args.file_window,
+        "file_delivery": args.file_delivery,
+        "queue_high_water": args.queue_high_water,
+        "slow_consumer_policy": args.slow_consumer_policy,
+        "slow_consumer_timeout": args.slow_consumer_timeout,
+        "tcp_nodelay": args.tcp_nodelay,
+        "coalesce_bytes": args.coalesce_bytes,
+        "coalesce_window": args.coalesce_window / 1e6,
+        "rate_policy": args.rate_limit_policy,
+        "message_rate": args.message_rate,
+        "upload_rate": args.upload_rate,
+        "max_uploads": args.max_uploads,
+        "global_message_rate": args.global_message_rate,
+        "global_upload_rate": args.global_upload_rate,
+        "global_max_uploads": args.global_max_uploads,
+        "codec": args.codec,
+        "compression": args.compression,
+        "compress_threshold": args.compress_threshold,
+        "history_dir": args.history_dir,
+        "history_backfill": args.history_backfill,
+        "history_fsync": args.history_fsync,
+        "history_fsync_interval": args.history_fsync_interval,
+        "history_segment_size": args.history_segment_size,
+        "search_db": args.search_db,
+        "metrics_host": args.metrics_host,
+        "metrics_port": args.metrics_port,
+        "admin_token": args.admin_token,
+        "profile_dir": args.profile_dir,
+    }
+
+def create_server(args, **extra):
+    # Build a server for the selected engine
+    server_class = AsyncChatServer if args.engine == "asyncio" else ChatServer
+    return server_class(args.host, args.port, **server_options(args), **extra)
+
+def run_server(chat_server):
+    # Serve until interrupted, then release the listening socket
     try:
-        chat_server.accept_connections()
+        if isinstance(chat_server, AsyncChatServer):
+            asyncio.run(chat_server.serve_forever())
+        else:
+            chat_server.accept_connections()
+    except KeyboardInterrupt:
+        pass
     finally:
-        chat_server.handle_cleanup()
\ No newline at end of file
+        chat_server.handle_cleanup()
+
+def run_worker(args, worker_id, bus_path):
+    # Entry point of a worker process: share the port with the other workers and join the bus
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    configure_logging(args.log_level, args.log_format)
+    run_server(create_server(args, reuse_port=True, bus_path=bus_path, worker_id=worker_id))
+
+def stop_cluster(signum, frame):
+    # SIGTERM (kill, systemd, a benchmark stopping its server) stops the workers like Ctrl+C does
+    raise KeyboardInterrupt
+
+def run_cluster(args):
+    # Run the bus hub in this process and args.workers server processes sharing the port. The workers
+    # are stopped however the master ends, so none keeps accepting on the port without the hub.
+    signal.signal(signal.SIGTERM, stop_cluster)
+    bus_path = args.bus_path or os.path.join(tempfile.gettempdir(), f"quickchat-{args.port}.sock")
+    hub = BusHub(bus_path)
+    hub.start()
+    workers = [multiprocessing.Process(target=run_worker, args=(args, worker_id, bus_path), daemon=True)
+               for worker_id in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Started {args.workers} workers on port {args.port}, bus at {bus_path}")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        hub.close()
+
+if __name__ == '__main__':
+    args = parse_args()
+    configure_logging(args.log_level, args.log_format)
+    if args.workers > 1:
+        run_cluster(args)
+    else:
+        run_server(create_server(args))
@@ -0,0 +1,161 @@
+import os
+
+from History import (HistoryLog, HistoryStore, FSYNC_NEVER, INDEX_ENTRY, INDEX_SUFFIX, LOG_SUFFIX,
+                     MAX_DIRECTORY_NAME, room_directory)
+from Protocol import FrameDecoder, decode_message, encode_message
+
+
+def texts(frames):
+    decoder = FrameDecoder()
+    decoder.feed(frames)
+    return [decode_message(payload)["text"] for _, payload in decoder.frames()]
+
+
+def record(log, *values):
+    for value in values:
+        log.record({"type": "text", "text": value}, encode_message)
+
+
+def segment_files(directory, suffix):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(suffix))
+
+
+def test_records_and_replays(tmp_path):
+    log = HistoryLog(str(tmp_path / "room"), fsync=FSYNC_NEVER)
+    record(log, "a", "b", "c")
+    frames, count, cursor = log.backfill(last=2)
+    assert (texts(frames), count, cursor) == (["b", "c"], 2, 3)
+    assert texts(log.backfill(since=1)[0]) == ["b", "c"]
+    assert texts(log.backfill(last=5, before=2)[0]) == ["a", "b"]
+
+
+def test_directory_is_created_by_the_first_message(tmp_path):
+    directory = str(tmp_path / "room")
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    assert log.backfill(last=10) == (b"", 0, 0)
+    assert not os.path.exists(directory)
+    record(log, "a")
+    assert os.path.isdir(directory)
+
+
+def test_reopen_continues_offsets(tmp_path):
+    directory = str(tmp_path / "room")
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    record(log, "a", "b")
+    log.close()
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    assert log.next_offset == 2
+    record(log, "c")
+    assert texts(log.backfill(since=0)[0]) == ["a", "b", "c"]
+
+
+def test_recovery_drops_a_frame_without_index_entry(tmp_path):
+    directory = str(tmp_path / "room")
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    record(log, "a", "b")
+    log.close()
+    (log_path,) = segment_files(directory, LOG_SUFFIX)
+    size = os.path.getsize(log_path)
+    # Crash after writing part of a frame but before its index entry
+    with open(log_path, 'ab') as file:
+        file.write(encode_message({"type": "text", "text": "torn"})[:7])
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    assert os.path.getsize(log_path) == size
+    record(log, "c")
+    assert texts(log.backfill(since=0)[0]) == ["a", "b", "c"]
+
+
+def test_recovery_drops_an_entry_whose_frame_is_incomplete(tmp_path):
+    directory = str(tmp_path / "room")
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    record(log, "a", "b")
+    log.close()
+    (log_path,) = segment_files(directory, LOG_SUFFIX)
+    # The index entry of "b" made it to disk but the end of its frame did not
+    os.truncate(log_path, os.path.getsize(log_path) - 3)
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    assert log.next_offset == 1
+    record(log, "c")
+    assert texts(log.backfill(since=0)[0]) == ["a", "c"]
+
+
+def test_recovery_drops_a_partial_index_entry(tmp_path):
+    directory = str(tmp_path / "room")
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    record(log, "a")
+    log.close()
+    (index_path,) = segment_files(directory, INDEX_SUFFIX)
+    with open(index_path, 'ab') as file:
+        file.write(INDEX_ENTRY.pack(12345)[:5])
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    assert os.path.getsize(index_path) == INDEX_ENTRY.size
+    record(log, "b")
+    assert texts(log.backfill(since=0)[0]) == ["a", "b"]
+
+
+def test_recovery_of_a_segment_with_nothing_complete(tmp_path):
+    directory = str(tmp_path / "room")
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    record(log, "a")
+    log.close()
+    (log_path,) = segment_files(directory, LOG_SUFFIX)
+    os.truncate(log_path, 2)
+    log = HistoryLog(directory, fsync=FSYNC_NEVER)
+    assert log.next_offset == 0
+    assert os.path.getsize(log_path) == 0
+    record(log, "b")
+    assert texts(log.backfill(since=0)[0]) == ["b"]
+
+
+def test_segments_roll_over(tmp_path):
+    directory = str(tmp_path / "room")
+    frame_size = len(encode_message({"type": "text", "text": "m00", "offset": 0}))
+    # Three messages per segment
+    log = HistoryLog(directory, segment_size=3 * frame_size, fsync=FSYNC_NEVER)
+    values = [f"m{i:02d}" for i in range(10)]
+    record(log, *values)
+    assert [segment.base for segment in log.segments] == [0, 3, 6, 9]
+    assert len(segment_files(directory, LOG_SUFFIX)) == 4
+    # Only the active segment keeps files open
+    assert [segment.log_fd is not None for segment in log.segments] == [False, False, False, True]
+    assert texts(log.backfill(since=0)[0]) == values
+    # Ranges that start and end inside different segments
+    assert texts(log.backfill(since=2, before=8)[0]) == values[2:8]
+    assert texts(log.backfill(last=4)[0]) == values[6:]
+
+
+def test_rolled_segments_survive_reopening(tmp_path):
+    directory = str(tmp_path / "room")
+    frame_size = len(encode_message({"type": "text", "text": "m00", "offset": 0}))
+    log = HistoryLog(directory, segment_size=3 * frame_size, fsync=FSYNC_NEVER)
+    values = [f"m{i:02d}" for i in range(9)]
+    record(log, *values)
+    log.close()
+    # The last roll left a segment that was never written to
+    log = HistoryLog(directory, segment_size=3 * frame_size, fsync=FSYNC_NEVER)
+    assert [segment.base for segment in log.segments] == [0, 3, 6]
+    assert log.next_offset == 9
+    record(log, "m09")
+    assert texts(log.backfill(since=5)[0]) == values[5:] + ["m09"]
+
+
+def test_long_room_names_fit_a_directory_name():
+    name = room_directory("é" * 100)
+    assert len(name) <= MAX_DIRECTORY_NAME
+    assert room_directory("é" * 100) == name
+    assert room_directory("é" * 101) != name
+    assert room_directory("../x") == "%2E%2E%2Fx"
+
+
+def test_store_closes_the_files_of_idle_rooms(tmp_path):
+    store = HistoryStore(str(tmp_path), fsync=FSYNC_NEVER, max_open=1)
+    store.record("one", {"type": "text", "text": "a"}, encode_message)
+    first = store.log("one")
+    assert first.segments[-1].log_fd is not None
+    store.record("two", {"type": "text", "text": "b"}, encode_message)
+    assert first.segments[-1].log_fd is None
+    # Used again, the room opens its files and carries on where it stopped
+    store.record("one", {"type": "text", "text": "c"}, encode_message)
+    assert store.log("one") is first
+    assert texts(first.backfill(since=0)[0]) == ["a", "c"]
+    store.close()
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+
+from Outbound import AsyncOutboundQueue, FileRegion, OutboundQueue, POLICY_DISCONNECT, POLICY_DROP
+
+
+def test_frames_up_to_the_high_water_mark_are_queued():
+    queue = OutboundQueue(high_water=100)
+    assert all(queue.put(b"x" * 25) for _ in range(4))
+    assert queue.stats()["queued_bytes"] == 100
+    assert [queue.get() for _ in range(4)] == [b"x" * 25] * 4
+
+
+def test_a_frame_larger_than_the_mark_is_queued_when_nothing_waits():
+    queue = OutboundQueue(high_water=100)
+    assert queue.put(b"x" * 500)
+    assert not queue.closed
+
+
+def test_drop_policy_discards_the_frame_and_keeps_the_client():
+    queue = OutboundQueue(high_water=100, policy=POLICY_DROP)
+    assert queue.put(b"x" * 80)
+    assert not queue.put(b"y" * 30)
+    assert not queue.closed
+    stats = queue.stats()
+    assert (stats["dropped"], stats["evicted"], stats["queued_bytes"]) == (1, False, 80)
+    # Once the writer catches up the client receives frames again
+    assert queue.get() == b"x" * 80
+    assert queue.put(b"y" * 30)
+
+
+def test_disconnect_policy_evicts_the_client():
+    queue = OutboundQueue(high_water=100, policy=POLICY_DISCONNECT)
+    assert queue.put(b"x" * 80)
+    assert not queue.put(b"y" * 30)
+    assert queue.closed
+    assert queue.stats()["evicted"]
+    # The writer stops and nothing more is accepted
+    assert queue.get() is None
+    assert not queue.put(b"z")
+
+
+def test_file_chunks_do_not_count_against_chat_frames():
+    queue = OutboundQueue(high_water=100, policy=POLICY_DISCONNECT)
+    assert queue.put(b"f" * 1000, background=True)
+    assert queue.put(b"c" * 60)
+    assert queue.put(b"c" * 40)
+    assert not queue.closed
+    # Chat frames are written before the file chunk queued ahead of them
+    assert queue.get_batch(max_bytes=1000) == [b"c" * 60, b"c" * 40, b"f" * 1000]
+
+
+def test_bulk_frames_wait_instead_of_being_refused():
+    queue = OutboundQueue(high_water=100, policy=POLICY_DISCONNECT)
+    for _ in range(5):
+        assert queue.put(b"x" * 60, bulk=True)
+    assert not queue.closed
+    assert not queue.has_space()
+
+
+def test_bulk_frames_past_their_limit_evict():
+    queue = OutboundQueue(high_water=100)
+    assert queue.put(b"x" * 150, bulk=True, limit=200)
+    assert not queue.put(b"x" * 60, bulk=True, limit=200)
+    assert queue.closed and queue.stats()["evicted"]
+
+
+def test_file_regions_are_not_counted():
+    queue = OutboundQueue(high_water=100)
+    assert queue.put((b"h" * 10, FileRegion("unused", 0, 10 ** 9)), bulk=True)
+    assert queue.stats()["queued_bytes"] == 10
+
+
+def test_wait_for_space_evicts_on_timeout():
+    queue = OutboundQueue(high_water=100)
+    queue.put(b"x" * 200, bulk=True)
+    assert not queue.wait_for_space(timeout=0.05)
+    assert queue.closed and queue.stats()["evicted"]
+
+
+def test_wait_for_space_returns_once_the_writer_catches_up():
+    queue = OutboundQueue(high_water=100)
+    queue.put(b"x" * 200, bulk=True)
+    writer = threading.Timer(0.05, queue.get)
+    writer.start()
+    assert queue.wait_for_space(timeout=5)
+    writer.join()
+    assert not queue.closed
+
+
+def test_async_queue_applies_the_same_policies():
+    async def scenario():
+        queue = AsyncOutboundQueue(high_water=100, policy=POLICY_DISCONNECT)
+        assert queue.put(b"x" * 80)
+        assert await queue.get() == b"x" * 80
+        queue.put(b"x" * 200, bulk=True)
+        assert not await queue.wait_for_space(timeout=0.05)
+        assert queue.closed and queue.stats()["evicted"]
+        assert await queue.get() is None
+
+    asyncio.run(scenario())
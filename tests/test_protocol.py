@@ -0,0 +1,122 @@
+import pytest
+
+from Protocol import (FrameDecoder, ProtocolError, FrameCompressor, COMPRESSIONS, FRAME_FILE_CHUNK, FRAME_JSON,
+                      HEADER_SIZE, decode_message, encode_frame, encode_message)
+
+
+def test_header_split_across_feeds():
+    frame = encode_message({"type": "text", "text": "hello"})
+    decoder = FrameDecoder()
+    for i in range(HEADER_SIZE - 1):
+        decoder.feed(frame[i:i + 1])
+        assert decoder.next_frame() is None
+    decoder.feed(frame[HEADER_SIZE - 1:])
+    frame_type, payload = decoder.next_frame()
+    assert frame_type == FRAME_JSON
+    assert decode_message(payload) == {"type": "text", "text": "hello"}
+    assert decoder.next_frame() is None
+    assert decoder.pending() == 0
+
+
+def test_many_frames_in_one_feed():
+    frames = [encode_message({"type": "text", "text": str(i)}) for i in range(10)]
+    decoder = FrameDecoder()
+    # The last frame stops one byte short
+    decoder.feed(b"".join(frames)[:-1])
+    assert [decode_message(payload)["text"] for _, payload in decoder.frames()] == [str(i) for i in range(9)]
+    decoder.feed(frames[-1][-1:])
+    assert decode_message(decoder.next_frame()[1])["text"] == "9"
+
+
+def test_raw_frame_keeps_its_header():
+    frame = encode_frame(FRAME_FILE_CHUNK, b"x" * 100)
+    decoder = FrameDecoder()
+    decoder.feed(frame)
+    assert decoder.next_raw_frame() == (FRAME_FILE_CHUNK, frame)
+
+
+def test_oversized_frame_is_rejected_from_its_header():
+    decoder = FrameDecoder(max_frame_size=1024)
+    # Only the header has arrived; the length alone must be enough to refuse it
+    decoder.feed(encode_frame(FRAME_FILE_CHUNK, b"x" * 1025)[:HEADER_SIZE])
+    with pytest.raises(ProtocolError):
+        decoder.wanted()
+    with pytest.raises(ProtocolError):
+        decoder.next_frame()
+
+
+def test_frame_at_the_limit_is_accepted():
+    decoder = FrameDecoder(max_frame_size=1024)
+    decoder.feed(encode_frame(FRAME_FILE_CHUNK, b"x" * 1024))
+    assert decoder.next_frame() == (FRAME_FILE_CHUNK, b"x" * 1024)
+
+
+def test_compressed_frames_expand_in_place():
+    frames = [encode_message({"type": "text", "text": "x" * 500, "n": i}) for i in range(3)]
+    compressed = FrameCompressor(COMPRESSIONS["zlib"], threshold=0).compress(b"".join(frames))
+    decoder = FrameDecoder()
+    decoder.feed(compressed + frames[0])
+    assert [decode_message(payload)["n"] for _, payload in decoder.frames()] == [0, 1, 2, 0]
+
+
+def test_compressed_frame_cannot_exceed_the_limit():
+    big = encode_frame(FRAME_FILE_CHUNK, b"x" * 4096)
+    decoder = FrameDecoder(max_frame_size=1024)
+    decoder.feed(FrameCompressor(COMPRESSIONS["zlib"], threshold=0).compress(big))
+    with pytest.raises(ProtocolError):
+        decoder.next_frame()
+
+
+def test_buffer_grows_for_a_large_frame():
+    decoder = FrameDecoder(buffer_size=64)
+    decoder.feed(encode_frame(FRAME_FILE_CHUNK, b"x" * 1000))
+    assert len(decoder.buffer) >= HEADER_SIZE + 1000
+    assert decoder.next_frame() == (FRAME_FILE_CHUNK, b"x" * 1000)
+
+
+def test_buffer_stays_grown_while_large_frames_keep_coming():
+    decoder = FrameDecoder(buffer_size=64, shrink_after=4)
+    large = encode_frame(FRAME_FILE_CHUNK, b"x" * 1000)
+    small = encode_message({"type": "text"})
+    buffers = set()
+    for _ in range(20):
+        decoder.feed(large)
+        decoder.next_frame()
+        # A few small frames between large ones are not enough to give the memory back
+        for _ in range(3):
+            decoder.feed(small)
+            decoder.next_frame()
+        buffers.add(id(decoder.buffer))
+    assert len(buffers) == 1
+    assert len(decoder.buffer) > 64
+
+
+def test_buffer_shrinks_after_enough_small_frames():
+    decoder = FrameDecoder(buffer_size=64, shrink_after=4)
+    decoder.feed(encode_frame(FRAME_FILE_CHUNK, b"x" * 1000))
+    decoder.next_frame()
+    small = encode_message({"type": "text"})
+    for _ in range(3):
+        decoder.feed(small)
+        decoder.next_frame()
+        assert len(decoder.buffer) > 64
+    decoder.feed(small)
+    decoder.next_frame()
+    assert len(decoder.buffer) == 64
+    # And it grows again when needed
+    decoder.feed(encode_frame(FRAME_FILE_CHUNK, b"y" * 1000))
+    assert decoder.next_frame() == (FRAME_FILE_CHUNK, b"y" * 1000)
+
+
+def test_buffer_does_not_shrink_under_a_partial_frame():
+    decoder = FrameDecoder(buffer_size=64, shrink_after=1)
+    decoder.feed(encode_frame(FRAME_FILE_CHUNK, b"x" * 1000))
+    decoder.next_frame()
+    small = encode_message({"type": "text"})
+    # A small frame followed by the start of the next one: the buffer is not empty, so it keeps its size
+    decoder.feed(small + small[:3])
+    decoder.next_frame()
+    assert len(decoder.buffer) > 64
+    decoder.feed(small[3:])
+    assert decode_message(decoder.next_frame()[1]) == {"type": "text"}
+    assert len(decoder.buffer) == 64
@@ -0,0 +1,125 @@
+import pytest
+
+import RateLimit
+from Metrics import Metrics
+from RateLimit import (RateLimiter, TokenBucket, LIMIT_BYTES, LIMIT_MESSAGES, RATE_DELAY, RATE_DISCONNECT,
+                       RATE_DROP)
+
+
+class Clock:
+    # Stands in for time.monotonic so refills do not depend on how fast the tests run
+    def __init__(self):
+        self.now = 1024.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(RateLimit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_refuses(clock):
+    bucket = TokenBucket(rate=10, burst=5)
+    assert all(bucket.take(1) for _ in range(5))
+    assert not bucket.take(1)
+
+
+def test_bucket_refills_at_its_rate(clock):
+    bucket = TokenBucket(rate=8, burst=4)
+    for _ in range(4):
+        bucket.take(1)
+    clock.now += 0.25
+    # Two tokens came back
+    assert bucket.take(1) and bucket.take(1)
+    assert not bucket.take(1)
+    clock.now += 0.125
+    assert bucket.take(1)
+
+
+def test_bucket_never_holds_more_than_a_burst(clock):
+    bucket = TokenBucket(rate=10, burst=5)
+    clock.now += 3600
+    assert all(bucket.take(1) for _ in range(5))
+    assert not bucket.take(1)
+
+
+def test_burst_defaults_to_the_rate(clock):
+    bucket = TokenBucket(rate=3)
+    assert all(bucket.take(1) for _ in range(3))
+    assert not bucket.take(1)
+
+
+def test_amount_larger_than_a_burst_needs_a_full_bucket(clock):
+    bucket = TokenBucket(rate=8, burst=4)
+    assert bucket.take(6)
+    assert bucket.tokens == -2
+    clock.now += 0.5
+    # Back to 2 tokens, not full
+    assert not bucket.take(6)
+    clock.now += 0.25
+    assert bucket.take(6)
+
+
+def test_borrowing_returns_the_wait_until_the_debt_is_repaid(clock):
+    bucket = TokenBucket(rate=100, burst=100)
+    assert bucket.borrow(100) == 0.0
+    assert bucket.borrow(50) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.borrow(0) == 0.0
+
+
+def test_given_back_tokens_are_capped_at_a_burst(clock):
+    bucket = TokenBucket(rate=10, burst=5)
+    bucket.take(2)
+    bucket.give(10)
+    assert bucket.tokens == 5
+
+
+def test_drop_policy_discards_messages_past_the_limit(clock):
+    limiter = RateLimiter(Metrics(), policy=RATE_DROP, message_rate=2)
+    limits = limiter.connection_limits()
+    assert [limiter.admit(limits, LIMIT_MESSAGES) for _ in range(3)] == [0.0, 0.0, None]
+    # Upload bytes are delayed rather than discarded under "drop"
+    limiter = RateLimiter(Metrics(), policy=RATE_DROP, byte_rate=100)
+    limits = limiter.connection_limits()
+    assert limiter.admit(limits, LIMIT_BYTES, 100) == 0.0
+    assert limiter.admit(limits, LIMIT_BYTES, 50) == pytest.approx(0.5)
+
+
+def test_delay_policy_returns_the_wait(clock):
+    limiter = RateLimiter(Metrics(), policy=RATE_DELAY, message_rate=2)
+    limits = limiter.connection_limits()
+    assert [limiter.admit(limits, LIMIT_MESSAGES) for _ in range(3)] == [0.0, 0.0, pytest.approx(0.5)]
+
+
+def test_disconnect_policy_raises(clock):
+    limiter = RateLimiter(Metrics(), policy=RATE_DISCONNECT, message_rate=1)
+    limits = limiter.connection_limits()
+    limiter.admit(limits, LIMIT_MESSAGES)
+    with pytest.raises(ConnectionError):
+        limiter.admit(limits, LIMIT_MESSAGES)
+
+
+def test_global_limit_is_shared_and_refunds_the_connection(clock):
+    limiter = RateLimiter(Metrics(), policy=RATE_DROP, message_rate=5, global_message_rate=3)
+    first, second = limiter.connection_limits(), limiter.connection_limits()
+    assert [limiter.admit(first, LIMIT_MESSAGES) for _ in range(2)] == [0.0, 0.0]
+    assert limiter.admit(second, LIMIT_MESSAGES) == 0.0
+    assert limiter.admit(second, LIMIT_MESSAGES) is None
+    # The refused message did not use up the connection's own tokens
+    assert second.messages.tokens == 4
+
+
+def test_transfer_slots_per_user_and_in_total():
+    limiter = RateLimiter(Metrics(), transfers=1, global_transfers=2)
+    assert limiter.start_transfer("alice")
+    assert not limiter.start_transfer("alice")
+    assert limiter.start_transfer("bob")
+    assert not limiter.start_transfer("carol")
+    limiter.end_transfer("alice")
+    assert limiter.start_transfer("carol")
+    assert limiter.active_by_user == {"bob": 1, "carol": 1}